@@ -1,12 +1,16 @@
 from typing import Annotated, List, Optional
 from uuid import UUID
-from fastapi import APIRouter, Depends, status, Query
+from fastapi import APIRouter, Depends, HTTPException, Response, status, Query
 from sqlalchemy.ext.asyncio import AsyncSession
-from app.core.dependencies import get_db, get_current_user_id
+from app.core.config import settings
+from app.core.dependencies import get_db, get_current_user_id, get_admin_user_id
 from app.services.conversation_service import ConversationService
 from app.services.messaging_service import MessagingService
 from app.websocket.redis_store import RedisConnectionStore
 from app.schemas.messaging import (
+    BulkMessageCreate,
+    BulkMessageResponse,
+    BulkMessageResult,
     ConversationCreate,
     ConversationCreateDirect,
     ConversationResponse,
@@ -14,6 +18,7 @@ from app.schemas.messaging import (
     MessageResponse,
     PaginatedMessagesResponse,
     MessageReadReceiptResponse,
+    OnlineUsersPage,
     TypingIndicatorRequest,
     TypingIndicatorResponse,
 )
@@ -33,9 +38,38 @@ async def list_conversations(
 @router.get("/online", response_model=List[str])
 async def list_online_user_ids(
     _: Annotated[UUID, Depends(get_current_user_id)],
+    user_ids: Annotated[List[UUID], Query()] = [],
 ):
-    ids = await RedisConnectionStore.get_online_user_ids()
-    return list(ids)
+    """Which of the given users are online (at most PRESENCE_QUERY_MAX_IDS per call)."""
+    if len(user_ids) > settings.PRESENCE_QUERY_MAX_IDS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"At most {settings.PRESENCE_QUERY_MAX_IDS} user_ids per request",
+        )
+    return await RedisConnectionStore.get_online_among(user_ids)
+
+
+@router.get("/online/all", response_model=OnlineUsersPage)
+async def scan_online_user_ids(
+    _: Annotated[UUID, Depends(get_admin_user_id)],
+    cursor: int = Query(0, ge=0),
+    count: int = Query(500, ge=1),
+):
+    """Admin: page through every online user with an SSCAN cursor."""
+    next_cursor, ids = await RedisConnectionStore.scan_online_user_ids(
+        cursor, min(count, settings.PRESENCE_SCAN_MAX_COUNT)
+    )
+    return OnlineUsersPage(user_ids=ids, next_cursor=next_cursor or None)
+
+
+@router.get("/{conversation_id}/online", response_model=List[str])
+async def list_online_participants(
+    conversation_id: UUID,
+    user_id: Annotated[UUID, Depends(get_current_user_id)],
+    db: Annotated[AsyncSession, Depends(get_db)],
+):
+    svc = ConversationService(db)
+    return await svc.get_online_participants(conversation_id, user_id)
 
 
 @router.get("/direct", response_model=ConversationResponse)
@@ -87,19 +121,16 @@ async def get_messages(
     conversation_id: UUID,
     user_id: Annotated[UUID, Depends(get_current_user_id)],
     db: Annotated[AsyncSession, Depends(get_db)],
-    skip: int = Query(0, ge=0),
     limit: int = Query(50, ge=1, le=100),
-    cursor: Optional[UUID] = Query(None),
+    before: Optional[str] = Query(None, max_length=64),
+    after: Optional[str] = Query(None, max_length=64),
+    around: Optional[UUID] = Query(None),
     use_cache: bool = Query(True),
+    after_seq: Optional[int] = Query(None, ge=0),
 ):
     svc = MessagingService(db)
-    messages, next_cursor = await svc.get_conversation_messages(
-        conversation_id, user_id, skip, limit, cursor, use_cache
-    )
-    return PaginatedMessagesResponse(
-        messages=messages,
-        next_cursor=next_cursor,
-        has_more=next_cursor is not None,
+    return await svc.get_conversation_messages(
+        conversation_id, user_id, limit, before, after, around, use_cache, after_seq
     )
 
 
@@ -107,14 +138,64 @@ async def get_messages(
 async def send_message_rest(
     conversation_id: UUID,
     body: MessageCreate,
+    response: Response,
     user_id: Annotated[UUID, Depends(get_current_user_id)],
     db: Annotated[AsyncSession, Depends(get_db)],
 ):
     from fastapi import HTTPException
     if str(body.conversation_id) != str(conversation_id):
         raise HTTPException(status_code=400, detail="conversation_id mismatch")
+    from app.websocket.manager import ws_manager
+    from app.websocket.events import message_event
+    svc = MessagingService(db)
+    msg, created = await svc.send_message(user_id, body)
+    if not created:
+        # Retry of an earlier send: hand back the original, no second write or broadcast
+        response.status_code = status.HTTP_200_OK
+        return msg
+    await db.commit()
+    await ws_manager.broadcast_to_conversation(conversation_id, message_event(msg))
+    return msg
+
+
+@router.post("/messages/bulk", response_model=BulkMessageResponse)
+async def send_messages_bulk(
+    body: BulkMessageCreate,
+    user_id: Annotated[UUID, Depends(get_admin_user_id)],
+    db: Annotated[AsyncSession, Depends(get_db)],
+):
+    """
+    Admin (imports and bots): up to MESSAGE_BULK_MAX messages for any conversations the caller
+    is in, written in one transaction. Each conversation gets a single `message_batch` broadcast.
+    Restricted to ADMIN_USER_IDS because it is not charged against RATE_LIMIT_MESSAGE_PER_MINUTE.
+    """
+    from app.websocket.manager import ws_manager
+    from app.websocket.events import message_batch_event
     svc = MessagingService(db)
-    return await svc.send_message(user_id, body)
+    results = await svc.send_bulk(user_id, body.messages)
+
+    created_by_conversation: dict = {}
+    for msg, created in results:
+        if created:
+            created_by_conversation.setdefault(msg.conversation_id, []).append(msg)
+    for conversation_id, messages in created_by_conversation.items():
+        await ws_manager.broadcast_to_conversation(conversation_id, message_batch_event(conversation_id, messages))
+
+    created_count = sum(1 for _, created in results if created)
+    return BulkMessageResponse(
+        results=[
+            BulkMessageResult(
+                id=msg.id,
+                conversation_id=msg.conversation_id,
+                seq=msg.seq,
+                client_message_id=msg.client_message_id,
+                created=created,
+            )
+            for msg, created in results
+        ],
+        created=created_count,
+        duplicates=len(results) - created_count,
+    )
 
 
 @router.post("/{conversation_id}/read", status_code=status.HTTP_204_NO_CONTENT)
@@ -170,8 +251,7 @@ async def send_typing_indicator(
     db: Annotated[AsyncSession, Depends(get_db)],
 ):
     from app.repositories.user_repository import UserRepository
-    from app.websocket.typing_indicator import TypingIndicatorManager
-    from app.websocket.manager import ws_manager
+    from app.websocket.typing_indicator import typing_engine
     
     user_repo = UserRepository(db)
     user = await user_repo.get_by_id(user_id)
@@ -179,23 +259,7 @@ async def send_typing_indicator(
         from fastapi import HTTPException
         raise HTTPException(status_code=404, detail="User not found")
     
-    await TypingIndicatorManager.set_typing(conversation_id, user_id, user.username, body.is_typing)
-    
-    typing_users = await TypingIndicatorManager.get_typing_users(conversation_id)
-    payload = {
-        "type": "typing_indicator",
-        "conversation_id": str(conversation_id),
-        "typing_users": [
-            {
-                "user_id": uid,
-                "username": data.get("username", ""),
-                "timestamp": data.get("timestamp", ""),
-            }
-            for uid, data in typing_users.items()
-        ],
-    }
-    
-    await ws_manager.broadcast_to_conversation(conversation_id, payload)
+    await typing_engine.note(conversation_id, user_id, user.username, body.is_typing)
     return None
 
 
@@ -1,17 +1,30 @@
-from typing import Optional
+from functools import partial
+from typing import Annotated, Dict, Iterable, List, Literal, Optional, Tuple
 from uuid import UUID
 import json
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Query, status
+import msgpack
+from fastapi import APIRouter, Depends, HTTPException, WebSocket, WebSocketDisconnect, Query, status
+from app.core.config import settings
+from app.core.dependencies import get_admin_user_id, get_current_user_id
+from app.core.pagination import encode_cursor
 from app.core.security import verify_token
 from app.db.session import AsyncSessionLocal
 from app.repositories.user_repository import UserRepository
 from app.repositories.conversation_repository import ConversationRepository
 from app.websocket.manager import ws_manager
+from app.websocket.affinity import affinity_router
+from app.websocket.admission import AdmissionRejected, handshake_admission
+from app.websocket.events import message_event
+from app.websocket.inbound import InboundQueue
+from app.websocket.presence import presence_notifier
+from app.websocket.typing_indicator import typing_engine
 from app.services.messaging_service import MessagingService
-from app.schemas.messaging import MessageCreate
+from app.services.message_writer import CommittedWriteError, message_writer
 
 router = APIRouter()
 
+HEARTBEAT_EVENTS = {"ping", "pong"}
+
 
 async def get_user_id_from_token(token: str) -> Optional[UUID]:
     payload = verify_token(token)
@@ -26,138 +39,472 @@ async def get_user_id_from_token(token: str) -> Optional[UUID]:
         return None
 
 
+def _parse_conversation_ids(body: dict) -> List[UUID]:
+    raw = body.get("conversation_ids")
+    if raw is None:
+        raw = [body.get("conversation_id")]
+    ids = []
+    for value in raw if isinstance(raw, list) else []:
+        try:
+            ids.append(UUID(str(value)))
+        except (ValueError, TypeError):
+            continue
+    return ids
+
+
+async def _receive(websocket: WebSocket, connection_id: str) -> Optional[dict]:
+    """Next client frame: JSON text, or MessagePack in a binary frame. None if it does not decode to an object."""
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", status.WS_1000_NORMAL_CLOSURE))
+    ws_manager.touch(connection_id)
+    try:
+        if message.get("bytes") is not None:
+            body = msgpack.unpackb(message["bytes"], raw=False)
+        else:
+            body = json.loads(message.get("text") or "")
+    except (ValueError, TypeError, msgpack.UnpackException):
+        return None
+    return body if isinstance(body, dict) else None
+
+
+async def _get_username(user_id: UUID) -> str:
+    async with AsyncSessionLocal() as db:
+        user_repo = UserRepository(db)
+        user = await user_repo.get_by_id(user_id)
+        return user.username if user else "Unknown"
+
+
+async def _replay_offline(connection_id: str, conversation_id: UUID, user_id: UUID) -> None:
+    """
+    Stream unread messages in keyset chunks, one offline_batch frame per chunk, waiting on the
+    socket's queue between chunks. Stops after WS_OFFLINE_REPLAY_MAX messages with an
+    offline_more marker; only replayed messages are marked read.
+    """
+    last = None
+    sent = 0
+    more_available = False
+    while True:
+        budget = settings.WS_OFFLINE_REPLAY_MAX - sent
+        limit = min(settings.WS_OFFLINE_BATCH_SIZE, budget)
+        # Short session per chunk so a slow client never pins a pooled connection
+        async with AsyncSessionLocal() as db:
+            chunk = await MessagingService(db).get_offline_chunk(conversation_id, user_id, last, limit + 1)
+        if not chunk:
+            break
+        has_more = len(chunk) > limit
+        chunk = chunk[:limit]
+        await ws_manager.wait_writable(connection_id)
+        delivered = await ws_manager.send_to_connection(connection_id, {
+            "type": "offline_batch",
+            "conversation_id": str(conversation_id),
+            "messages": [message_event(msg, "offline_message") for msg in chunk],
+        })
+        if not delivered:
+            return
+        last = chunk[-1]
+        sent += len(chunk)
+        if not has_more:
+            break
+        if sent >= settings.WS_OFFLINE_REPLAY_MAX:
+            more_available = True
+            break
+
+    if more_available:
+        await ws_manager.send_to_connection(connection_id, {
+            "type": "offline_more",
+            "conversation_id": str(conversation_id),
+            "next_cursor": encode_cursor(last.created_at, last.id),
+        })
+    if last is not None:
+        async with AsyncSessionLocal() as db:
+            await MessagingService(db).mark_read(conversation_id, user_id, up_to=last.created_at)
+            await db.commit()
+
+
+async def _resume(connection_id: str, conversation_id: UUID, user_id: UUID, cursor: str) -> None:
+    """
+    Deliver only what the client missed since `cursor` (the `cursor` of the last message event it
+    received). When the cursor is invalid or more than WS_RESUME_MAX_GAP messages followed it,
+    send a resync marker and fall back to the full offline replay.
+    """
+    max_gap = settings.WS_RESUME_MAX_GAP
+    async with AsyncSessionLocal() as db:
+        delta = await MessagingService(db).get_resume_delta(conversation_id, cursor, max_gap + 1)
+    if delta is None or len(delta) > max_gap:
+        await ws_manager.send_to_connection(connection_id, {
+            "type": "resync",
+            "conversation_id": str(conversation_id),
+            "reason": "unknown_cursor" if delta is None else "gap_too_large",
+        })
+        await _replay_offline(connection_id, conversation_id, user_id)
+        return
+
+    batch_size = settings.WS_OFFLINE_BATCH_SIZE
+    for start in range(0, len(delta), batch_size):
+        await ws_manager.wait_writable(connection_id)
+        delivered = await ws_manager.send_to_connection(connection_id, {
+            "type": "resume_batch",
+            "conversation_id": str(conversation_id),
+            "messages": [message_event(msg) for msg in delta[start:start + batch_size]],
+        })
+        if not delivered:
+            return
+    await ws_manager.send_to_connection(connection_id, {
+        "type": "resumed",
+        "conversation_id": str(conversation_id),
+        "count": len(delta),
+    })
+    # Nothing missed means nothing to mark: a reconnect after a blip costs one indexed read
+    if delta:
+        async with AsyncSessionLocal() as db:
+            await MessagingService(db).mark_read(conversation_id, user_id, up_to=delta[-1].created_at)
+            await db.commit()
+
+
+def _parse_resume(body: dict) -> Dict[UUID, str]:
+    raw = body.get("resume_from")
+    resume = {}
+    for conversation_id, cursor in (raw.items() if isinstance(raw, dict) else ()):
+        try:
+            resume[UUID(str(conversation_id))] = str(cursor)[:64]
+        except (ValueError, TypeError):
+            continue
+    return resume
+
+
+async def _handle_heartbeat(connection_id: str, event_type: str) -> None:
+    # Server pings are answered with pong and only refresh liveness; clients may ping too
+    if event_type == "ping":
+        await ws_manager.send_to_connection(connection_id, {"type": "pong"})
+
+
+async def _handle_typing(conversation_id: UUID, user_id: UUID, username: str, is_typing: bool) -> None:
+    await typing_engine.note(conversation_id, user_id, username, is_typing)
+
+
+def _client_message_id(body: dict) -> Optional[str]:
+    value = body.get("client_message_id")
+    if isinstance(value, str) and 0 < len(value) <= 64:
+        return value
+    return None
+
+
+async def _queue_message(
+    inbound: InboundQueue,
+    connection_id: str,
+    conversation_id: UUID,
+    content: str,
+    client_message_id: Optional[str],
+) -> None:
+    if inbound.full():
+        # Tell the client before we stop reading its socket
+        await ws_manager.send_to_connection(connection_id, {"type": "backpressure", "queued": inbound.qsize()})
+    await inbound.put((conversation_id, content, client_message_id))
+
+
+async def _handle_messages(
+    connection_id: str,
+    user_id: UUID,
+    items: List[Tuple[UUID, str, Optional[str]]],
+) -> None:
+    """
+    Process a batch of one sender's queued messages: one rate-limit round trip for the batch,
+    one membership check per conversation, all rows handed to the group-commit writer at once,
+    then broadcasts in the order the messages were received.
+    """
+    from app.core.rate_limit import RateLimiter
+    granted, retry_after = await RateLimiter.acquire(
+        f"user:{user_id}:send_message", len(items), settings.RATE_LIMIT_MESSAGE_PER_MINUTE, 60
+    )
+    if granted < len(items):
+        error_payload = {
+            "type": "error",
+            "message": f"Rate limit exceeded. Retry after {retry_after} seconds",
+            "retry_after": retry_after,
+        }
+        await ws_manager.send_to_connection(connection_id, error_payload)
+        items = items[:granted]
+
+    allowed = set()
+    async with AsyncSessionLocal() as db:
+        conv_repo = ConversationRepository(db)
+        for conversation_id in dict.fromkeys(item[0] for item in items):
+            if await conv_repo.is_participant(conversation_id, user_id):
+                allowed.add(conversation_id)
+            else:
+                await ws_manager.send_to_connection(connection_id, {"type": "error", "message": "Not a participant"})
+
+    pending = [
+        (client_message_id, message_writer.enqueue(user_id, conversation_id, content, client_message_id))
+        for conversation_id, content, client_message_id in items
+        if conversation_id in allowed
+    ]
+    for client_message_id, future in pending:
+        try:
+            msg, created = await future
+        except Exception as exc:
+            error_payload = {"type": "error", "message": "Message could not be sent"}
+            if isinstance(exc, CommittedWriteError):
+                # Only a retry whose original could not be read back ends up here: it is stored,
+                # and resending with the same client_message_id returns it without a second copy
+                error_payload["message"] = "Message already stored; resend with the same client_message_id"
+            if client_message_id:
+                error_payload["client_message_id"] = client_message_id
+            await ws_manager.send_to_connection(connection_id, error_payload)
+            continue
+
+        payload = message_event(msg)
+        if not created:
+            # Re-sent after a flaky connection: acknowledge with the original, others already have it
+            await ws_manager.send_to_connection(connection_id, payload)
+            continue
+
+        await ws_manager.broadcast_to_conversation(
+            msg.conversation_id,
+            payload,
+            exclude_connection_id=connection_id,
+        )
+        await ws_manager.send_to_connection(connection_id, payload)
+
+
+async def _cleanup_typing(user_id: UUID, conversation_ids: Iterable[UUID]) -> None:
+    for conversation_id in conversation_ids:
+        await typing_engine.clear(conversation_id, user_id)
+
+
+async def _cleanup(
+    connection_id: str,
+    user_id: UUID,
+    conversation_ids: Iterable[UUID],
+    inbound: Optional[InboundQueue] = None,
+) -> None:
+    if inbound is not None:
+        await inbound.close()
+    await _cleanup_typing(user_id, conversation_ids)
+    await ws_manager.disconnect(connection_id)
+
+
+async def _reject_handshake(websocket: WebSocket, retry_after: int) -> None:
+    # Accept first so the client sees the close code and retry hint rather than a bare HTTP 403
+    await websocket.accept()
+    await websocket.send_json({"type": "retry", "retry_after": retry_after})
+    await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER, reason=f"retry_after={retry_after}")
+
+
+async def _start_conversation_socket(
+    connection_id: str,
+    conversation_id: UUID,
+    user_id: UUID,
+    resume_from: Optional[str],
+) -> bool:
+    """Affinity hint and offline replay/resume for a new socket. False if it went away meanwhile."""
+    try:
+        if settings.WS_AFFINITY_ENABLED:
+            hint = affinity_router.hint(conversation_id, ws_manager.node_id)
+            if hint is not None:
+                await ws_manager.send_to_connection(connection_id, hint)
+        if resume_from is not None:
+            await _resume(connection_id, conversation_id, user_id, resume_from)
+        else:
+            await _replay_offline(connection_id, conversation_id, user_id)
+    except WebSocketDisconnect:
+        await _cleanup(connection_id, user_id, [conversation_id])
+        return False
+    except Exception:
+        await _cleanup(connection_id, user_id, [conversation_id])
+        raise
+    return True
+
+
+@router.get("/route")
+async def route_conversation(
+    conversation_id: UUID,
+    _: Annotated[UUID, Depends(get_current_user_id)],
+):
+    """Which WebSocket node owns a conversation under conversation affinity (no database access)."""
+    if not settings.WS_AFFINITY_ENABLED:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Conversation affinity is disabled")
+    route = await affinity_router.route(conversation_id)
+    if route is None:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="No WebSocket nodes available")
+    node_id, url = route
+    return {
+        "conversation_id": str(conversation_id),
+        "node_id": node_id,
+        "url": url,
+        "ring_version": affinity_router.ring.version,
+    }
+
+
+@router.get("/stats")
+async def realtime_stats(
+    _: Annotated[UUID, Depends(get_admin_user_id)],
+):
+    """Admin: this node's sockets and the counters of its writer, fan-out, typing, admission and presence."""
+    return {
+        "node_id": ws_manager.node_id,
+        "connections": ws_manager.stats(),
+        "writer": message_writer.stats(),
+        "fanout": ws_manager.fanout.stats(),
+        "typing": typing_engine.stats(),
+        "admission": handshake_admission.stats(),
+        "presence": presence_notifier.stats(),
+    }
+
+
 @router.websocket("/conversations/{conversation_id}")
 async def conversation_websocket(
     websocket: WebSocket,
     conversation_id: UUID,
     token: str = Query(..., alias="token"),
+    resume_from: Optional[str] = Query(None, max_length=64),
+    encoding: Literal["json", "msgpack"] = Query("json"),
+    compact: bool = Query(False),
 ):
+    if ws_manager.draining:
+        await websocket.close(code=status.WS_1012_SERVICE_RESTART)
+        return
     user_id = await get_user_id_from_token(token)
     if user_id is None:
         await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
         return
 
-    async with AsyncSessionLocal() as db:
-        conv_repo = ConversationRepository(db)
-        conv = await conv_repo.get_with_participants(conversation_id)
-        if not conv:
-            await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
-            return
-        if user_id not in {p.id for p in conv.participants}:
-            await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
-            return
+    try:
+        # Only the membership check and registration hold an admission slot. Replay waits on the
+        # client's socket, so a client that stops reading must not keep other handshakes out.
+        async with handshake_admission.slot():
+            async with AsyncSessionLocal() as db:
+                username = await ConversationRepository(db).get_participant_username(conversation_id, user_id)
+            if username is None:
+                await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+                return
+            connection_id = await ws_manager.connect(websocket, user_id, conversation_id, encoding, compact)
+    except AdmissionRejected as exc:
+        await _reject_handshake(websocket, exc.retry_after)
+        return
+    if not await _start_conversation_socket(connection_id, conversation_id, user_id, resume_from):
+        return
+
+    inbound = InboundQueue(partial(_handle_messages, connection_id, user_id))
+    try:
+        while True:
+            body = await _receive(websocket, connection_id)
+            if body is None:
+                continue
+
+            event_type = body.get("type", "message")
+            if event_type in HEARTBEAT_EVENTS:
+                await _handle_heartbeat(connection_id, event_type)
+                continue
 
-    connection_id = await ws_manager.connect(websocket, user_id, conversation_id)
+            if event_type == "typing":
+                await _handle_typing(conversation_id, user_id, username, body.get("is_typing", True))
+                continue
+
+            content = (body.get("content") or "").strip()
+            if not content:
+                continue
+            await _queue_message(inbound, connection_id, conversation_id, content, _client_message_id(body))
+
+    except WebSocketDisconnect:
+        await _cleanup(connection_id, user_id, [conversation_id], inbound)
+    except Exception:
+        await _cleanup(connection_id, user_id, [conversation_id], inbound)
+        raise
+
+
+@router.websocket("/user")
+async def user_websocket(
+    websocket: WebSocket,
+    token: str = Query(..., alias="token"),
+    encoding: Literal["json", "msgpack"] = Query("json"),
+    compact: bool = Query(False),
+):
+    """
+    One socket per user, multiplexing any number of conversations.
+    The client subscribes/unsubscribes conversations over the socket; message and typing
+    frames name the conversation they target.
+    """
+    if ws_manager.draining:
+        await websocket.close(code=status.WS_1012_SERVICE_RESTART)
+        return
+    user_id = await get_user_id_from_token(token)
+    if user_id is None:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
 
     try:
-        async with AsyncSessionLocal() as db:
-            messaging = MessagingService(db)
-            offline = await messaging.get_offline_messages(conversation_id, user_id)
-            for msg in offline:
-                payload = {
-                    "type": "offline_message",
-                    "id": str(msg.id),
-                    "sender_id": str(msg.sender_id),
-                    "conversation_id": str(msg.conversation_id),
-                    "content": msg.content,
-                    "timestamp": msg.created_at.isoformat(),
-                    "read_status": msg.read_status.value if hasattr(msg.read_status, "value") else str(msg.read_status),
-                }
-                if msg.sender:
-                    payload["sender"] = {"id": str(msg.sender.id), "username": msg.sender.username, "email": msg.sender.email}
-                await ws_manager.send_to_connection(connection_id, payload)
-            await messaging.mark_read(conversation_id, user_id)
-            await db.commit()
+        async with handshake_admission.slot():
+            username = await _get_username(user_id)
+    except AdmissionRejected as exc:
+        await _reject_handshake(websocket, exc.retry_after)
+        return
 
-        async with AsyncSessionLocal() as db:
-            user_repo = UserRepository(db)
-            user = await user_repo.get_by_id(user_id)
-            username = user.username if user else "Unknown"
+    connection_id = await ws_manager.connect(websocket, user_id, encoding=encoding, compact=compact)
+    inbound = InboundQueue(partial(_handle_messages, connection_id, user_id))
 
+    try:
         while True:
-            data = await websocket.receive_text()
-            try:
-                body = json.loads(data)
-            except json.JSONDecodeError:
+            body = await _receive(websocket, connection_id)
+            if body is None:
                 continue
-            
+
             event_type = body.get("type", "message")
-            
+            if event_type in HEARTBEAT_EVENTS:
+                await _handle_heartbeat(connection_id, event_type)
+                continue
+            conversation_ids = _parse_conversation_ids(body)
+            subscriptions = ws_manager.get_subscriptions(connection_id)
+
+            if event_type == "subscribe":
+                room = settings.WS_MAX_SUBSCRIPTIONS - len(subscriptions)
+                requested = [c for c in conversation_ids if c not in subscriptions][:max(room, 0)]
+                async with AsyncSessionLocal() as db:
+                    allowed = await ConversationRepository(db).get_participating_ids(user_id, requested)
+                added = await ws_manager.subscribe(connection_id, [c for c in requested if c in allowed])
+                await ws_manager.send_to_connection(connection_id, {
+                    "type": "subscribed",
+                    "conversation_ids": [str(c) for c in added],
+                    "rejected": [str(c) for c in conversation_ids if c not in allowed and c not in subscriptions],
+                })
+                resume = _parse_resume(body)
+                for conversation_id in added:
+                    if conversation_id in resume:
+                        await _resume(connection_id, conversation_id, user_id, resume[conversation_id])
+                    elif body.get("replay"):
+                        await _replay_offline(connection_id, conversation_id, user_id)
+                continue
+
+            if event_type == "unsubscribe":
+                removed = await ws_manager.unsubscribe(connection_id, conversation_ids)
+                await _cleanup_typing(user_id, removed)
+                await ws_manager.send_to_connection(connection_id, {
+                    "type": "unsubscribed",
+                    "conversation_ids": [str(c) for c in removed],
+                })
+                continue
+
+            if len(conversation_ids) != 1 or conversation_ids[0] not in subscriptions:
+                await ws_manager.send_to_connection(connection_id, {
+                    "type": "error",
+                    "message": "Not subscribed to conversation",
+                    "conversation_id": body.get("conversation_id"),
+                })
+                continue
+            conversation_id = conversation_ids[0]
+
             if event_type == "typing":
-                from app.websocket.typing_indicator import TypingIndicatorManager
-                is_typing = body.get("is_typing", True)
-                await TypingIndicatorManager.set_typing(conversation_id, user_id, username, is_typing)
-                
-                typing_users = await TypingIndicatorManager.get_typing_users(conversation_id)
-                payload = {
-                    "type": "typing_indicator",
-                    "conversation_id": str(conversation_id),
-                    "typing_users": [
-                        {
-                            "user_id": uid,
-                            "username": t_data.get("username", ""),
-                            "timestamp": t_data.get("timestamp", ""),
-                        }
-                        for uid, t_data in typing_users.items()
-                    ],
-                }
-                await ws_manager.broadcast_to_conversation(conversation_id, payload)
+                await _handle_typing(conversation_id, user_id, username, body.get("is_typing", True))
                 continue
-            
+
             content = (body.get("content") or "").strip()
             if not content:
                 continue
-
-            async with AsyncSessionLocal() as db:
-                from app.core.rate_limit import RateLimiter
-                allowed, retry_after = await RateLimiter.check_user_rate_limit(
-                    user_id, "send_message", 30, 60
-                )
-                if not allowed:
-                    error_payload = {
-                        "type": "error",
-                        "message": f"Rate limit exceeded. Retry after {retry_after} seconds",
-                        "retry_after": retry_after,
-                    }
-                    await ws_manager.send_to_connection(connection_id, error_payload)
-                    continue
-                
-                messaging = MessagingService(db)
-                try:
-                    msg = await messaging.send_message(
-                        user_id,
-                        MessageCreate(conversation_id=conversation_id, content=content),
-                    )
-                    await db.commit()
-                except Exception:
-                    await db.rollback()
-                    continue
-
-            payload = {
-                "type": "message",
-                "id": str(msg.id),
-                "sender_id": str(msg.sender_id),
-                "conversation_id": str(msg.conversation_id),
-                "content": msg.content,
-                "timestamp": msg.created_at.isoformat(),
-                "read_status": msg.read_status.value if hasattr(msg.read_status, "value") else str(msg.read_status),
-            }
-            if msg.sender:
-                payload["sender"] = {"id": str(msg.sender.id), "username": msg.sender.username, "email": msg.sender.email}
-
-            await ws_manager.broadcast_to_conversation(
-                conversation_id,
-                payload,
-                exclude_connection_id=connection_id,
-            )
-            await ws_manager.send_to_connection(connection_id, payload)
+            await _queue_message(inbound, connection_id, conversation_id, content, _client_message_id(body))
 
     except WebSocketDisconnect:
-        from app.websocket.typing_indicator import TypingIndicatorManager
-        await TypingIndicatorManager.clear_typing(conversation_id, user_id)
-        await ws_manager.disconnect(connection_id, conversation_id)
+        await _cleanup(connection_id, user_id, ws_manager.get_subscriptions(connection_id), inbound)
     except Exception:
-        from app.websocket.typing_indicator import TypingIndicatorManager
-        await TypingIndicatorManager.clear_typing(conversation_id, user_id)
-        await ws_manager.disconnect(connection_id, conversation_id)
+        await _cleanup(connection_id, user_id, ws_manager.get_subscriptions(connection_id), inbound)
         raise
@@ -1,5 +1,5 @@
 from pydantic_settings import BaseSettings, SettingsConfigDict
-from typing import Optional
+from typing import Literal, Optional
 
 
 class Settings(BaseSettings):
@@ -35,6 +35,51 @@ class Settings(BaseSettings):
     
     # WebSocket
     WS_HEARTBEAT_INTERVAL: int = 30
+    # Opt-in: clients must answer the server's app-level ping; 0 only reaps sockets whose writer failed
+    WS_IDLE_TIMEOUT: int = 0
+    WS_NODE_LEASE_TTL: int = 90
+    WS_PUBSUB_ENABLED: bool = False
+    WS_SEND_QUEUE_SIZE: int = 256
+    WS_SEND_OVERFLOW_POLICY: Literal["drop", "coalesce", "disconnect"] = "drop"
+    WS_MAX_SUBSCRIPTIONS: int = 500
+    WS_OFFLINE_BATCH_SIZE: int = 100
+    WS_OFFLINE_REPLAY_MAX: int = 1000
+    WS_RESUME_MAX_GAP: int = 200
+    WS_FANOUT_THRESHOLD: int = 1000
+    WS_FANOUT_SHARD_SIZE: int = 256
+    WS_INBOUND_QUEUE_SIZE: int = 64
+    WS_INBOUND_MAX_BATCH: int = 32
+    WS_HANDSHAKE_CONCURRENCY: int = 4
+    WS_HANDSHAKE_MAX_WAIT_MS: int = 2000
+    WS_HANDSHAKE_RETRY_AFTER: int = 5
+    WS_DRAIN_TIMEOUT: float = 10.0
+    WS_DRAIN_RECONNECT_MS: int = 1000
+    WS_DRAIN_JITTER_MS: int = 15000
+    WS_AFFINITY_ENABLED: bool = False
+    WS_NODE_URL: Optional[str] = None
+    WS_AFFINITY_VNODES: int = 64
+    
+    # Presence
+    PRESENCE_QUERY_MAX_IDS: int = 500
+    PRESENCE_SCAN_MAX_COUNT: int = 1000
+    ADMIN_USER_IDS: list[str] = []
+    PRESENCE_PUSH_INTERVAL_MS: int = 1000
+    PRESENCE_OFFLINE_GRACE_SECONDS: float = 5.0
+    
+    # Message writer (group commit for WebSocket sends)
+    MESSAGE_WRITER_MAX_BATCH: int = 200
+    MESSAGE_WRITER_FLUSH_MS: int = 2
+    # How long Redis remembers a client_message_id (message_client_ids covers retries after that)
+    MESSAGE_DEDUPE_WINDOW_SECONDS: int = 86400
+    # Bulk ingest (POST /conversations/messages/bulk)
+    MESSAGE_BULK_MAX: int = 5000
+    MESSAGE_BULK_INSERT_CHUNK: int = 1000
+    # Monthly partitions of messages created ahead of the current month
+    MESSAGE_PARTITION_MONTHS_AHEAD: int = 3
+    
+    # Typing indicators
+    TYPING_TICK_MS: int = 200
+    TYPING_REFRESH_SECONDS: float = 3.0
     
     # Rate Limiting
     RATE_LIMIT_REQUESTS_PER_MINUTE: int = 60
@@ -46,6 +46,18 @@ async def get_current_user_id(
     return user_id
 
 
+async def get_admin_user_id(
+    user_id: Annotated[UUID, Depends(get_current_user_id)],
+) -> UUID:
+    """Current user, restricted to ADMIN_USER_IDS."""
+    if str(user_id) not in settings.ADMIN_USER_IDS:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin access required",
+        )
+    return user_id
+
+
 async def get_current_user(
     user_id: Annotated[UUID, Depends(get_current_user_id)],
     db: Annotated[AsyncSession, Depends(get_db)]
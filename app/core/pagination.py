@@ -0,0 +1,28 @@
+import base64
+import binascii
+import struct
+from datetime import datetime, timedelta, timezone
+from typing import Tuple
+from uuid import UUID
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+# Microseconds since the epoch (signed 64-bit) followed by the 16 UUID bytes
+_CURSOR = struct.Struct(">q16s")
+
+
+def encode_cursor(created_at: datetime, message_id: UUID) -> str:
+    """Opaque keyset cursor for a message position: (created_at, id), URL-safe, 32 characters."""
+    if created_at.tzinfo is None:
+        created_at = created_at.replace(tzinfo=timezone.utc)
+    micros = (created_at - EPOCH) // timedelta(microseconds=1)
+    return base64.urlsafe_b64encode(_CURSOR.pack(micros, message_id.bytes)).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, UUID]:
+    """Inverse of encode_cursor. Raises ValueError for anything it did not produce."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        micros, id_bytes = _CURSOR.unpack(raw)
+        return EPOCH + timedelta(microseconds=micros), UUID(bytes=id_bytes)
+    except (binascii.Error, struct.error, OverflowError, ValueError, TypeError) as exc:
+        raise ValueError("Invalid cursor") from exc
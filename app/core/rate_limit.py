@@ -6,6 +6,18 @@ from starlette.middleware.base import BaseHTTPMiddleware
 from app.db.redis_client import get_redis
 import time
 
+# KEYS[1] window counter; ARGV[1] requested, ARGV[2] limit, ARGV[3] ttl. Adds only what fits under
+# the limit, so a partly denied request does not use up units it was not given. Returns the grant.
+ACQUIRE_SCRIPT = """
+local used = tonumber(redis.call('GET', KEYS[1]) or '0')
+local granted = math.max(0, math.min(tonumber(ARGV[1]), tonumber(ARGV[2]) - used))
+if granted > 0 then
+    redis.call('INCRBY', KEYS[1], granted)
+end
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return granted
+"""
+
 
 class RateLimitMiddleware(BaseHTTPMiddleware):
     def __init__(self, app, requests_per_minute: int = 60, requests_per_hour: int = 1000):
@@ -88,6 +100,28 @@ class RateLimiter:
         
         return True, None
 
+    @staticmethod
+    async def acquire(
+        key: str,
+        requested: int,
+        limit: int,
+        window_seconds: int,
+    ) -> tuple[int, Optional[int]]:
+        """
+        Take up to `requested` units from the window in one round trip (a Lua script, so the check
+        and the increment are atomic and only granted units are counted). Returns how many were
+        granted and, if not all, the seconds until the window resets.
+        """
+        redis = await get_redis()
+        current_window = int(time.time() / window_seconds)
+        rate_key = f"rate_limit:{key}:{current_window}"
+
+        script = redis.register_script(ACQUIRE_SCRIPT)
+        granted = int(await script(keys=[rate_key], args=[requested, limit, window_seconds + 10]))
+        if granted < requested:
+            return granted, window_seconds - (int(time.time()) % window_seconds)
+        return granted, None
+
     @staticmethod
     async def check_user_rate_limit(
         user_id: UUID,
@@ -1,7 +1,7 @@
 import enum
 from datetime import datetime
 from uuid import uuid4
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Text, Table, Enum, Index
+from sqlalchemy import BigInteger, Column, Integer, String, Boolean, DateTime, ForeignKey, ForeignKeyConstraint, Text, Table, Enum, Index
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
@@ -98,37 +98,108 @@ class Conversation(Base):
 
 
 class Message(Base):
+    """
+    Range-partitioned by created_at, one partition per month (see app/db/partitions.py). Postgres
+    requires the partition key in every unique index, so the primary key is (id, created_at) and
+    per-conversation uniqueness of seq / client_message_id lives in MessageSeq / MessageClientId.
+    """
     __tablename__ = "messages"
     
-    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid4, index=True)
-    sender_id = Column(UUID(as_uuid=True), ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True)
-    conversation_id = Column(UUID(as_uuid=True), ForeignKey("conversations.id", ondelete="CASCADE"), nullable=False, index=True)
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid4)
+    sender_id = Column(UUID(as_uuid=True), ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    conversation_id = Column(UUID(as_uuid=True), ForeignKey("conversations.id", ondelete="CASCADE"), nullable=False)
+    # Per-conversation, strictly increasing (gaps possible); unique through MessageSeq
+    seq = Column(BigInteger, nullable=False)
+    # Optional sender-chosen id making retried sends idempotent; unique through MessageClientId
+    client_message_id = Column(String(64), nullable=True)
     content = Column(Text, nullable=False)
-    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False, index=True)
-    read_status = Column(Enum(MessageReadStatus), nullable=False, default=MessageReadStatus.sent, index=True)
+    # Partition key
+    created_at = Column(DateTime(timezone=True), primary_key=True, server_default=func.now(), nullable=False)
+    read_status = Column(Enum(MessageReadStatus), nullable=False, default=MessageReadStatus.sent)
     
     conversation = relationship("Conversation", back_populates="messages")
     sender = relationship("User", back_populates="messages_sent")
     read_receipts = relationship("MessageReadReceipt", back_populates="message", cascade="all, delete-orphan")
     
     __table_args__ = (
-        Index("idx_messages_conversation_created", "conversation_id", "created_at"),
+        # Keyset pagination by (created_at, id) within a conversation, both directions
+        Index("idx_messages_conversation_created", "conversation_id", "created_at", "id"),
+        Index("idx_messages_conversation_seq", "conversation_id", "seq"),
         Index("idx_messages_sender_conversation", "sender_id", "conversation_id"),
+        {"postgresql_partition_by": "RANGE (created_at)"},
+    )
+
+
+class MessageClientId(Base):
+    """
+    Uniqueness of (conversation_id, sender_id, client_message_id) for idempotent sends, kept out of
+    the partitioned messages table where a unique index would have to include created_at.
+    Claimed in the same transaction as the message insert.
+    """
+    __tablename__ = "message_client_ids"
+
+    conversation_id = Column(UUID(as_uuid=True), primary_key=True)
+    sender_id = Column(UUID(as_uuid=True), primary_key=True)
+    client_message_id = Column(String(64), primary_key=True)
+    message_id = Column(UUID(as_uuid=True), nullable=False)
+    message_created_at = Column(DateTime(timezone=True), nullable=False)
+
+    __table_args__ = (
+        ForeignKeyConstraint(
+            ["message_id", "message_created_at"],
+            ["messages.id", "messages.created_at"],
+            ondelete="CASCADE",
+            # Claims are inserted just before the message they point at
+            deferrable=True,
+            initially="DEFERRED",
+        ),
+    )
+
+
+class MessageSeq(Base):
+    """
+    Uniqueness of (conversation_id, seq), which the partitioned messages table cannot enforce.
+    Claimed in the same transaction as the message insert; see MessageSequenceService.claim.
+    """
+    __tablename__ = "message_seqs"
+
+    conversation_id = Column(UUID(as_uuid=True), primary_key=True)
+    seq = Column(BigInteger, primary_key=True)
+    message_id = Column(UUID(as_uuid=True), nullable=False)
+    message_created_at = Column(DateTime(timezone=True), nullable=False)
+
+    __table_args__ = (
+        ForeignKeyConstraint(
+            ["message_id", "message_created_at"],
+            ["messages.id", "messages.created_at"],
+            ondelete="CASCADE",
+            # Claims are inserted just before the message they point at
+            deferrable=True,
+            initially="DEFERRED",
+        ),
     )
 
 
 class MessageReadReceipt(Base):
     __tablename__ = "message_read_receipts"
     
-    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid4, index=True)
-    message_id = Column(UUID(as_uuid=True), ForeignKey("messages.id", ondelete="CASCADE"), nullable=False, index=True)
-    user_id = Column(UUID(as_uuid=True), ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True)
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid4)
+    # Lookups by message use idx_read_receipts_message_user, by user idx_read_receipts_user_read_at
+    message_id = Column(UUID(as_uuid=True), nullable=False)
+    # Part of the foreign key: messages is partitioned and keyed by (id, created_at)
+    message_created_at = Column(DateTime(timezone=True), nullable=False)
+    user_id = Column(UUID(as_uuid=True), ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
     read_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
     
     message = relationship("Message", back_populates="read_receipts")
     user = relationship("User")
     
     __table_args__ = (
+        ForeignKeyConstraint(
+            ["message_id", "message_created_at"],
+            ["messages.id", "messages.created_at"],
+            ondelete="CASCADE",
+        ),
         Index("idx_read_receipts_message_user", "message_id", "user_id", unique=True),
         Index("idx_read_receipts_user_read_at", "user_id", "read_at"),
     )
@@ -0,0 +1,128 @@
+import asyncio
+import logging
+from datetime import date, datetime, timezone
+from typing import List, Optional, Tuple
+from sqlalchemy import text
+from app.core.config import settings
+from app.db.session import engine
+
+logger = logging.getLogger(__name__)
+
+MESSAGES_TABLE = "messages"
+# Partition names sort chronologically: messages_p2026_01, messages_p2026_02, ...
+PARTITION_NAME = MESSAGES_TABLE + "_p{year:04d}_{month:02d}"
+# Not created: a DEFAULT partition rules out ordered partition scans (every newest-page query
+# would MergeAppend across all months) and blocks creating a month it holds rows for.
+# Reported if an older deployment left one behind.
+DEFAULT_PARTITION = MESSAGES_TABLE + "_default"
+# Serializes partition DDL across app instances starting at once
+ADVISORY_LOCK_ID = 0x6D736770  # "msgp"
+CHECK_INTERVAL_SECONDS = 6 * 3600
+
+
+def add_months(day: date, months: int) -> date:
+    index = day.year * 12 + day.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def monthly_ranges(today: date, months_ahead: int) -> List[Tuple[str, date, date]]:
+    """(name, from, to) for last month, this month and `months_ahead` months after it (UTC)."""
+    first = add_months(today.replace(day=1), -1)
+    ranges = []
+    for i in range(months_ahead + 2):
+        start = add_months(first, i)
+        end = add_months(start, 1)
+        ranges.append((PARTITION_NAME.format(year=start.year, month=start.month), start, end))
+    return ranges
+
+
+class UnpartitionedMessagesTable(RuntimeError):
+    pass
+
+
+MIGRATION_HINT = (
+    "Table 'messages' exists but is not partitioned by created_at. It cannot be converted in "
+    "place: create the partitioned table, copy rows month by month and swap the names (README: "
+    "Message partitioning), then restart."
+)
+
+
+class MessagePartitionMaintainer:
+    """
+    Keeps monthly range partitions of `messages` created ahead of time. Runs once at startup
+    (right after create_all) and then every few hours, so the month boundary never arrives without
+    its partition even on a long-lived instance. Every statement is CREATE TABLE IF NOT EXISTS
+    under a transaction-level advisory lock, so any number of instances can run it. Old
+    partitions are left alone; retention is a DETACH/DROP away and is up to the operator.
+    There is no DEFAULT partition, so a row dated outside every month fails its insert.
+    """
+
+    def __init__(self, months_ahead: Optional[int] = None) -> None:
+        self.months_ahead = (
+            months_ahead if months_ahead is not None else settings.MESSAGE_PARTITION_MONTHS_AHEAD
+        )
+        self._task: Optional[asyncio.Task] = None
+
+    async def check_layout(self) -> None:
+        """
+        Run before create_all: with a pre-partitioning `messages` table, create_all would fail on
+        the composite foreign keys with an obscure error, so fail here with the way out instead.
+        """
+        async with engine.connect() as conn:
+            kind = (await conn.execute(
+                text("SELECT relkind FROM pg_class WHERE oid = to_regclass(:table)"),
+                {"table": MESSAGES_TABLE},
+            )).scalar_one_or_none()
+        if kind is not None and kind != "p":
+            raise UnpartitionedMessagesTable(MIGRATION_HINT)
+
+    async def start(self) -> None:
+        if self._task is not None:
+            return
+        await self.ensure()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def ensure(self, today: Optional[date] = None) -> List[str]:
+        """Create missing partitions; returns the names of the ones that exist afterwards."""
+        today = today or datetime.now(timezone.utc).date()
+        ranges = monthly_ranges(today, self.months_ahead)
+        async with engine.begin() as conn:
+            await conn.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": ADVISORY_LOCK_ID})
+            for name, start, end in ranges:
+                # Bounds are dates formatted by us, not user input; DDL cannot take bind parameters
+                await conn.execute(text(
+                    f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {MESSAGES_TABLE} "
+                    f"FOR VALUES FROM ('{start.isoformat()} 00:00+00') TO ('{end.isoformat()} 00:00+00')"
+                ))
+            leftover = await conn.execute(text("SELECT to_regclass(:name) IS NOT NULL"), {"name": DEFAULT_PARTITION})
+            if leftover.scalar():
+                logger.error(
+                    "%s exists: it disables ordered partition scans and can block new months. "
+                    "Move its rows into monthly partitions, then DETACH and DROP it.",
+                    DEFAULT_PARTITION,
+                )
+        return [name for name, _, _ in ranges]
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(CHECK_INTERVAL_SECONDS)
+            try:
+                await self.ensure()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Message partition maintenance failed")
+
+
+# Shared singleton — started from the app lifespan
+message_partitions = MessagePartitionMaintainer()
@@ -1,7 +1,13 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Set
+from sqlalchemy import event
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
-from sqlalchemy.orm import declarative_base
+from sqlalchemy.orm import Session, declarative_base
 from app.core.config import settings
 
+logger = logging.getLogger(__name__)
+
 
 engine = create_async_engine(
     settings.DATABASE_URL,
@@ -21,6 +27,57 @@ AsyncSessionLocal = async_sessionmaker(
 
 Base = declarative_base()
 
+_AFTER_COMMIT = "after_commit_callbacks"
+_AFTER_ROLLBACK = "after_rollback_callbacks"
+# Strong references to running transaction callbacks
+_callback_tasks: Set[asyncio.Task] = set()
+
+
+def on_commit(db: AsyncSession, callback: Callable[[], Awaitable[None]]) -> None:
+    """
+    Run `callback` (a coroutine factory) once the session's current transaction commits; it is
+    dropped on rollback. For cache invalidation that must not run before other sessions can see
+    the change.
+    """
+    db.sync_session.info.setdefault(_AFTER_COMMIT, []).append(callback)
+
+
+def on_rollback(db: AsyncSession, callback: Callable[[], Awaitable[None]]) -> None:
+    """
+    Run `callback` if the session's current transaction rolls back (including a failed commit);
+    dropped on commit. For releasing claims taken outside the database, e.g. in Redis.
+    """
+    db.sync_session.info.setdefault(_AFTER_ROLLBACK, []).append(callback)
+
+
+async def _run_callback(callback: Callable[[], Awaitable[None]]) -> None:
+    try:
+        await callback()
+    except Exception:
+        logger.exception("Transaction callback failed")
+
+
+def _schedule(callbacks) -> None:
+    if not callbacks:
+        return
+    loop = asyncio.get_running_loop()
+    for callback in callbacks:
+        task = loop.create_task(_run_callback(callback))
+        _callback_tasks.add(task)
+        task.add_done_callback(_callback_tasks.discard)
+
+
+@event.listens_for(Session, "after_commit")
+def _after_commit(session: Session) -> None:
+    session.info.pop(_AFTER_ROLLBACK, None)
+    _schedule(session.info.pop(_AFTER_COMMIT, None))
+
+
+@event.listens_for(Session, "after_rollback")
+def _after_rollback(session: Session) -> None:
+    session.info.pop(_AFTER_COMMIT, None)
+    _schedule(session.info.pop(_AFTER_ROLLBACK, None))
+
 
 async def get_db() -> AsyncSession:
     async with AsyncSessionLocal() as session:
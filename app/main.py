@@ -1,4 +1,7 @@
+import asyncio
 import logging
+import signal
+import threading
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
@@ -16,6 +19,11 @@ from app.core.auth_middleware import AuthMiddleware
 from app.api.v1 import api_router
 from app.db.session import engine, Base
 from app.db.redis_client import RedisClient
+from app.db.partitions import message_partitions
+from app.websocket.manager import ws_manager
+from app.services.message_writer import message_writer
+from app.websocket.typing_indicator import typing_engine
+from app.websocket.presence import presence_notifier
 from fastapi.exceptions import RequestValidationError
 from starlette.exceptions import HTTPException as StarletteHTTPException
 
@@ -28,12 +36,49 @@ logging.basicConfig(
 )
 
 
+def _drain_on_sigterm() -> None:
+    """
+    uvicorn closes every WebSocket (1012) before the lifespan shutdown runs, so draining there alone
+    would be too late. Run the drain first when SIGTERM arrives, then hand the signal to the server.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        return
+    previous = signal.getsignal(signal.SIGTERM)
+    if not callable(previous):
+        return
+    loop = asyncio.get_running_loop()
+
+    async def drain_then_exit(signum, frame) -> None:
+        try:
+            await ws_manager.drain()
+        finally:
+            previous(signum, frame)
+
+    def handler(signum, frame) -> None:
+        loop.call_soon_threadsafe(lambda: asyncio.ensure_future(drain_then_exit(signum, frame)))
+
+    signal.signal(signal.SIGTERM, handler)
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await RedisClient.get_client()
+    await message_partitions.check_layout()
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+    await message_partitions.start()
+    await message_writer.start()
+    await ws_manager.start()
+    await typing_engine.start()
+    await presence_notifier.start()
+    _drain_on_sigterm()
     yield
+    await ws_manager.drain()
+    await presence_notifier.stop()
+    await typing_engine.stop()
+    await message_writer.stop()
+    await ws_manager.stop()
+    await message_partitions.stop()
     await RedisClient.close()
 
 
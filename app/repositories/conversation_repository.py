@@ -1,11 +1,15 @@
-from typing import List, Optional
+from typing import Dict, Iterable, List, Optional, Set
 from uuid import UUID
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 from sqlalchemy.orm import selectinload
 from app.repositories.base_repository import BaseRepository
+from app.db.session import on_commit
 from app.db.models import Conversation, User, ConversationType
 
+# Users per get_memberships query: one bind parameter each, far below asyncpg's limit of 32767
+MEMBERSHIP_CHUNK = 1000
+
 
 class ConversationRepository(BaseRepository[Conversation]):
     def __init__(self, db: AsyncSession):
@@ -17,6 +21,42 @@ class ConversationRepository(BaseRepository[Conversation]):
             options=[selectinload(Conversation.participants)],
         )
 
+    async def get_participant_ids(self, conversation_id: UUID) -> List[UUID]:
+        from app.db.models import conversation_participants
+
+        query = select(conversation_participants.c.user_id).where(
+            conversation_participants.c.conversation_id == conversation_id,
+        )
+        result = await self.db.execute(query)
+        return list(result.scalars().all())
+
+    async def is_participant(self, conversation_id: UUID, user_id: UUID) -> bool:
+        """Membership check served from MembershipCacheService; loads participant ids only on a miss."""
+        from app.services.membership_cache import MembershipCacheService
+
+        cached = await MembershipCacheService.is_participant(conversation_id, user_id)
+        if cached is not None:
+            return cached
+        generation = await MembershipCacheService.generation(conversation_id)
+        participant_ids = await self.get_participant_ids(conversation_id)
+        await MembershipCacheService.store_participants(conversation_id, participant_ids, generation)
+        return user_id in participant_ids
+
+    async def get_participant_username(self, conversation_id: UUID, user_id: UUID) -> Optional[str]:
+        """The user's username if they participate in the conversation, else None (one query)."""
+        from app.db.models import conversation_participants
+
+        query = (
+            select(User.username)
+            .join(conversation_participants, conversation_participants.c.user_id == User.id)
+            .where(
+                User.id == user_id,
+                conversation_participants.c.conversation_id == conversation_id,
+            )
+        )
+        result = await self.db.execute(query)
+        return result.scalar_one_or_none()
+
     async def get_user_conversations(self, user_id: UUID) -> List[Conversation]:
         query = (
             select(Conversation)
@@ -26,6 +66,36 @@ class ConversationRepository(BaseRepository[Conversation]):
         result = await self.db.execute(query)
         return list(result.scalars().all())
 
+    async def get_participating_ids(self, user_id: UUID, conversation_ids: Iterable[UUID]) -> Set[UUID]:
+        """Subset of conversation_ids the user participates in, in one query."""
+        from app.db.models import conversation_participants
+
+        ids = list(conversation_ids)
+        if not ids:
+            return set()
+        query = select(conversation_participants.c.conversation_id).where(
+            conversation_participants.c.user_id == user_id,
+            conversation_participants.c.conversation_id.in_(ids),
+        )
+        result = await self.db.execute(query)
+        return set(result.scalars().all())
+
+    async def get_memberships(self, user_ids: Iterable[UUID]) -> Dict[UUID, Set[UUID]]:
+        """user_id -> every conversation that user participates in; one query per MEMBERSHIP_CHUNK users."""
+        from app.db.models import conversation_participants
+
+        users = list(user_ids)
+        memberships: Dict[UUID, Set[UUID]] = {}
+        for start in range(0, len(users), MEMBERSHIP_CHUNK):
+            query = select(
+                conversation_participants.c.user_id,
+                conversation_participants.c.conversation_id,
+            ).where(conversation_participants.c.user_id.in_(users[start:start + MEMBERSHIP_CHUNK]))
+            result = await self.db.execute(query)
+            for user_id, conversation_id in result.all():
+                memberships.setdefault(user_id, set()).add(conversation_id)
+        return memberships
+
     async def get_direct_between(self, user_id_1: UUID, user_id_2: UUID) -> Optional[Conversation]:
         from sqlalchemy import func
         from app.db.models import conversation_participants
@@ -62,8 +132,29 @@ class ConversationRepository(BaseRepository[Conversation]):
             return True
         conv.participants.append(user)
         await self.db.flush()
+        await self._invalidate_membership(conversation_id)
         return True
 
+    async def add_participants(self, conversation_id: UUID, user_ids: Iterable[UUID]) -> List[UUID]:
+        """Add existing users as participants in one INSERT. Returns the ids that were added."""
+        from app.db.models import conversation_participants
+
+        existing = set(await self.get_participant_ids(conversation_id))
+        candidates = [uid for uid in dict.fromkeys(user_ids) if uid not in existing]
+        if not candidates:
+            return []
+        result = await self.db.execute(select(User.id).where(User.id.in_(candidates)))
+        found = set(result.scalars().all())
+        added = [uid for uid in candidates if uid in found]
+        if added:
+            await self.db.execute(
+                conversation_participants.insert(),
+                [{"conversation_id": conversation_id, "user_id": uid} for uid in added],
+            )
+            await self.db.flush()
+            await self._invalidate_membership(conversation_id)
+        return added
+
     async def remove_participant(self, conversation_id: UUID, user_id: UUID) -> bool:
         conv = await self.get_with_participants(conversation_id)
         if not conv:
@@ -74,4 +165,14 @@ class ConversationRepository(BaseRepository[Conversation]):
         if user in conv.participants:
             conv.participants.remove(user)
             await self.db.flush()
+            await self._invalidate_membership(conversation_id)
         return True
+
+    async def _invalidate_membership(self, conversation_id: UUID) -> None:
+        """
+        Invalidate now (this session's own reads) and again once the change commits: a fill that
+        read the old participants in between would otherwise stay cached for MEMBERSHIP_TTL.
+        """
+        from app.services.membership_cache import MembershipCacheService
+        await MembershipCacheService.invalidate(conversation_id)
+        on_commit(self.db, lambda: MembershipCacheService.invalidate(conversation_id))
@@ -1,68 +1,217 @@
-from typing import List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 from uuid import UUID
 from datetime import datetime
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import delete, func, select, tuple_
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import selectinload
 from app.repositories.base_repository import BaseRepository
-from app.db.models import Message, MessageReadStatus
+from app.db.models import Message, MessageClientId, MessageReadStatus, MessageSeq
 
 
 class MessageRepository(BaseRepository[Message]):
     def __init__(self, db: AsyncSession):
         super().__init__(db, Message)
 
-    async def get_by_conversation(
+    async def insert_many(self, rows: List[Dict[str, Any]]) -> List[Message]:
+        """
+        Multi-row INSERT ... RETURNING; rows must carry their own ids and created_at.
+        Rows whose client_message_id was already used by the sender are skipped (not returned):
+        their keys are claimed in message_client_ids first (ON CONFLICT DO NOTHING) and only the
+        winning rows are inserted. Seqs must already be claimed (claim_seqs); the claims of skipped
+        rows are dropped. Senders are not loaded.
+        """
+        if not rows:
+            return []
+        claims = [
+            {
+                "conversation_id": row["conversation_id"],
+                "sender_id": row["sender_id"],
+                "client_message_id": row["client_message_id"],
+                "message_id": row["id"],
+                "message_created_at": row["created_at"],
+            }
+            for row in rows
+            if row.get("client_message_id") is not None
+        ]
+        if claims:
+            claimed = await self.db.scalars(
+                insert(MessageClientId).on_conflict_do_nothing().returning(MessageClientId.message_id),
+                claims,
+            )
+            won = set(claimed.all())
+            await self.release_seqs(
+                [row["id"] for row in rows if row.get("client_message_id") is not None and row["id"] not in won]
+            )
+            rows = [row for row in rows if row.get("client_message_id") is None or row["id"] in won]
+            if not rows:
+                return []
+        result = await self.db.scalars(insert(Message).returning(Message), rows)
+        return list(result.all())
+
+    async def claim_seqs(self, rows: List[Dict[str, Any]]) -> List[UUID]:
+        """
+        Claim each row's (conversation_id, seq) in message_seqs (ON CONFLICT DO NOTHING). Returns the
+        ids of rows whose seq was already taken; the other rows keep their claim.
+        """
+        if not rows:
+            return []
+        claimed = await self.db.scalars(
+            insert(MessageSeq).on_conflict_do_nothing().returning(MessageSeq.message_id),
+            [
+                {
+                    "conversation_id": row["conversation_id"],
+                    "seq": row["seq"],
+                    "message_id": row["id"],
+                    "message_created_at": row["created_at"],
+                }
+                for row in rows
+            ],
+        )
+        won = set(claimed.all())
+        return [row["id"] for row in rows if row["id"] not in won]
+
+    async def release_seqs(self, message_ids: List[UUID]) -> None:
+        """Drop seq claims made in this transaction for messages that will not be inserted."""
+        if message_ids:
+            await self.db.execute(delete(MessageSeq).where(MessageSeq.message_id.in_(message_ids)))
+
+    async def get_by_ids(self, ids: List[UUID]) -> List[Message]:
+        if not ids:
+            return []
+        result = await self.db.execute(select(Message).where(Message.id.in_(ids)))
+        return list(result.scalars().all())
+
+    async def get_by_client_message_ids(self, keys: List[Tuple[UUID, UUID, str]]) -> List[Message]:
+        """Messages already stored under (conversation_id, sender_id, client_message_id) keys."""
+        if not keys:
+            return []
+        # Joined on the full primary key so each lookup touches one partition
+        result = await self.db.execute(
+            select(Message)
+            .join(
+                MessageClientId,
+                (MessageClientId.message_id == Message.id)
+                & (MessageClientId.message_created_at == Message.created_at),
+            )
+            .where(
+                tuple_(
+                    MessageClientId.conversation_id,
+                    MessageClientId.sender_id,
+                    MessageClientId.client_message_id,
+                ).in_(keys)
+            )
+        )
+        return list(result.scalars().all())
+
+    async def get_max_seqs(self, conversation_ids: List[UUID]) -> Dict[UUID, int]:
+        """
+        Highest claimed seq per conversation (conversations without messages are absent); read from
+        message_seqs, whose primary key answers it with one index probe instead of one per partition.
+        """
+        if not conversation_ids:
+            return {}
+        result = await self.db.execute(
+            select(MessageSeq.conversation_id, func.max(MessageSeq.seq))
+            .where(MessageSeq.conversation_id.in_(conversation_ids))
+            .group_by(MessageSeq.conversation_id)
+        )
+        return {conversation_id: seq for conversation_id, seq in result.all() if seq is not None}
+
+    async def get_after_seq(self, conversation_id: UUID, after_seq: int, limit: int = 100) -> List[Message]:
+        """
+        Up to `limit` messages with seq > after_seq, in seq order. seq carries no partition bound,
+        so this probes idx_messages_conversation_seq in every partition (each probe is cheap).
+        """
+        query = (
+            select(Message)
+            .where(Message.conversation_id == conversation_id, Message.seq > after_seq)
+            .order_by(Message.seq.asc())
+            .options(selectinload(Message.sender))
+            .limit(limit)
+        )
+        result = await self.db.execute(query)
+        return list(result.scalars().all())
+
+    async def get_page_before(
         self,
         conversation_id: UUID,
-        skip: int = 0,
+        before: Optional[Tuple[datetime, UUID]] = None,
         limit: int = 100,
     ) -> List[Message]:
+        """
+        Up to `limit` messages before `before` (or the newest ones), newest first.
+        A backward scan of idx_messages_conversation_created; the plain created_at bound lets the
+        planner skip partitions newer than the cursor (it cannot prune on the row comparison).
+        """
         query = (
             select(Message)
             .where(Message.conversation_id == conversation_id)
-            .order_by(Message.created_at.asc())
+            .order_by(Message.created_at.desc(), Message.id.desc())
             .options(selectinload(Message.sender))
+            .limit(limit)
         )
-        query = query.offset(skip).limit(limit)
+        if before is not None:
+            query = query.where(
+                Message.created_at <= before[0],
+                tuple_(Message.created_at, Message.id) < tuple_(*before),
+            )
         result = await self.db.execute(query)
         return list(result.scalars().all())
 
-    async def get_by_conversation_after(
+    async def get_unread_chunk(
         self,
         conversation_id: UUID,
-        after_timestamp: datetime,
+        user_id: UUID,
+        after: Optional[Tuple[datetime, UUID]] = None,
         limit: int = 100,
     ) -> List[Message]:
+        """One keyset page of unread messages ordered by (created_at, id), starting after `after`."""
         query = (
             select(Message)
             .where(
                 Message.conversation_id == conversation_id,
-                Message.created_at > after_timestamp,
+                Message.sender_id != user_id,
+                Message.read_status != MessageReadStatus.read,
             )
-            .order_by(Message.created_at.asc())
+            .order_by(Message.created_at.asc(), Message.id.asc())
             .options(selectinload(Message.sender))
             .limit(limit)
         )
+        if after is not None:
+            query = query.where(
+                Message.created_at >= after[0],
+                tuple_(Message.created_at, Message.id) > tuple_(*after),
+            )
         result = await self.db.execute(query)
         return list(result.scalars().all())
 
-    async def get_unread_for_user(self, conversation_id: UUID, user_id: UUID) -> List[Message]:
+    async def get_conversation_chunk(
+        self,
+        conversation_id: UUID,
+        after: Tuple[datetime, UUID],
+        limit: int = 100,
+        inclusive: bool = False,
+    ) -> List[Message]:
+        """Every message of the conversation after `after` (or from it, if inclusive), ordered by (created_at, id)."""
+        position = tuple_(Message.created_at, Message.id)
         query = (
             select(Message)
             .where(
                 Message.conversation_id == conversation_id,
-                Message.sender_id != user_id,
-                Message.read_status != MessageReadStatus.read,
+                # Redundant with the row comparison, but prunable
+                Message.created_at >= after[0],
+                position >= tuple_(*after) if inclusive else position > tuple_(*after),
             )
-            .order_by(Message.created_at.asc())
+            .order_by(Message.created_at.asc(), Message.id.asc())
             .options(selectinload(Message.sender))
+            .limit(limit)
         )
         result = await self.db.execute(query)
         return list(result.scalars().all())
 
     async def mark_conversation_read_for_user(
-        self, conversation_id: UUID, user_id: UUID
+        self, conversation_id: UUID, user_id: UUID, up_to: Optional[datetime] = None
     ) -> int:
         from sqlalchemy import update
         query = (
@@ -70,9 +219,12 @@ class MessageRepository(BaseRepository[Message]):
             .where(
                 Message.conversation_id == conversation_id,
                 Message.sender_id != user_id,
+                Message.read_status != MessageReadStatus.read,
             )
             .values(read_status=MessageReadStatus.read)
         )
+        if up_to is not None:
+            query = query.where(Message.created_at <= up_to)
         result = await self.db.execute(query)
         await self.db.flush()
         return result.rowcount or 0
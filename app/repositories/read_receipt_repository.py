@@ -11,13 +11,14 @@ class ReadReceiptRepository(BaseRepository[MessageReadReceipt]):
     def __init__(self, db: AsyncSession):
         super().__init__(db, MessageReadReceipt)
 
-    async def create_receipt(self, message_id: UUID, user_id: UUID) -> MessageReadReceipt:
-        existing = await self.get_by_message_and_user(message_id, user_id)
+    async def create_receipt(self, message: Message, user_id: UUID) -> MessageReadReceipt:
+        existing = await self.get_by_message_and_user(message.id, user_id)
         if existing:
             return existing
         
         receipt = await self.create({
-            "message_id": message_id,
+            "message_id": message.id,
+            "message_created_at": message.created_at,
             "user_id": user_id,
         })
         return receipt
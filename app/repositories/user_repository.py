@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import Iterable, List, Optional
 from uuid import UUID
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
@@ -23,6 +23,13 @@ class UserRepository(BaseRepository[User]):
     async def get_by_id(self, id: UUID) -> Optional[User]:
         return await super().get_by_id(id)
     
+    async def get_by_ids(self, ids: Iterable[UUID]) -> List[User]:
+        ids = list(ids)
+        if not ids:
+            return []
+        result = await self.db.execute(select(User).where(User.id.in_(ids)))
+        return list(result.scalars().all())
+    
     async def email_exists(self, email: str) -> bool:
         user = await self.get_by_email(email)
         return user is not None
@@ -33,12 +33,16 @@ class MessageBase(BaseModel):
 
 class MessageCreate(MessageBase):
     conversation_id: UUID
+    # Retries with the same id return the original message instead of sending again
+    client_message_id: Optional[str] = Field(None, min_length=1, max_length=64)
 
 
 class MessageResponse(MessageBase):
     id: UUID
     sender_id: UUID
     conversation_id: UUID
+    seq: Optional[int] = None
+    client_message_id: Optional[str] = None
     created_at: datetime
     read_status: MessageReadStatus
     sender: Optional[UserResponse] = None
@@ -46,6 +50,25 @@ class MessageResponse(MessageBase):
     model_config = ConfigDict(from_attributes=True)
 
 
+class BulkMessageCreate(BaseModel):
+    messages: List[MessageCreate] = Field(..., min_length=1)
+
+
+class BulkMessageResult(BaseModel):
+    id: UUID
+    conversation_id: UUID
+    seq: Optional[int] = None
+    client_message_id: Optional[str] = None
+    # False when client_message_id matched an earlier send (nothing new was written)
+    created: bool
+
+
+class BulkMessageResponse(BaseModel):
+    results: List[BulkMessageResult]
+    created: int
+    duplicates: int
+
+
 class MessagePayload(BaseModel):
     type: str = "message"
     id: UUID
@@ -81,5 +104,15 @@ class TypingIndicatorResponse(BaseModel):
 
 class PaginatedMessagesResponse(BaseModel):
     messages: List[MessageResponse]
-    next_cursor: Optional[UUID] = None
+    # Pass as `after` for newer messages / as `before` for older ones; null at either end
+    next_cursor: Optional[str] = None
+    prev_cursor: Optional[str] = None
+    has_newer: bool = False
+    has_older: bool = False
+    # More messages in the direction that was requested
     has_more: bool = False
+
+
+class OnlineUsersPage(BaseModel):
+    user_ids: List[str]
+    next_cursor: Optional[int] = None
@@ -44,10 +44,7 @@ class ConversationService:
             "type": ConversationType.group,
             "name": name or None,
         })
-        for pid in participant_ids:
-            user = await self.user_repo.get_by_id(pid)
-            if user:
-                await self.conv_repo.add_participant(conv.id, pid)
+        await self.conv_repo.add_participants(conv.id, participant_ids)
         conv = await self.conv_repo.get_with_participants(conv.id)
         return ConversationResponse.model_validate(conv)
 
@@ -66,6 +63,26 @@ class ConversationService:
             )
         return ConversationResponse.model_validate(conv)
 
+    async def get_online_participants(self, conversation_id: UUID, user_id: UUID) -> List[str]:
+        from app.services.membership_cache import MembershipCacheService
+        from app.websocket.redis_store import RedisConnectionStore
+
+        if not await self.conv_repo.is_participant(conversation_id, user_id):
+            if not await self.conv_repo.get_by_id(conversation_id):
+                raise HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND,
+                    detail="Conversation not found",
+                )
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="Not a participant",
+            )
+        # The membership check above leaves the participant set cached in Redis
+        participant_ids = await MembershipCacheService.get_participants(conversation_id)
+        if participant_ids is None:
+            participant_ids = await self.conv_repo.get_participant_ids(conversation_id)
+        return await RedisConnectionStore.get_online_among(participant_ids)
+
     async def list_user_conversations(self, user_id: UUID) -> List[ConversationResponse]:
         convs = await self.conv_repo.get_user_conversations(user_id)
         return [ConversationResponse.model_validate(c) for c in convs]
@@ -0,0 +1,124 @@
+import time
+from collections import OrderedDict
+from typing import Iterable, Optional, Set, Tuple
+from uuid import UUID
+from app.db.redis_client import get_redis
+
+MEMBERSHIP_KEY = "membership:conversation:{conversation_id}"
+# Bumped by every invalidation; a fill only lands if it is unchanged since the fill's read began
+GENERATION_KEY = "membership:conversation:{conversation_id}:gen"
+MEMBERSHIP_TTL = 120
+# Must outlive any in-flight fill, so a fill that started before an invalidation is always refused
+GENERATION_TTL = 86400
+LOCAL_TTL = 5
+LOCAL_MAX_CONVERSATIONS = 10000
+
+# KEYS[1] member set, KEYS[2] generation; ARGV[1] generation the caller read before loading
+# participants, ARGV[2] ttl, ARGV[3..] members. Returns 1 if stored, 0 if an invalidation won.
+STORE_SCRIPT = """
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[1] then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+redis.call('SADD', KEYS[1], unpack(ARGV, 3))
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+
+class MembershipCacheService:
+    """
+    Conversation membership cache: a short-lived in-process LRU of confirmed members in front of
+    a Redis set of participant ids per conversation. Only positive answers are kept locally, so a
+    removal is visible on other nodes after at most LOCAL_TTL seconds.
+
+    A fill races with membership changes: a reader can load the old participants just before a
+    removal commits and write them back just after it was invalidated. Fills are therefore
+    conditional on a per-conversation generation read before the database query, and writers
+    invalidate (bumping it) both before and after their commit.
+    """
+
+    _local: "OrderedDict[UUID, Tuple[float, Set[UUID]]]" = OrderedDict()
+
+    @classmethod
+    def _local_hit(cls, conversation_id: UUID, user_id: UUID) -> bool:
+        entry = cls._local.get(conversation_id)
+        if entry is None:
+            return False
+        expires_at, members = entry
+        if expires_at < time.monotonic():
+            del cls._local[conversation_id]
+            return False
+        cls._local.move_to_end(conversation_id)
+        return user_id in members
+
+    @classmethod
+    def _remember(cls, conversation_id: UUID, user_id: UUID) -> None:
+        entry = cls._local.get(conversation_id)
+        if entry is None or entry[0] < time.monotonic():
+            entry = (time.monotonic() + LOCAL_TTL, set())
+            cls._local[conversation_id] = entry
+        entry[1].add(user_id)
+        cls._local.move_to_end(conversation_id)
+        while len(cls._local) > LOCAL_MAX_CONVERSATIONS:
+            cls._local.popitem(last=False)
+
+    @classmethod
+    async def is_participant(cls, conversation_id: UUID, user_id: UUID) -> Optional[bool]:
+        """True/False when the answer is cached, None when the caller must load from the database."""
+        if cls._local_hit(conversation_id, user_id):
+            return True
+        redis = await get_redis()
+        key = MEMBERSHIP_KEY.format(conversation_id=str(conversation_id))
+        pipe = redis.pipeline()
+        pipe.exists(key)
+        pipe.sismember(key, str(user_id))
+        exists, is_member = await pipe.execute()
+        if not exists:
+            return None
+        if is_member:
+            cls._remember(conversation_id, user_id)
+        return bool(is_member)
+
+    @classmethod
+    async def generation(cls, conversation_id: UUID) -> str:
+        """Read before loading participants from the database; pass it to store_participants."""
+        redis = await get_redis()
+        value = await redis.get(GENERATION_KEY.format(conversation_id=str(conversation_id)))
+        return str(value or "0")
+
+    @classmethod
+    async def store_participants(cls, conversation_id: UUID, user_ids: Iterable[UUID], generation: str) -> bool:
+        """Cache the participant set unless the conversation was invalidated since `generation`."""
+        members = [str(uid) for uid in user_ids]
+        if not members:
+            return False
+        redis = await get_redis()
+        script = redis.register_script(STORE_SCRIPT)
+        stored = await script(
+            keys=[
+                MEMBERSHIP_KEY.format(conversation_id=str(conversation_id)),
+                GENERATION_KEY.format(conversation_id=str(conversation_id)),
+            ],
+            args=[generation, MEMBERSHIP_TTL, *members],
+        )
+        return bool(stored)
+
+    @classmethod
+    async def get_participants(cls, conversation_id: UUID) -> Optional[Set[UUID]]:
+        redis = await get_redis()
+        members = await redis.smembers(MEMBERSHIP_KEY.format(conversation_id=str(conversation_id)))
+        if not members:
+            return None
+        return {UUID(m) for m in members}
+
+    @classmethod
+    async def invalidate(cls, conversation_id: UUID) -> None:
+        cls._local.pop(conversation_id, None)
+        redis = await get_redis()
+        generation_key = GENERATION_KEY.format(conversation_id=str(conversation_id))
+        pipe = redis.pipeline()
+        pipe.incr(generation_key)
+        pipe.expire(generation_key, GENERATION_TTL)
+        pipe.delete(MEMBERSHIP_KEY.format(conversation_id=str(conversation_id)))
+        await pipe.execute()
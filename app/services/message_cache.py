@@ -1,24 +1,48 @@
-from typing import List, Optional
+from typing import Dict, List, Optional
 from uuid import UUID
 from app.db.redis_client import get_redis
 import json
 from datetime import datetime
 
 MESSAGE_CACHE_KEY = "messages:conversation:{conversation_id}"
-CACHE_SIZE = 50
+# Largest page (GET /conversations/{id}/messages caps limit at 100) plus one, so the newest page
+# of any size can be served from the list and still tell whether older messages exist
+CACHE_SIZE = 101
 CACHE_TTL = 3600
 
 
 class MessageCacheService:
+    @staticmethod
+    def cache_entry(msg) -> dict:
+        """Cache representation of a MessageResponse."""
+        data = {
+            "id": str(msg.id),
+            "sender_id": str(msg.sender_id),
+            "conversation_id": str(msg.conversation_id),
+            "seq": msg.seq,
+            "content": msg.content,
+            "created_at": msg.created_at.isoformat(),
+            "read_status": msg.read_status.value,
+        }
+        if msg.sender:
+            data["sender"] = {
+                "id": str(msg.sender.id),
+                "username": msg.sender.username,
+                "email": msg.sender.email,
+            }
+        return data
+
     @staticmethod
     async def cache_message(conversation_id: UUID, message_data: dict) -> None:
         redis = await get_redis()
         key = MESSAGE_CACHE_KEY.format(conversation_id=str(conversation_id))
         
         message_json = json.dumps(message_data, default=str)
-        await redis.lpush(key, message_json)
-        await redis.ltrim(key, 0, CACHE_SIZE - 1)
-        await redis.expire(key, CACHE_TTL)
+        pipe = redis.pipeline()
+        pipe.lpush(key, message_json)
+        pipe.ltrim(key, 0, CACHE_SIZE - 1)
+        pipe.expire(key, CACHE_TTL)
+        await pipe.execute()
 
     @staticmethod
     async def get_cached_messages(
@@ -60,3 +84,18 @@ class MessageCacheService:
         pipe.ltrim(key, 0, CACHE_SIZE - 1)
         pipe.expire(key, CACHE_TTL)
         await pipe.execute()
+
+    @staticmethod
+    async def cache_messages_by_conversation(messages: Dict[UUID, List[dict]]) -> None:
+        """Push messages (oldest first) for several conversations in a single pipeline."""
+        if not messages:
+            return
+        redis = await get_redis()
+        pipe = redis.pipeline()
+        for conversation_id, batch in messages.items():
+            key = MESSAGE_CACHE_KEY.format(conversation_id=str(conversation_id))
+            for msg in batch[-CACHE_SIZE:]:
+                pipe.lpush(key, json.dumps(msg, default=str))
+            pipe.ltrim(key, 0, CACHE_SIZE - 1)
+            pipe.expire(key, CACHE_TTL)
+        await pipe.execute()
@@ -0,0 +1,74 @@
+from typing import Dict, Iterable, Optional, Tuple
+from uuid import UUID
+from app.core.config import settings
+from app.db.redis_client import get_redis
+
+DEDUPE_KEY = "messages:dedupe:{conversation_id}:{sender_id}:{client_message_id}"
+# Claimed by a send that has not committed yet
+PENDING = "pending"
+
+# (conversation_id, sender_id, client_message_id)
+ClientKey = Tuple[UUID, UUID, str]
+
+
+def _key(client_key: ClientKey) -> str:
+    conversation_id, sender_id, client_message_id = client_key
+    return DEDUPE_KEY.format(
+        conversation_id=str(conversation_id),
+        sender_id=str(sender_id),
+        client_message_id=client_message_id,
+    )
+
+
+class MessageDedupeService:
+    """
+    Fast path for idempotent sends keyed by the client's message id. The first send claims the
+    key with SET NX; once committed the key holds the message id for MESSAGE_DEDUPE_WINDOW_SECONDS,
+    so a retry is answered without touching the messages table. The message_client_ids primary
+    key on (conversation_id, sender_id, client_message_id) stays the source of truth: a retry that
+    finds the key still pending (or expired) goes to an INSERT ... ON CONFLICT DO NOTHING instead.
+    """
+
+    @staticmethod
+    async def claim(client_keys: Iterable[ClientKey]) -> Dict[ClientKey, Optional[UUID]]:
+        """
+        Claim each key in one pipeline. Maps every key to the id of the message already sent
+        under it, or None when the caller should insert (new claim, or original still pending).
+        """
+        client_keys = list(dict.fromkeys(client_keys))
+        if not client_keys:
+            return {}
+        redis = await get_redis()
+        pipe = redis.pipeline()
+        for client_key in client_keys:
+            key = _key(client_key)
+            pipe.set(key, PENDING, nx=True, ex=settings.MESSAGE_DEDUPE_WINDOW_SECONDS)
+            pipe.get(key)
+        results = await pipe.execute()
+        known: Dict[ClientKey, Optional[UUID]] = {}
+        for i, client_key in enumerate(client_keys):
+            claimed, value = results[2 * i], results[2 * i + 1]
+            if isinstance(value, bytes):
+                value = value.decode()
+            known[client_key] = None if claimed or value in (None, PENDING) else UUID(value)
+        return known
+
+    @staticmethod
+    async def remember(sent: Dict[ClientKey, UUID]) -> None:
+        """Record committed message ids so retries short-circuit."""
+        if not sent:
+            return
+        redis = await get_redis()
+        pipe = redis.pipeline()
+        for client_key, message_id in sent.items():
+            pipe.set(_key(client_key), str(message_id), ex=settings.MESSAGE_DEDUPE_WINDOW_SECONDS)
+        await pipe.execute()
+
+    @staticmethod
+    async def release(client_keys: Iterable[ClientKey]) -> None:
+        """Drop pending claims after a failed write so a retry is not held up by them."""
+        keys = [_key(client_key) for client_key in client_keys]
+        if not keys:
+            return
+        redis = await get_redis()
+        await redis.delete(*keys)
@@ -0,0 +1,126 @@
+import logging
+from collections import Counter
+from typing import Any, Dict, Iterable, List
+from uuid import UUID
+from app.db.redis_client import get_redis
+from app.repositories.message_repository import MessageRepository
+
+logger = logging.getLogger(__name__)
+
+SEQUENCE_KEY = "messages:conversation:{conversation_id}:seq"
+# Idle counters expire; the next allocation reseeds from the database, which is safe once nothing is in flight
+SEQUENCE_TTL = 7 * 86400
+
+# KEYS[1] counter; ARGV[1] how many to allocate, ARGV[2] seed (highest seq in the database, or -1 when
+# not read yet), ARGV[3] ttl. Returns the last allocated seq, or nil if the counter needs a seed.
+ALLOCATE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    if tonumber(ARGV[2]) < 0 then
+        return false
+    end
+    redis.call('SET', KEYS[1], ARGV[2], 'NX')
+end
+local last = redis.call('INCRBY', KEYS[1], ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return last
+"""
+
+# KEYS[1] counter; ARGV[1] highest seq claimed in the database, ARGV[2] ttl. Moves a counter that fell
+# behind the database (Redis failover, reseed racing an in-flight insert) past it; never moves it back.
+REPAIR_SCRIPT = """
+local current = tonumber(redis.call('GET', KEYS[1]) or '-1')
+if current < tonumber(ARGV[1]) then
+    redis.call('SET', KEYS[1], ARGV[1])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+# Collide, repair, allocate again: a second collision means another writer is repairing the same counter
+CLAIM_ATTEMPTS = 3
+
+
+class MessageSequenceService:
+    """
+    Per-conversation message sequence numbers. Ranges come from a Redis counter per conversation
+    (INCRBY, one pipelined round trip for a whole batch), so busy groups never queue on a database
+    row lock; a counter that does not exist yet is seeded from MAX(seq) in the database first.
+    The counter can still fall behind the database (a Redis failover losing recent INCRBYs, or a
+    reseed that ran while a batch was in flight), so every seq is also claimed in message_seqs,
+    whose primary key is (conversation_id, seq); a collision repairs the counter and allocates
+    again. Seqs increase strictly but may have gaps (an allocated range whose insert failed), and
+    rows can commit slightly out of seq order when several nodes write to one conversation at once.
+    """
+
+    @staticmethod
+    async def _allocate(counts: Dict[UUID, int], seeds: Dict[UUID, int]) -> Dict[UUID, Any]:
+        redis = await get_redis()
+        script = redis.register_script(ALLOCATE_SCRIPT)
+        pipe = redis.pipeline()
+        for conversation_id, count in counts.items():
+            key = SEQUENCE_KEY.format(conversation_id=str(conversation_id))
+            await script(keys=[key], args=[count, seeds.get(conversation_id, -1), SEQUENCE_TTL], client=pipe)
+        results = await pipe.execute()
+        return dict(zip(counts, results))
+
+    @staticmethod
+    async def allocate(counts: Dict[UUID, int], msg_repo: MessageRepository) -> Dict[UUID, int]:
+        """First seq of a fresh contiguous range of `counts[conversation_id]` seqs per conversation."""
+        if not counts:
+            return {}
+        last = await MessageSequenceService._allocate(counts, {})
+        unseeded = [conversation_id for conversation_id, value in last.items() if value is None]
+        if unseeded:
+            seeds = await msg_repo.get_max_seqs(unseeded)
+            last.update(await MessageSequenceService._allocate(
+                {conversation_id: counts[conversation_id] for conversation_id in unseeded},
+                {conversation_id: seeds.get(conversation_id, 0) for conversation_id in unseeded},
+            ))
+        return {conversation_id: int(value) - counts[conversation_id] + 1 for conversation_id, value in last.items()}
+
+    @staticmethod
+    async def assign(rows: Iterable[Dict[str, Any]], msg_repo: MessageRepository) -> None:
+        """Set `seq` on rows that have none, in row order within each conversation."""
+        pending: List[Dict[str, Any]] = [row for row in rows if row.get("seq") is None]
+        counts = Counter(row["conversation_id"] for row in pending)
+        next_seq = await MessageSequenceService.allocate(dict(counts), msg_repo)
+        for row in pending:
+            conversation_id = row["conversation_id"]
+            row["seq"] = next_seq[conversation_id]
+            next_seq[conversation_id] += 1
+
+    @staticmethod
+    async def repair(conversation_ids: List[UUID], msg_repo: MessageRepository) -> None:
+        """Move the counters of `conversation_ids` past the highest seq claimed in the database."""
+        seeds = await msg_repo.get_max_seqs(conversation_ids)
+        redis = await get_redis()
+        script = redis.register_script(REPAIR_SCRIPT)
+        pipe = redis.pipeline()
+        for conversation_id in conversation_ids:
+            key = SEQUENCE_KEY.format(conversation_id=str(conversation_id))
+            await script(keys=[key], args=[seeds.get(conversation_id, 0), SEQUENCE_TTL], client=pipe)
+        await pipe.execute()
+
+    @staticmethod
+    async def claim(rows: List[Dict[str, Any]], msg_repo: MessageRepository) -> None:
+        """
+        assign, then claim every row's seq in message_seqs in the caller's transaction. In a
+        conversation where any seq was taken, all of this batch's rows give their claims back and
+        get a fresh range after the counter is repaired, so row order and seq order still agree.
+        """
+        await MessageSequenceService.assign(rows, msg_repo)
+        pending = rows
+        for attempt in range(CLAIM_ATTEMPTS):
+            taken = set(await msg_repo.claim_seqs(pending))
+            if not taken:
+                return
+            collided = {row["conversation_id"] for row in pending if row["id"] in taken}
+            if attempt + 1 == CLAIM_ATTEMPTS:
+                break
+            logger.warning("seq collision in %d conversation(s), repairing their counters", len(collided))
+            pending = [row for row in rows if row["conversation_id"] in collided]
+            await msg_repo.release_seqs([row["id"] for row in pending if row["id"] not in taken])
+            for row in pending:
+                row["seq"] = None
+            await MessageSequenceService.repair(list(collided), msg_repo)
+            await MessageSequenceService.assign(pending, msg_repo)
+        raise RuntimeError(f"Could not claim seqs in conversations {sorted(map(str, collided))}")
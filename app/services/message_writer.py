@@ -0,0 +1,309 @@
+import asyncio
+import logging
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from uuid import UUID, uuid4
+from app.core.config import settings
+from app.db.models import MessageReadStatus
+from app.db.session import AsyncSessionLocal
+from app.repositories.message_repository import MessageRepository
+from app.repositories.user_repository import UserRepository
+from app.schemas.messaging import MessageResponse
+from app.schemas.user import UserResponse
+from app.services.message_cache import MessageCacheService
+from app.services.message_dedupe import ClientKey, MessageDedupeService
+from app.services.message_sequence import MessageSequenceService
+
+logger = logging.getLogger(__name__)
+
+PendingMessage = Tuple[Dict[str, Any], asyncio.Future]
+# (message, created): created is False for a retry answered with the original message
+WriteResult = Tuple[MessageResponse, bool]
+# Attempts at reading back a committed batch before giving up on its acknowledgements
+COMMITTED_READ_ATTEMPTS = 2
+
+
+class CommittedWriteError(RuntimeError):
+    """
+    The rows are committed but could not all be read back; writing them again would duplicate
+    them. `results` holds what is known by row id: every inserted row (without its sender) and
+    every original that was already loaded.
+    """
+
+    def __init__(self, message: str, results: Dict[UUID, WriteResult]) -> None:
+        super().__init__(message)
+        self.results = results
+
+
+class MessageWriter:
+    """
+    Group-commit writer for messages sent over WebSockets on this node.
+    Concurrent sends are collected into one multi-row INSERT ... RETURNING per transaction;
+    each sender is acknowledged once its row is committed. Membership must be checked by the caller.
+    """
+
+    def __init__(
+        self,
+        max_batch: Optional[int] = None,
+        flush_interval_ms: Optional[int] = None,
+    ) -> None:
+        self.max_batch = max_batch or settings.MESSAGE_WRITER_MAX_BATCH
+        self.flush_interval = (
+            flush_interval_ms if flush_interval_ms is not None else settings.MESSAGE_WRITER_FLUSH_MS
+        ) / 1000
+        self._queue: "asyncio.Queue[PendingMessage]" = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+        self.batches = 0
+        self.messages = 0
+        self.max_batch_seen = 0
+        self.commit_seconds_total = 0.0
+        self.last_commit_seconds = 0.0
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Flush everything queued so far, then stop the writer task."""
+        if self._task is None:
+            return
+        self._queue.put_nowait(None)
+        await self._task
+        self._task = None
+
+    def enqueue(
+        self,
+        sender_id: UUID,
+        conversation_id: UUID,
+        content: str,
+        client_message_id: Optional[str] = None,
+    ) -> "asyncio.Future[WriteResult]":
+        """
+        Queue a message without waiting; futures of one caller resolve in enqueue order, to
+        (message, created). created is False when client_message_id was already used by this
+        sender in the conversation: the message is the original and nothing new was written.
+        """
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        row = self.build_row(sender_id, conversation_id, content, client_message_id)
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((row, future))
+        return future
+
+    @staticmethod
+    def build_row(
+        sender_id: UUID,
+        conversation_id: UUID,
+        content: str,
+        client_message_id: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        return {
+            "id": uuid4(),
+            "sender_id": sender_id,
+            "conversation_id": conversation_id,
+            "client_message_id": client_message_id,
+            "content": content,
+            "read_status": MessageReadStatus.sent,
+            # Stamped on arrival so rows of one batch keep their send order
+            "created_at": datetime.now(timezone.utc),
+        }
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "batches": self.batches,
+            "messages": self.messages,
+            "avg_batch_size": self.messages / self.batches if self.batches else 0.0,
+            "max_batch_size": self.max_batch_seen,
+            "avg_commit_ms": self.commit_seconds_total / self.batches * 1000 if self.batches else 0.0,
+            "last_commit_ms": self.last_commit_seconds * 1000,
+            "queue_depth": self._queue.qsize(),
+        }
+
+    async def _run(self) -> None:
+        while True:
+            first = await self._queue.get()
+            if first is None:
+                return
+            if self.flush_interval > 0:
+                await asyncio.sleep(self.flush_interval)
+            batch = [first]
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+                if item is None:
+                    # Stop requested: requeue the marker so this batch is still flushed first
+                    self._queue.put_nowait(None)
+                    break
+                batch.append(item)
+            try:
+                await self._flush(batch)
+            except Exception:
+                logger.exception("Message writer flush failed")
+
+    async def _flush(self, batch: List[PendingMessage]) -> None:
+        start = time.perf_counter()
+        try:
+            results = await self.write([row for row, _ in batch])
+        except CommittedWriteError as exc:
+            # Stored already, so never retried: what was read back is delivered, the rest fails
+            for row, future in batch:
+                if future.done():
+                    continue
+                if row["id"] in exc.results:
+                    future.set_result(exc.results[row["id"]])
+                else:
+                    future.set_exception(exc)
+            await self._cache(exc.results.values())
+            return
+        except Exception as exc:
+            if len(batch) == 1:
+                self._resolve(batch, exc)
+                return
+            # One bad row (e.g. a deleted conversation) must not fail everyone else's send
+            for item in batch:
+                await self._flush([item])
+            return
+        elapsed = time.perf_counter() - start
+        self.batches += 1
+        self.messages += len(batch)
+        self.max_batch_seen = max(self.max_batch_seen, len(batch))
+        self.commit_seconds_total += elapsed
+        self.last_commit_seconds = elapsed
+        logger.debug("Committed %d messages in %.2f ms", len(batch), elapsed * 1000)
+
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+        await self._cache(results)
+
+    async def _cache(self, results: Iterable[WriteResult]) -> None:
+        by_conversation: Dict[UUID, List[dict]] = defaultdict(list)
+        for response, created in results:
+            if created:
+                by_conversation[response.conversation_id].append(MessageCacheService.cache_entry(response))
+        try:
+            await MessageCacheService.cache_messages_by_conversation(by_conversation)
+        except Exception:
+            logger.exception("Failed to cache written messages")
+
+    def _resolve(self, batch: List[PendingMessage], exc: Exception) -> None:
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(exc)
+
+    async def write(self, rows: List[Dict[str, Any]], chunk_size: Optional[int] = None) -> List[WriteResult]:
+        """
+        Write rows from build_row in one transaction, bypassing the queue (the group-commit loop
+        and bulk ingest both use it): seqs for the whole batch in one Redis round trip and one
+        message_seqs claim, known retries skipped, then multi-row INSERTs of at most `chunk_size`
+        rows. Nothing is cached or broadcast here. Returns (message, created) per row, in row order.
+        """
+        chunk_size = chunk_size or len(rows) or 1
+        client_keys: Dict[UUID, ClientKey] = {
+            row["id"]: (row["conversation_id"], row["sender_id"], row["client_message_id"])
+            for row in rows
+            if row.get("client_message_id")
+        }
+        try:
+            known = await MessageDedupeService.claim(client_keys.values())
+        except Exception:
+            # Redis is only the fast path: the message_client_ids claim still catches every retry
+            logger.exception("Dedupe claim failed")
+            known = {}
+
+        try:
+            async with AsyncSessionLocal() as db:
+                msg_repo = MessageRepository(db)
+                originals: Dict[ClientKey, Any] = {
+                    (m.conversation_id, m.sender_id, m.client_message_id): m
+                    for m in await msg_repo.get_by_ids([i for i in known.values() if i is not None])
+                }
+                # Retries whose original is already known skip the INSERT (and its seq) entirely
+                fresh = [row for row in rows if client_keys.get(row["id"]) not in originals]
+                # Rows retried one by one after a failed batch keep the seq they already got
+                await MessageSequenceService.claim(fresh, msg_repo)
+                inserted = []
+                for start in range(0, len(fresh), chunk_size):
+                    inserted += await msg_repo.insert_many(fresh[start:start + chunk_size])
+                await db.commit()
+        except Exception:
+            await self._release([client_keys[row["id"]] for row in rows if row["id"] in client_keys])
+            raise
+
+        # Committed: from here on a failure must not send the rows back through the INSERT path
+        by_id = {m.id: m for m in inserted}
+        remember: Dict[ClientKey, UUID] = {
+            client_keys[m.id]: m.id for m in inserted if m.id in client_keys
+        }
+        # Lost the message_client_ids claim: the original committed while this key looked pending
+        lost = [client_keys[row["id"]] for row in fresh if row["id"] not in by_id and row["id"] in client_keys]
+        users: Dict[UUID, UserResponse] = {}
+        failure: Optional[Exception] = None
+        try:
+            found, senders = await self._read_committed(
+                lost, {m.sender_id for m in inserted} | {m.sender_id for m in originals.values()}
+            )
+            for m in found:
+                originals[(m.conversation_id, m.sender_id, m.client_message_id)] = m
+            users = {u.id: UserResponse.model_validate(u) for u in senders}
+        except Exception as exc:
+            failure = exc
+
+        results: Dict[UUID, WriteResult] = {}
+        for row in rows:
+            m = by_id.get(row["id"])
+            created = m is not None
+            if not created:
+                m = originals.get(client_keys.get(row["id"]))
+                if m is None:
+                    continue
+            results[row["id"]] = (MessageResponse(
+                id=m.id,
+                sender_id=m.sender_id,
+                conversation_id=m.conversation_id,
+                seq=m.seq,
+                client_message_id=m.client_message_id,
+                content=m.content,
+                created_at=m.created_at,
+                read_status=m.read_status,
+                sender=users.get(m.sender_id),
+            ), created)
+        await self._remember(remember)
+        if failure is not None:
+            raise CommittedWriteError("Committed messages could not be read back", results) from failure
+        if len(results) < len(rows):
+            raise CommittedWriteError("Committed messages were neither inserted nor found", results)
+        return [results[row["id"]] for row in rows]
+
+    async def _read_committed(self, lost: List[ClientKey], sender_ids: set) -> Tuple[List[Any], List[Any]]:
+        """Originals of rows that lost their claim, and the senders to attach; retried in a fresh session."""
+        for attempt in range(COMMITTED_READ_ATTEMPTS):
+            try:
+                async with AsyncSessionLocal() as db:
+                    found = await MessageRepository(db).get_by_client_message_ids(lost)
+                    senders = await UserRepository(db).get_by_ids(sender_ids | {m.sender_id for m in found})
+                return found, senders
+            except Exception:
+                if attempt + 1 == COMMITTED_READ_ATTEMPTS:
+                    raise
+                logger.warning("Reading committed messages failed, retrying", exc_info=True)
+
+    async def _remember(self, remember: Dict[ClientKey, UUID]) -> None:
+        try:
+            await MessageDedupeService.remember(remember)
+        except Exception:
+            logger.exception("Failed to record client message ids")
+
+    async def _release(self, client_keys: List[ClientKey]) -> None:
+        try:
+            await MessageDedupeService.release(client_keys)
+        except Exception:
+            logger.exception("Failed to release dedupe claims")
+
+
+# Shared singleton — started from the app lifespan
+message_writer = MessageWriter()
@@ -1,61 +1,132 @@
-from typing import List, Optional, Tuple
-from uuid import UUID
-from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from uuid import UUID, uuid4
+from datetime import datetime, timezone
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import selectinload
 from fastapi import HTTPException, status
+from app.core.pagination import decode_cursor, encode_cursor
 from app.db.models import MessageReadStatus, Message
+from app.db.session import on_commit, on_rollback
 from app.repositories.conversation_repository import ConversationRepository
 from app.repositories.message_repository import MessageRepository
 from app.repositories.read_receipt_repository import ReadReceiptRepository
 from app.services.message_cache import MessageCacheService
-from app.schemas.messaging import MessageCreate, MessageResponse
+from app.services.message_dedupe import MessageDedupeService
+from app.services.message_sequence import MessageSequenceService
+from app.schemas.messaging import MessageCreate, MessageResponse, PaginatedMessagesResponse
 
 
 class MessagingService:
     def __init__(self, db: AsyncSession):
+        self.db = db
         self.conv_repo = ConversationRepository(db)
         self.msg_repo = MessageRepository(db)
         self.receipt_repo = ReadReceiptRepository(db)
 
-    async def send_message(self, sender_id: UUID, data: MessageCreate) -> MessageResponse:
-        conv = await self.conv_repo.get_with_participants(data.conversation_id)
-        if not conv:
+    async def _require_participant(self, conversation_id: UUID, user_id: UUID) -> None:
+        if await self.conv_repo.is_participant(conversation_id, user_id):
+            return
+        if not await self.conv_repo.get_by_id(conversation_id):
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="Conversation not found",
             )
-        participant_ids = {p.id for p in conv.participants}
-        if sender_id not in participant_ids:
-            raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN,
-                detail="Not a participant",
-            )
-        msg = await self.msg_repo.create({
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Not a participant",
+        )
+
+    async def send_message(self, sender_id: UUID, data: MessageCreate) -> Tuple[MessageResponse, bool]:
+        """
+        Store a message. Returns (message, created); with a client_message_id the sender already
+        used in this conversation, the original message comes back with created=False and nothing
+        is written, cached or meant to be broadcast. The caller commits; the dedupe record and
+        the cache entry are only written once it has.
+        """
+        await self._require_participant(data.conversation_id, sender_id)
+        client_key = (data.conversation_id, sender_id, data.client_message_id) if data.client_message_id else None
+        if client_key is not None:
+            known = await MessageDedupeService.claim([client_key])
+            if known[client_key] is not None:
+                original = await self.get_message_with_sender(known[client_key])
+                if original is not None:
+                    return original, False
+        row = {
+            "id": uuid4(),
             "sender_id": sender_id,
             "conversation_id": data.conversation_id,
+            "client_message_id": data.client_message_id,
             "content": data.content,
             "read_status": MessageReadStatus.sent,
-        })
-        msg = await self.msg_repo.get_by_id(msg.id, options=[selectinload(Message.sender)])
-        
-        cache_data = {
-            "id": str(msg.id),
-            "sender_id": str(msg.sender_id),
-            "conversation_id": str(msg.conversation_id),
-            "content": msg.content,
-            "created_at": msg.created_at.isoformat(),
-            "read_status": msg.read_status.value,
+            "created_at": datetime.now(timezone.utc),
         }
-        if msg.sender:
-            cache_data["sender"] = {
-                "id": str(msg.sender.id),
-                "username": msg.sender.username,
-                "email": msg.sender.email,
-            }
-        await MessageCacheService.cache_message(data.conversation_id, cache_data)
-        
-        return MessageResponse.model_validate(msg)
+        try:
+            await MessageSequenceService.claim([row], self.msg_repo)
+            inserted = await self.msg_repo.insert_many([row])
+            if inserted:
+                msg = await self.msg_repo.get_by_id(row["id"], options=[selectinload(Message.sender)])
+        except Exception:
+            if client_key is not None:
+                await MessageDedupeService.release([client_key])
+            raise
+        if not inserted:
+            # Lost the message_client_ids claim: an earlier send with this id committed first
+            original = (await self.msg_repo.get_by_client_message_ids([client_key]))[0]
+            await MessageDedupeService.remember({client_key: original.id})
+            return await self.get_message_with_sender(original.id), False
+        response = MessageResponse.model_validate(msg)
+        # Redis must not point at the message before the caller's commit makes it visible;
+        # if that commit fails, the pending claim is freed for the retry instead
+        if client_key is not None:
+            on_commit(self.db, lambda: MessageDedupeService.remember({client_key: msg.id}))
+            on_rollback(self.db, lambda: MessageDedupeService.release([client_key]))
+        entry = MessageCacheService.cache_entry(response)
+        on_commit(self.db, lambda: MessageCacheService.cache_message(data.conversation_id, entry))
+        return response, True
+
+    async def send_bulk(
+        self,
+        sender_id: UUID,
+        items: List[MessageCreate],
+    ) -> List[Tuple[MessageResponse, bool]]:
+        """
+        Store many messages from one sender across any number of conversations in one
+        transaction: membership is checked once per conversation (one query for all of them),
+        rows go through the group-commit writer's bulk path (chunked multi-row INSERTs,
+        client_message_id dedupe), and new messages reach the cache in one pipeline.
+        Returns (message, created) per item, in request order. Broadcasting is up to the caller.
+        """
+        from app.core.config import settings
+        from app.services.message_writer import message_writer
+
+        if len(items) > settings.MESSAGE_BULK_MAX:
+            raise HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                detail=f"At most {settings.MESSAGE_BULK_MAX} messages per request",
+            )
+        conversation_ids = list(dict.fromkeys(item.conversation_id for item in items))
+        allowed = await self.conv_repo.get_participating_ids(sender_id, conversation_ids)
+        rejected = [str(c) for c in conversation_ids if c not in allowed]
+        if rejected:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail={"message": "Not a participant", "conversation_ids": rejected},
+            )
+
+        rows = [
+            message_writer.build_row(sender_id, item.conversation_id, item.content, item.client_message_id)
+            for item in items
+        ]
+        results = await message_writer.write(rows, settings.MESSAGE_BULK_INSERT_CHUNK)
+
+        by_conversation: Dict[UUID, List[dict]] = {}
+        for response, created in results:
+            if created:
+                by_conversation.setdefault(response.conversation_id, []).append(
+                    MessageCacheService.cache_entry(response)
+                )
+        await MessageCacheService.cache_messages_by_conversation(by_conversation)
+        return results
 
     async def get_message_with_sender(self, message_id: UUID) -> Optional[MessageResponse]:
         msg = await self.msg_repo.get_by_id(message_id, options=[selectinload(Message.sender)])
@@ -67,61 +138,110 @@ class MessagingService:
         self,
         conversation_id: UUID,
         user_id: UUID,
-        skip: int = 0,
-        limit: int = 100,
-        cursor: Optional[UUID] = None,
+        limit: int = 50,
+        before: Optional[str] = None,
+        after: Optional[str] = None,
+        around: Optional[UUID] = None,
         use_cache: bool = True,
-    ) -> Tuple[List[MessageResponse], Optional[UUID]]:
-        conv = await self.conv_repo.get_with_participants(conversation_id)
-        if not conv:
+        after_seq: Optional[int] = None,
+    ) -> PaginatedMessagesResponse:
+        """
+        One keyset page of a conversation, oldest first within the page. Without a position it is
+        the newest `limit` messages; `before`/`after` take opaque cursors from an earlier page and
+        `around` a message id (e.g. a search hit), which lands in the middle of the page.
+        `after_seq` is the sync form of `after`: every message with a higher seq.
+        Every branch fetches limit+1 rows so has_more needs no count.
+        """
+        if sum(position is not None for position in (before, after, around, after_seq)) > 1:
             raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="Conversation not found",
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Use at most one of before, after, around, after_seq",
             )
-        if user_id not in {p.id for p in conv.participants}:
-            raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN,
-                detail="Not a participant",
+        try:
+            before_key = decode_cursor(before) if before is not None else None
+            after_key = decode_cursor(after) if after is not None else None
+        except ValueError:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+        await self._require_participant(conversation_id, user_id)
+
+        if after_key is not None:
+            rows = await self.msg_repo.get_conversation_chunk(conversation_id, after_key, limit + 1)
+            page = self._page(rows[:limit], has_older=True, has_newer=len(rows) > limit)
+            page.has_more = page.has_newer
+            return page
+
+        if after_seq is not None:
+            rows = await self.msg_repo.get_after_seq(conversation_id, after_seq, limit + 1)
+            page = self._page(rows[:limit], has_older=after_seq > 0, has_newer=len(rows) > limit)
+            page.has_more = page.has_newer
+            return page
+
+        if around is not None:
+            anchor = await self.msg_repo.get_by_id(around)
+            if anchor is None or anchor.conversation_id != conversation_id:
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Message not found")
+            key = (anchor.created_at, anchor.id)
+            older_limit = limit // 2
+            older = await self.msg_repo.get_page_before(conversation_id, key, older_limit + 1)
+            newer = await self.msg_repo.get_conversation_chunk(
+                conversation_id, key, limit - older_limit + 1, inclusive=True
             )
-        
-        if use_cache and skip == 0 and cursor is None:
-            cached = await MessageCacheService.get_cached_messages(conversation_id, limit)
-            if cached:
-                from app.schemas.messaging import MessageResponse
-                from app.db.models import MessageReadStatus
-                messages = []
-                for c in cached:
-                    try:
-                        msg = MessageResponse(
-                            id=UUID(c["id"]),
-                            sender_id=UUID(c["sender_id"]),
-                            conversation_id=UUID(c["conversation_id"]),
-                            content=c["content"],
-                            created_at=datetime.fromisoformat(c["created_at"]),
-                            read_status=MessageReadStatus(c["read_status"]),
-                        )
-                        messages.append(msg)
-                    except (KeyError, ValueError, TypeError):
-                        continue
-                if messages:
-                    next_cursor = messages[-1].id if len(messages) == limit else None
-                    return messages, next_cursor
-        
-        if cursor:
-            from sqlalchemy import select
-            cursor_msg = await self.msg_repo.get_by_id(cursor)
-            if cursor_msg:
-                messages = await self.msg_repo.get_by_conversation_after(
-                    conversation_id, cursor_msg.created_at, limit
-                )
-            else:
-                messages = await self.msg_repo.get_by_conversation(conversation_id, 0, limit)
-        else:
-            messages = await self.msg_repo.get_by_conversation(conversation_id, skip, limit)
-        
-        result = [MessageResponse.model_validate(m) for m in messages]
-        next_cursor = result[-1].id if result and len(result) == limit else None
-        return result, next_cursor
+            rows = older[:older_limit][::-1] + newer[:limit - older_limit]
+            page = self._page(rows, has_older=len(older) > older_limit, has_newer=len(newer) > limit - older_limit)
+            page.has_more = page.has_older or page.has_newer
+            return page
+
+        if before_key is None and use_cache:
+            cached = await self._cached_latest(conversation_id, limit)
+            if cached is not None:
+                return cached
+
+        rows = await self.msg_repo.get_page_before(conversation_id, before_key, limit + 1)
+        page = self._page(rows[:limit][::-1], has_older=len(rows) > limit, has_newer=before_key is not None)
+        page.has_more = page.has_older
+        return page
+
+    async def _cached_latest(self, conversation_id: UUID, limit: int) -> Optional[PaginatedMessagesResponse]:
+        """
+        The newest page from the Redis list, only when it holds at least limit+1 messages: with
+        fewer we could not tell whether older ones exist, so the database answers instead.
+        """
+        cached = await MessageCacheService.get_cached_messages(conversation_id, limit + 1)
+        if len(cached) <= limit:
+            return None
+        messages = []
+        for c in cached:
+            try:
+                messages.append(MessageResponse(
+                    id=UUID(c["id"]),
+                    sender_id=UUID(c["sender_id"]),
+                    conversation_id=UUID(c["conversation_id"]),
+                    seq=c.get("seq"),
+                    content=c["content"],
+                    created_at=datetime.fromisoformat(c["created_at"]),
+                    read_status=MessageReadStatus(c["read_status"]),
+                ))
+            except (KeyError, ValueError, TypeError):
+                return None
+        # List order is insertion order; pages are keyed by (created_at, id)
+        messages.sort(key=lambda m: (m.created_at, m.id))
+        page = self._page(messages[-limit:], has_older=True, has_newer=False)
+        page.has_more = True
+        return page
+
+    @staticmethod
+    def _page(rows: list, has_older: bool, has_newer: bool) -> PaginatedMessagesResponse:
+        messages = [MessageResponse.model_validate(m) for m in rows]
+        if not messages:
+            return PaginatedMessagesResponse(messages=[])
+        first, last = messages[0], messages[-1]
+        return PaginatedMessagesResponse(
+            messages=messages,
+            prev_cursor=encode_cursor(first.created_at, first.id) if has_older else None,
+            next_cursor=encode_cursor(last.created_at, last.id) if has_newer else None,
+            has_older=has_older,
+            has_newer=has_newer,
+        )
 
     async def mark_message_read(self, message_id: UUID, user_id: UUID) -> bool:
         msg = await self.msg_repo.get_by_id(message_id)
@@ -130,32 +250,43 @@ class MessagingService:
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="Message not found",
             )
-        conv = await self.conv_repo.get_with_participants(msg.conversation_id)
-        if user_id not in {p.id for p in conv.participants}:
-            raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN,
-                detail="Not a participant",
-            )
+        await self._require_participant(msg.conversation_id, user_id)
         if msg.sender_id == user_id:
             return False
         
-        await self.receipt_repo.create_receipt(message_id, user_id)
+        await self.receipt_repo.create_receipt(msg, user_id)
         return True
 
-    async def get_offline_messages(self, conversation_id: UUID, user_id: UUID) -> List[MessageResponse]:
-        messages = await self.msg_repo.get_unread_for_user(conversation_id, user_id)
+    async def get_offline_chunk(
+        self,
+        conversation_id: UUID,
+        user_id: UUID,
+        after: Optional[MessageResponse] = None,
+        limit: int = 100,
+    ) -> List[MessageResponse]:
+        """Next keyset chunk of unread messages after the last one already delivered."""
+        anchor = (after.created_at, after.id) if after is not None else None
+        messages = await self.msg_repo.get_unread_chunk(conversation_id, user_id, anchor, limit)
         return [MessageResponse.model_validate(m) for m in messages]
 
-    async def mark_read(self, conversation_id: UUID, user_id: UUID) -> int:
-        conv = await self.conv_repo.get_with_participants(conversation_id)
-        if not conv:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="Conversation not found",
-            )
-        if user_id not in {p.id for p in conv.participants}:
-            raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN,
-                detail="Not a participant",
-            )
-        return await self.msg_repo.mark_conversation_read_for_user(conversation_id, user_id)
+    async def get_resume_delta(
+        self,
+        conversation_id: UUID,
+        cursor: str,
+        limit: int,
+    ) -> Optional[List[MessageResponse]]:
+        """
+        Messages after the client's last received one (its opaque cursor), at most `limit`.
+        The cursor carries created_at, so this is one partition-pruned keyset read with no lookup
+        of the anchor message. None when the cursor is not valid.
+        """
+        try:
+            position = decode_cursor(cursor)
+        except ValueError:
+            return None
+        messages = await self.msg_repo.get_conversation_chunk(conversation_id, position, limit)
+        return [MessageResponse.model_validate(m) for m in messages]
+
+    async def mark_read(self, conversation_id: UUID, user_id: UUID, up_to: Optional[datetime] = None) -> int:
+        await self._require_participant(conversation_id, user_id)
+        return await self.msg_repo.mark_conversation_read_for_user(conversation_id, user_id, up_to)
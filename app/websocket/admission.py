@@ -0,0 +1,63 @@
+import asyncio
+import random
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional
+from app.core.config import settings
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, retry_after: int) -> None:
+        super().__init__(f"Handshake rejected, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class HandshakeAdmission:
+    """
+    Bounds the WebSocket handshakes doing database work at once (WS_HANDSHAKE_CONCURRENCY, kept
+    below the pool size so REST traffic keeps connections). A handshake that cannot get a slot
+    within WS_HANDSHAKE_MAX_WAIT_MS is rejected with a jittered retry-after instead of queueing
+    behind a reconnect storm.
+    """
+
+    def __init__(self, limit: Optional[int] = None, max_wait_ms: Optional[int] = None) -> None:
+        self.limit = limit or settings.WS_HANDSHAKE_CONCURRENCY
+        self.max_wait = (max_wait_ms if max_wait_ms is not None else settings.WS_HANDSHAKE_MAX_WAIT_MS) / 1000
+        self._semaphore = asyncio.Semaphore(self.limit)
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.wait_seconds_total = 0.0
+
+    def retry_after(self) -> int:
+        base = settings.WS_HANDSHAKE_RETRY_AFTER
+        return base + random.randint(0, base)
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.max_wait)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise AdmissionRejected(self.retry_after())
+        self.admitted += 1
+        self.wait_seconds_total += time.perf_counter() - start
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self._semaphore.release()
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "in_flight": self.in_flight,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "avg_wait_ms": self.wait_seconds_total / self.admitted * 1000 if self.admitted else 0.0,
+        }
+
+
+# Shared singleton — one budget per process
+handshake_admission = HandshakeAdmission()
@@ -0,0 +1,82 @@
+import bisect
+import hashlib
+import logging
+from typing import Dict, List, Optional, Tuple
+from uuid import UUID
+from app.core.config import settings
+from app.websocket.redis_store import RedisConnectionStore
+
+logger = logging.getLogger(__name__)
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """Consistent-hash ring with virtual nodes: adding or removing a node only moves ~1/N of the keys."""
+
+    def __init__(self, nodes: Dict[str, str], vnodes: int) -> None:
+        self.nodes = dict(nodes)
+        points: List[Tuple[int, str]] = []
+        for node_id in self.nodes:
+            for replica in range(vnodes):
+                points.append((_hash(f"{node_id}#{replica}"), node_id))
+        points.sort()
+        self._hashes = [h for h, _ in points]
+        self._owners = [node_id for _, node_id in points]
+        self.version = hashlib.md5(",".join(sorted(self.nodes)).encode()).hexdigest()[:12]
+
+    def owner(self, key: str) -> Optional[str]:
+        if not self._hashes:
+            return None
+        index = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._owners[index]
+
+
+class AffinityRouter:
+    """
+    Conversation affinity (WS_AFFINITY_ENABLED): conversations are mapped to WebSocket nodes on a
+    consistent-hash ring built from the nodes holding a presence lease, so clients of one conversation
+    can connect to the same node and most fan-out stays process-local. Routing is a hint: any node
+    still accepts any socket, and cross-node delivery keeps working through pub/sub.
+    """
+
+    def __init__(self, vnodes: Optional[int] = None) -> None:
+        self.vnodes = vnodes or settings.WS_AFFINITY_VNODES
+        self.ring = HashRing({}, self.vnodes)
+
+    async def refresh(self) -> bool:
+        """Rebuild the ring from the live nodes. Returns True when membership changed."""
+        nodes = await RedisConnectionStore.get_live_nodes()
+        if nodes == self.ring.nodes:
+            return False
+        previous = self.ring.version
+        self.ring = HashRing(nodes, self.vnodes)
+        logger.info("Affinity ring %s -> %s (%d nodes)", previous, self.ring.version, len(nodes))
+        return True
+
+    async def route(self, conversation_id: UUID) -> Optional[Tuple[str, str]]:
+        """(node id, URL) owning the conversation, or None when no node advertises a URL."""
+        if not self.ring.nodes:
+            await self.refresh()
+        node_id = self.ring.owner(str(conversation_id))
+        if node_id is None:
+            return None
+        return node_id, self.ring.nodes[node_id]
+
+    def hint(self, conversation_id: UUID, node_id: str) -> Optional[dict]:
+        """A `rebalance` frame when `node_id` no longer owns the conversation, else None."""
+        owner = self.ring.owner(str(conversation_id))
+        if owner is None or owner == node_id:
+            return None
+        return {
+            "type": "rebalance",
+            "conversation_id": str(conversation_id),
+            "url": self.ring.nodes[owner],
+            "ring_version": self.ring.version,
+        }
+
+
+# Shared singleton — refreshed by the ConnectionManager heartbeat
+affinity_router = AffinityRouter()
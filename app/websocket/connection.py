@@ -0,0 +1,203 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Set
+from uuid import UUID
+from fastapi import WebSocket, status
+from app.core.config import settings
+from app.websocket.frame import ENCODING_MSGPACK, Frame
+
+logger = logging.getLogger(__name__)
+
+OVERFLOW_DROP = "drop"
+OVERFLOW_COALESCE = "coalesce"
+OVERFLOW_DISCONNECT = "disconnect"
+
+
+class Connection:
+    """
+    A local WebSocket with a bounded outbound queue drained by its own writer task,
+    so a slow client only delays its own frames instead of the whole broadcast.
+
+    Slotted and lazy so an idle socket stays small: the queue, the writer task and the
+    backpressure event only exist while frames are in flight (see README, "Memory per connection").
+    """
+
+    # Frames refused by full queues on this node, across all connections (a per-socket count
+    # would cost every idle socket a slot); reported by ConnectionManager.stats
+    frames_dropped = 0
+
+    __slots__ = (
+        "connection_id",
+        "websocket",
+        "user_id",
+        "subscriptions",
+        "max_queue",
+        "overflow_policy",
+        "binary",
+        "compact",
+        "closed",
+        "last_seen",
+        "_known_senders",
+        "_queue",
+        "_pending",
+        "_writable",
+        "_writer",
+    )
+
+    def __init__(
+        self,
+        connection_id: str,
+        websocket: WebSocket,
+        user_id: UUID,
+        max_queue: Optional[int] = None,
+        overflow_policy: Optional[str] = None,
+        encoding: Optional[str] = None,
+        compact: bool = False,
+    ) -> None:
+        self.connection_id = connection_id
+        self.websocket = websocket
+        self.user_id = user_id
+        self.subscriptions: Set[UUID] = set()
+        self.max_queue = max_queue or settings.WS_SEND_QUEUE_SIZE
+        self.overflow_policy = overflow_policy or settings.WS_SEND_OVERFLOW_POLICY
+        self.binary = encoding == ENCODING_MSGPACK
+        # Compact sockets get each sender's profile once in a `users` frame, then only sender_id
+        self.compact = compact
+        self._known_senders: Optional[Set[str]] = None
+        self.closed = False
+        # Monotonic time of the last frame received from the client (heartbeat liveness)
+        self.last_seen = time.monotonic()
+        # Each entry is [frame, coalesce_key]; kept mutable so coalescing can swap the frame in place
+        self._queue: Optional[Deque[List]] = None
+        self._pending: Optional[Dict[str, List]] = None
+        # Exists (unset) from the high watermark until the writer drains below the low one
+        self._writable: Optional[asyncio.Event] = None
+        # Runs only while the queue is non-empty
+        self._writer: Optional[asyncio.Task] = None
+
+    def enqueue(self, frame: Frame, coalesce_key: Optional[str] = None) -> bool:
+        """Queue a frame without awaiting the socket. Returns False if the frame was not queued."""
+        if self.closed:
+            return False
+        queue = self._queue
+        if queue is None:
+            queue = self._queue = deque()
+        elif len(queue) >= self.max_queue:
+            return self._overflow(frame, coalesce_key)
+        entry = [frame, coalesce_key]
+        queue.append(entry)
+        if coalesce_key is not None:
+            if self._pending is None:
+                self._pending = {}
+            self._pending[coalesce_key] = entry
+        if len(queue) >= self.max_queue // 2 and self._writable is None:
+            self._writable = asyncio.Event()
+        if self._writer is None:
+            self._writer = asyncio.create_task(self._write_loop(queue))
+        return True
+
+    def touch(self) -> None:
+        self.last_seen = time.monotonic()
+
+    async def wait_writable(self) -> None:
+        """Wait until the outbound queue has drained enough for bulk producers to continue."""
+        writable = self._writable
+        if writable is not None and not self.closed:
+            await writable.wait()
+
+    def _overflow(self, frame: Frame, coalesce_key: Optional[str]) -> bool:
+        if self.overflow_policy == OVERFLOW_DISCONNECT:
+            logger.warning("Evicting slow WebSocket consumer %s", self.connection_id)
+            self._evict()
+            return False
+        if self.overflow_policy == OVERFLOW_COALESCE and coalesce_key is not None and self._pending:
+            entry = self._pending.get(coalesce_key)
+            if entry is not None:
+                entry[0] = frame
+                return True
+        Connection.frames_dropped += 1
+        return False
+
+    def _evict(self) -> None:
+        # The queue was full, so the writer is running: it closes the socket once its send returns
+        self.closed = True
+        self._queue.clear()
+        self._pending = None
+        self._release_writable()
+
+    def _release_writable(self) -> None:
+        if self._writable is not None:
+            self._writable.set()
+            self._writable = None
+
+    async def _write_loop(self, queue: Deque[List]) -> None:
+        try:
+            while queue:
+                entry = queue.popleft()
+                frame, coalesce_key = entry
+                if coalesce_key is not None and self._pending is not None and self._pending.get(coalesce_key) is entry:
+                    del self._pending[coalesce_key]
+                await self._send(frame)
+                if self._writable is not None and len(queue) <= self.max_queue // 4:
+                    self._release_writable()
+            if self.closed:
+                await self.websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.closed = True
+            self._release_writable()
+        finally:
+            # Nothing can be enqueued between the empty check and here (no await), so drop it all
+            self._writer = None
+            self._queue = None
+            self._pending = None
+
+    async def _send(self, frame: Frame) -> None:
+        if self.compact:
+            compact = frame.compact()
+            known = self._known_senders
+            if known is None:
+                known = self._known_senders = set()
+            new = [sender for sender_id, sender in compact.senders.items() if sender_id not in known]
+            if new:
+                known.update(str(sender.get("id")) for sender in new)
+                await self._write(Frame({"type": "users", "users": new}))
+            frame = compact
+        await self._write(frame)
+
+    async def _write(self, frame: Frame) -> None:
+        if self.binary:
+            await self.websocket.send_bytes(frame.binary)
+        else:
+            await self.websocket.send_text(frame.text)
+
+    async def flush(self) -> None:
+        """Wait until everything queued so far has been written (or the socket is gone)."""
+        while self._writer is not None and not self._writer.done():
+            await asyncio.wait((self._writer,))
+
+    async def stop(self) -> None:
+        self.closed = True
+        self._release_writable()
+        writer = self._writer
+        # A writer cancelled before its first step never reaches its finally block
+        self._writer = None
+        self._queue = None
+        self._pending = None
+        if writer is not None and not writer.done():
+            writer.cancel()
+            try:
+                await writer
+            except asyncio.CancelledError:
+                pass
+
+    async def close(self, code: int = status.WS_1000_NORMAL_CLOSURE, timeout: float = 5.0) -> None:
+        """Stop writing and close the socket; bounded, since the peer may already be gone."""
+        await self.stop()
+        try:
+            await asyncio.wait_for(self.websocket.close(code=code), timeout)
+        except Exception:
+            pass
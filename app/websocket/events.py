@@ -0,0 +1,48 @@
+from typing import Any, Dict, List
+from uuid import UUID
+from app.core.pagination import encode_cursor
+from app.schemas.messaging import MessageResponse
+
+
+def message_event(msg: MessageResponse, event_type: str = "message") -> Dict[str, Any]:
+    payload = {
+        "type": event_type,
+        "id": str(msg.id),
+        "sender_id": str(msg.sender_id),
+        "conversation_id": str(msg.conversation_id),
+        "seq": msg.seq,
+        "content": msg.content,
+        "timestamp": msg.created_at.isoformat(),
+        # Position for resume_from and for `after` paging
+        "cursor": encode_cursor(msg.created_at, msg.id),
+        "read_status": msg.read_status.value if hasattr(msg.read_status, "value") else str(msg.read_status),
+    }
+    if msg.client_message_id:
+        payload["client_message_id"] = msg.client_message_id
+    if msg.sender:
+        payload["sender"] = {"id": str(msg.sender.id), "username": msg.sender.username, "email": msg.sender.email}
+    return payload
+
+
+def message_batch_event(conversation_id: UUID, messages: List[MessageResponse]) -> Dict[str, Any]:
+    """Many new messages of one conversation in a single frame (bulk ingest), oldest first."""
+    return {
+        "type": "message_batch",
+        "conversation_id": str(conversation_id),
+        "messages": [message_event(msg) for msg in messages],
+    }
+
+
+def typing_event(conversation_id: UUID, typing_users: Dict[str, dict]) -> Dict[str, Any]:
+    return {
+        "type": "typing_indicator",
+        "conversation_id": str(conversation_id),
+        "typing_users": [
+            {
+                "user_id": uid,
+                "username": data.get("username", ""),
+                "timestamp": data.get("timestamp", ""),
+            }
+            for uid, data in typing_users.items()
+        ],
+    }
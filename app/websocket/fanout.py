@@ -0,0 +1,92 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple
+from app.core.config import settings
+from app.websocket.connection import Connection
+from app.websocket.frame import Frame
+
+logger = logging.getLogger(__name__)
+
+# (enqueued at, live recipient map, frame, coalesce key, excluded connection id)
+FanoutJob = Tuple[float, Dict[str, Connection], Frame, Optional[str], Optional[str]]
+
+
+class ConversationFanout:
+    """
+    Background delivery for conversations with many local sockets. Each such conversation gets
+    one worker task that processes its broadcasts in order, enqueuing recipients in shards of
+    WS_FANOUT_SHARD_SIZE and yielding to the event loop between shards, so a broadcast to tens of
+    thousands of sockets never blocks the sender or other sockets. A worker exits once its
+    conversation has no queued broadcasts.
+    """
+
+    def __init__(self, shard_size: Optional[int] = None) -> None:
+        self.shard_size = shard_size or settings.WS_FANOUT_SHARD_SIZE
+        self._jobs: Dict[str, Deque[FanoutJob]] = {}
+        self._workers: Dict[str, asyncio.Task] = {}
+        self.broadcasts = 0
+        self.recipients = 0
+        self.lag_seconds_total = 0.0
+        self.max_lag_seconds = 0.0
+        self.last_lag_seconds = 0.0
+
+    def active(self, key: str) -> bool:
+        return key in self._workers
+
+    def submit(
+        self,
+        key: str,
+        connections: Dict[str, Connection],
+        frame: Frame,
+        coalesce_key: Optional[str] = None,
+        exclude_connection_id: Optional[str] = None,
+    ) -> None:
+        """Queue a broadcast behind the conversation's earlier ones; returns without delivering."""
+        job = (time.perf_counter(), connections, frame, coalesce_key, exclude_connection_id)
+        self._jobs.setdefault(key, deque()).append(job)
+        if key not in self._workers:
+            self._workers[key] = asyncio.create_task(self._work(key))
+
+    async def _work(self, key: str) -> None:
+        jobs = self._jobs[key]
+        try:
+            while jobs:
+                enqueued_at, connections, frame, coalesce_key, exclude = jobs.popleft()
+                # Snapshot: sockets joining mid-delivery get the next broadcast, not half of this one
+                targets = list(connections.values())
+                for start in range(0, len(targets), self.shard_size):
+                    for conn in targets[start:start + self.shard_size]:
+                        if conn.connection_id != exclude:
+                            conn.enqueue(frame, coalesce_key)
+                    await asyncio.sleep(0)
+                self._record(time.perf_counter() - enqueued_at, len(targets))
+        except Exception:
+            logger.exception("Fan-out worker for conversation %s failed", key)
+        finally:
+            del self._jobs[key]
+            del self._workers[key]
+
+    def _record(self, lag: float, recipients: int) -> None:
+        self.broadcasts += 1
+        self.recipients += recipients
+        self.lag_seconds_total += lag
+        self.last_lag_seconds = lag
+        self.max_lag_seconds = max(self.max_lag_seconds, lag)
+
+    async def wait_idle(self) -> None:
+        """Wait until every queued broadcast has been handed to its recipients' send queues."""
+        while self._workers:
+            await asyncio.gather(*list(self._workers.values()), return_exceptions=True)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "broadcasts": self.broadcasts,
+            "recipients": self.recipients,
+            "avg_lag_ms": self.lag_seconds_total / self.broadcasts * 1000 if self.broadcasts else 0.0,
+            "max_lag_ms": self.max_lag_seconds * 1000,
+            "last_lag_ms": self.last_lag_seconds * 1000,
+            "active_conversations": len(self._workers),
+            "queued_broadcasts": sum(len(jobs) for jobs in self._jobs.values()),
+        }
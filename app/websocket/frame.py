@@ -0,0 +1,82 @@
+import json
+from typing import Any, Dict, Optional
+import msgpack
+
+ENCODING_JSON = "json"
+ENCODING_MSGPACK = "msgpack"
+
+
+def _strip_sender(event: Dict[str, Any], senders: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    sender = event.get("sender")
+    if not isinstance(sender, dict):
+        return event
+    senders[str(sender.get("id"))] = sender
+    return {k: v for k, v in event.items() if k != "sender"}
+
+
+class Frame:
+    """
+    An outbound WebSocket payload serialized at most once per encoding, however many sockets it is
+    sent to. Build from a dict (encoded lazily on first use) or from already-encoded text.
+    """
+
+    __slots__ = ("_message", "_text", "_binary", "_compact", "senders", "type")
+
+    def __init__(
+        self,
+        message: Optional[Dict[str, Any]] = None,
+        text: Optional[str] = None,
+        event_type: Optional[str] = None,
+    ) -> None:
+        self._message = message
+        self._text = text
+        self._binary: Optional[bytes] = None
+        self._compact: Optional["Frame"] = None
+        # Sender objects removed by compact(), keyed by user id
+        self.senders: Dict[str, Dict[str, Any]] = {}
+        self.type = event_type if event_type is not None or message is None else message.get("type")
+
+    @classmethod
+    def from_text(cls, text: str, event_type: Optional[str] = None) -> "Frame":
+        return cls(text=text, event_type=event_type)
+
+    @property
+    def message(self) -> Dict[str, Any]:
+        if self._message is None:
+            self._message = json.loads(self._text)
+        return self._message
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = json.dumps(self._message, default=str)
+        return self._text
+
+    @property
+    def binary(self) -> bytes:
+        """MessagePack encoding; UUIDs and datetimes become strings as in the JSON form."""
+        if self._binary is None:
+            self._binary = msgpack.packb(self.message, default=str, use_bin_type=True)
+        return self._binary
+
+    def compact(self) -> "Frame":
+        """
+        The same frame without embedded `sender` objects (message events and batches of them),
+        which are collected in `senders` instead. Returns self when there is nothing to strip.
+        """
+        if self._compact is None:
+            message = self.message
+            senders: Dict[str, Dict[str, Any]] = {}
+            stripped = _strip_sender(message, senders)
+            if isinstance(message.get("messages"), list):
+                stripped = dict(stripped)
+                stripped["messages"] = [
+                    _strip_sender(item, senders) if isinstance(item, dict) else item
+                    for item in message["messages"]
+                ]
+            if senders:
+                self._compact = Frame(stripped, event_type=self.type)
+                self._compact.senders = senders
+            else:
+                self._compact = self
+        return self._compact
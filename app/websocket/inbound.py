@@ -0,0 +1,80 @@
+import asyncio
+import logging
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, List, Optional
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+BatchProcessor = Callable[[List[Any]], Awaitable[None]]
+
+
+class InboundQueue:
+    """
+    Bounded per-socket queue of inbound work drained by one worker task. The receive loop keeps
+    reading while earlier frames are processed; the worker hands everything queued so far (up to
+    WS_INBOUND_MAX_BATCH) to `process` at once so it can share round trips, and batches run one
+    after another so a sender's frames are handled in order. When the queue is full, `put` waits,
+    which stops reading from the socket and lets TCP push back on the client.
+
+    Meant for a single producer (the socket's receive loop). The worker only runs while items
+    are queued, so an idle socket holds no task.
+    """
+
+    __slots__ = ("_process", "maxsize", "max_batch", "_items", "_space", "_worker", "_closed")
+
+    def __init__(
+        self,
+        process: BatchProcessor,
+        maxsize: Optional[int] = None,
+        max_batch: Optional[int] = None,
+    ) -> None:
+        self._process = process
+        self.maxsize = maxsize or settings.WS_INBOUND_QUEUE_SIZE
+        self.max_batch = max_batch or settings.WS_INBOUND_MAX_BATCH
+        self._items: Deque[Any] = deque()
+        # Resolved by the worker when a full queue gets room again
+        self._space: Optional[asyncio.Future] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._closed = False
+
+    def full(self) -> bool:
+        return len(self._items) >= self.maxsize
+
+    def qsize(self) -> int:
+        return len(self._items)
+
+    async def put(self, item: Any) -> None:
+        while self.full() and not self._closed:
+            self._space = asyncio.get_running_loop().create_future()
+            await self._space
+        if self._closed:
+            return
+        self._items.append(item)
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run())
+
+    async def close(self, timeout: float = 5.0) -> None:
+        """Process what is already queued, then stop the worker."""
+        self._closed = True
+        worker = self._worker
+        if worker is None:
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(worker), timeout)
+        except asyncio.TimeoutError:
+            worker.cancel()
+
+    async def _run(self) -> None:
+        items = self._items
+        try:
+            while items:
+                batch = [items.popleft() for _ in range(min(len(items), self.max_batch))]
+                if self._space is not None and not self._space.done():
+                    self._space.set_result(None)
+                try:
+                    await self._process(batch)
+                except Exception:
+                    logger.exception("Inbound batch failed")
+        finally:
+            self._worker = None
@@ -1,20 +1,175 @@
-from typing import Dict, Set, Optional, Any
+import asyncio
+import logging
+import random
+import time
+from typing import Dict, Iterable, List, Set, Optional, Any, Union
 from uuid import UUID
 import uuid as uuid_lib
-import json
-from fastapi import WebSocket
+from fastapi import WebSocket, status
+from app.core.config import settings
 from app.websocket.redis_store import RedisConnectionStore
+from app.websocket.pubsub import ConversationPubSub
+from app.websocket.affinity import affinity_router
+from app.websocket.connection import Connection
+from app.websocket.fanout import ConversationFanout
+from app.websocket.frame import Frame
+
+logger = logging.getLogger(__name__)
+
+# Event types that only carry the latest state and may be coalesced on a full send queue
+COALESCIBLE_EVENTS = {"typing_indicator"}
+
+Outbound = Union[Frame, Dict[str, Any]]
+
+PING_FRAME = Frame({"type": "ping"})
 
 
 class ConnectionManager:
     """
-    Manages WebSocket connections per conversation.
+    Manages WebSocket connections and their conversation subscriptions.
+    A socket may subscribe to many conversations (per-user endpoint) or exactly one (per-conversation endpoint).
     In-memory store for local connections; Redis used for online users and connection metadata.
+    With WS_PUBSUB_ENABLED, broadcasts are also relayed to other nodes over Redis pub/sub.
+    Sends never await the socket: frames go to each connection's bounded queue (see Connection),
+    and each payload is serialized once as a Frame regardless of the number of recipients.
+    Conversations with more than WS_FANOUT_THRESHOLD local sockets are delivered by a background
+    ConversationFanout worker in shards instead of inline in the sender's coroutine.
+    A heartbeat pings every socket each WS_HEARTBEAT_INTERVAL, reaps sockets whose writer failed
+    (and, when WS_IDLE_TIMEOUT is set, sockets silent for longer than that), and renews this node's presence lease so a crashed node's presence is purged
+    by the survivors.
     """
 
     def __init__(self) -> None:
-        self._connections: Dict[str, Dict[str, WebSocket]] = {}
-        self._connection_meta: Dict[str, Dict[str, str]] = {}
+        self._connections: Dict[str, Dict[str, Connection]] = {}
+        self._by_id: Dict[str, Connection] = {}
+        self._by_user: Dict[UUID, Set[str]] = {}
+        self.node_id = uuid_lib.uuid4().hex
+        self._pubsub: Optional[ConversationPubSub] = None
+        self._heartbeat: Optional[asyncio.Task] = None
+        self.fanout = ConversationFanout()
+        self.draining = False
+        self._drain_task: Optional[asyncio.Task] = None
+        self.reaped = 0
+
+    async def start(self) -> None:
+        if self._heartbeat is None:
+            await self._renew_lease()
+            self._heartbeat = asyncio.create_task(self._heartbeat_loop())
+        if not settings.WS_PUBSUB_ENABLED or self._pubsub is not None:
+            return
+        self._pubsub = ConversationPubSub(self.node_id, self._deliver_local)
+        await self._pubsub.start()
+        for key in list(self._connections):
+            await self._pubsub.subscribe(UUID(key))
+
+    async def stop(self) -> None:
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+            try:
+                await self._heartbeat
+            except asyncio.CancelledError:
+                pass
+            self._heartbeat = None
+        if self._pubsub is not None:
+            await self._pubsub.stop()
+            self._pubsub = None
+
+    async def drain(self) -> None:
+        """
+        Graceful shutdown of this node's sockets: refuse new ones, tell every client when to
+        reconnect (with jitter, so they don't all hit the next node at once), flush what is already
+        queued, close with 1012 and drop all of this node's presence in one bulk Redis pass.
+        Safe to call more than once; later calls wait for the first drain.
+        """
+        if self._drain_task is None:
+            self._drain_task = asyncio.create_task(self._drain())
+        await asyncio.shield(self._drain_task)
+
+    async def _drain(self) -> None:
+        self.draining = True
+        conns = list(self._by_id.values())
+        logger.info("Draining %d WebSocket connections", len(conns))
+        base, jitter = settings.WS_DRAIN_RECONNECT_MS, settings.WS_DRAIN_JITTER_MS
+        for conn in conns:
+            conn.enqueue(Frame({"type": "reconnect", "after_ms": base + random.randint(0, jitter)}))
+        try:
+            await asyncio.wait_for(
+                self._flush_all(conns),
+                timeout=settings.WS_DRAIN_TIMEOUT,
+            )
+        except asyncio.TimeoutError:
+            logger.warning("Drain timed out with unflushed WebSocket queues")
+
+        # Stop relaying first so removing thousands of subscriptions costs no pub/sub round trips
+        await self.stop()
+        for conn in conns:
+            self._unregister(conn.connection_id)
+            await self._remove_subscriptions(conn, list(conn.subscriptions))
+        await asyncio.gather(*(conn.close(status.WS_1012_SERVICE_RESTART) for conn in conns))
+        try:
+            await RedisConnectionStore.purge_node(self.node_id)
+            await RedisConnectionStore.release_node_lease(self.node_id)
+        except Exception:
+            logger.exception("Failed to clean up presence while draining")
+
+    async def _flush_all(self, conns: List[Connection]) -> None:
+        await self.fanout.wait_idle()
+        await asyncio.gather(*(conn.flush() for conn in conns))
+
+    async def _heartbeat_loop(self) -> None:
+        while True:
+            await asyncio.sleep(settings.WS_HEARTBEAT_INTERVAL)
+            try:
+                await self._reap_idle()
+                self._ping_all()
+                await self._renew_lease()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("WebSocket heartbeat failed")
+
+    def _ping_all(self) -> None:
+        for conn in self._by_id.values():
+            conn.enqueue(PING_FRAME)
+
+    async def _reap_idle(self) -> None:
+        # The ASGI server answers protocol-level pings itself and never tells the app, so only
+        # app frames count as activity; clients that predate the app-level ping send none
+        timeout = settings.WS_IDLE_TIMEOUT
+        cutoff = time.monotonic() - timeout if timeout > 0 else None
+        dead = [
+            conn for conn in self._by_id.values()
+            if conn.closed or (cutoff is not None and conn.last_seen < cutoff)
+        ]
+        for conn in dead:
+            # Unregister first so broadcasts stop targeting it even if the close handshake hangs
+            await self.disconnect(conn.connection_id)
+            await conn.close(status.WS_1001_GOING_AWAY)
+        if dead:
+            self.reaped += len(dead)
+            logger.info("Reaped %d unresponsive WebSocket connections", len(dead))
+
+    async def _renew_lease(self) -> None:
+        url = settings.WS_NODE_URL if settings.WS_AFFINITY_ENABLED else None
+        claimed = await RedisConnectionStore.renew_node_lease(self.node_id, settings.WS_NODE_LEASE_TTL, url)
+        for node_id in claimed:
+            purged = await RedisConnectionStore.purge_node(node_id)
+            logger.warning("Purged presence of %d connections left by expired node %s", purged, node_id)
+        if settings.WS_AFFINITY_ENABLED and await affinity_router.refresh():
+            await self._send_rebalance_hints()
+
+    async def _send_rebalance_hints(self) -> None:
+        # Local only: every node hints its own sockets for conversations it no longer owns
+        for conversation_id in self.get_local_conversation_ids():
+            hint = affinity_router.hint(conversation_id, self.node_id)
+            if hint is not None:
+                await self._deliver_local(conversation_id, Frame(hint))
+
+    def touch(self, connection_id: str) -> None:
+        """Record client activity; any received frame (including pong) keeps the socket alive."""
+        conn = self._by_id.get(connection_id)
+        if conn is not None:
+            conn.touch()
 
     def _conversation_key(self, conversation_id: UUID) -> str:
         return str(conversation_id)
@@ -23,39 +178,106 @@ class ConnectionManager:
         self,
         websocket: WebSocket,
         user_id: UUID,
-        conversation_id: UUID,
+        conversation_id: Optional[UUID] = None,
+        encoding: Optional[str] = None,
+        compact: bool = False,
     ) -> str:
         await websocket.accept()
         connection_id = f"{uuid_lib.uuid4()}"
-        key = self._conversation_key(conversation_id)
-        if key not in self._connections:
-            self._connections[key] = {}
-        self._connections[key][connection_id] = websocket
-        self._connection_meta[connection_id] = {
-            "user_id": str(user_id),
-            "conversation_id": str(conversation_id),
-        }
-        await RedisConnectionStore.set_online(user_id, connection_id, conversation_id)
+        self._register(Connection(connection_id, websocket, user_id, encoding=encoding, compact=compact))
+        await RedisConnectionStore.set_online(user_id, connection_id, self.node_id, conversation_id)
+        if conversation_id is not None:
+            await self._add_subscriptions(self._by_id[connection_id], [conversation_id])
         return connection_id
 
+    def _register(self, conn: Connection) -> None:
+        self._by_id[conn.connection_id] = conn
+        self._by_user.setdefault(conn.user_id, set()).add(conn.connection_id)
+
+    def _unregister(self, connection_id: str) -> Optional[Connection]:
+        conn = self._by_id.pop(connection_id, None)
+        if conn is None:
+            return None
+        user_conns = self._by_user.get(conn.user_id)
+        if user_conns is not None:
+            user_conns.discard(connection_id)
+            if not user_conns:
+                del self._by_user[conn.user_id]
+        return conn
+
+    async def subscribe(self, connection_id: str, conversation_ids: Iterable[UUID]) -> List[UUID]:
+        """Subscribe a socket to conversations (membership must already be verified). Returns the new ones."""
+        conn = self._by_id.get(connection_id)
+        if conn is None:
+            return []
+        added = [cid for cid in dict.fromkeys(conversation_ids) if cid not in conn.subscriptions]
+        await self._add_subscriptions(conn, added)
+        if added:
+            await RedisConnectionStore.add_conversations(conn.user_id, connection_id, added)
+        return added
+
+    async def unsubscribe(self, connection_id: str, conversation_ids: Iterable[UUID]) -> List[UUID]:
+        conn = self._by_id.get(connection_id)
+        if conn is None:
+            return []
+        removed = [cid for cid in dict.fromkeys(conversation_ids) if cid in conn.subscriptions]
+        await self._remove_subscriptions(conn, removed)
+        if removed:
+            await RedisConnectionStore.remove_conversations(conn.user_id, connection_id, removed)
+        return removed
+
+    async def _add_subscriptions(self, conn: Connection, conversation_ids: Iterable[UUID]) -> None:
+        for conversation_id in conversation_ids:
+            key = self._conversation_key(conversation_id)
+            if key not in self._connections and self._pubsub is not None:
+                await self._pubsub.subscribe(conversation_id)
+            self._connections.setdefault(key, {})[conn.connection_id] = conn
+            conn.subscriptions.add(conversation_id)
+
+    async def _remove_subscriptions(self, conn: Connection, conversation_ids: Iterable[UUID]) -> None:
+        for conversation_id in conversation_ids:
+            conn.subscriptions.discard(conversation_id)
+            key = self._conversation_key(conversation_id)
+            conns = self._connections.get(key)
+            if conns is None:
+                continue
+            conns.pop(conn.connection_id, None)
+            if not conns:
+                del self._connections[key]
+                if self._pubsub is not None:
+                    await self._pubsub.unsubscribe(conversation_id)
+
+    def get_connection_user(self, connection_id: str) -> Optional[UUID]:
+        conn = self._by_id.get(connection_id)
+        return conn.user_id if conn is not None else None
+
+    def get_subscriptions(self, connection_id: str) -> Set[UUID]:
+        conn = self._by_id.get(connection_id)
+        return set(conn.subscriptions) if conn is not None else set()
+
     async def disconnect(
         self,
         connection_id: str,
-        conversation_id: UUID,
+        conversation_id: Optional[UUID] = None,
     ) -> None:
-        key = self._conversation_key(conversation_id)
-        if key in self._connections:
-            self._connections[key].pop(connection_id, None)
-            if not self._connections[key]:
-                del self._connections[key]
-        meta = self._connection_meta.pop(connection_id, None)
-        if meta:
-            try:
-                user_id = UUID(meta["user_id"])
-                conv_id = UUID(meta["conversation_id"])
-                await RedisConnectionStore.set_offline(user_id, connection_id, conv_id)
-            except (ValueError, KeyError):
-                pass
+        conn = self._unregister(connection_id)
+        if conn is None:
+            return
+        await conn.stop()
+        await self._remove_subscriptions(conn, list(conn.subscriptions))
+        await RedisConnectionStore.set_offline(conn.user_id, connection_id, self.node_id)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "connections": len(self._by_id),
+            "conversations": len(self._connections),
+            "reaped": self.reaped,
+            "frames_dropped": Connection.frames_dropped,
+        }
+
+    def get_local_conversation_ids(self) -> List[UUID]:
+        """Conversations with at least one subscribed socket on this node."""
+        return [UUID(key) for key in self._connections]
 
     def get_connection_ids_for_conversation(self, conversation_id: UUID) -> Set[str]:
         key = self._conversation_key(conversation_id)
@@ -64,55 +286,68 @@ class ConnectionManager:
     async def broadcast_to_conversation(
         self,
         conversation_id: UUID,
-        message: Dict[str, Any],
+        message: Outbound,
+        exclude_connection_id: Optional[str] = None,
+    ) -> None:
+        frame = self._frame(message)
+        await self._deliver_local(conversation_id, frame, exclude_connection_id)
+        if self._pubsub is not None:
+            await self._pubsub.publish(conversation_id, frame, exclude_connection_id)
+
+    async def _deliver_local(
+        self,
+        conversation_id: UUID,
+        frame: Frame,
         exclude_connection_id: Optional[str] = None,
     ) -> None:
         key = self._conversation_key(conversation_id)
-        connections = self._connections.get(key, {})
-        payload = json.dumps(message, default=str) if isinstance(message, dict) else message
-        disconnected = []
-        for cid, ws in connections.items():
+        connections = self._connections.get(key)
+        if not connections:
+            return
+        coalesce_key = self._coalesce_key(conversation_id, frame)
+        # Once a conversation is on a fan-out worker, later broadcasts queue behind it to keep order
+        if self.fanout.active(key) or len(connections) > settings.WS_FANOUT_THRESHOLD:
+            self.fanout.submit(key, connections, frame, coalesce_key, exclude_connection_id)
+            return
+        for cid, conn in connections.items():
             if cid == exclude_connection_id:
                 continue
-            try:
-                await ws.send_text(payload if isinstance(payload, str) else json.dumps(payload))
-            except Exception:
-                disconnected.append(cid)
-        for cid in disconnected:
-            meta = self._connection_meta.get(cid)
-            if meta and key == self._conversation_key(conversation_id):
-                connections.pop(cid, None)
-                self._connection_meta.pop(cid, None)
-
-    async def send_to_connection(self, connection_id: str, message: Dict[str, Any]) -> bool:
-        for conv_key, conns in self._connections.items():
-            if connection_id in conns:
-                try:
-                    payload = json.dumps(message, default=str)
-                    await conns[connection_id].send_text(payload)
-                    return True
-                except Exception:
-                    return False
-        return False
+            conn.enqueue(frame, coalesce_key)
+
+    def _frame(self, message: Outbound) -> Frame:
+        return message if isinstance(message, Frame) else Frame(message)
+
+    def _coalesce_key(self, conversation_id: UUID, frame: Frame) -> Optional[str]:
+        event_type = frame.type
+        if event_type in COALESCIBLE_EVENTS:
+            return f"{event_type}:{conversation_id}"
+        return None
+
+    async def send_to_connection(self, connection_id: str, message: Outbound) -> bool:
+        conn = self._by_id.get(connection_id)
+        if conn is None:
+            return False
+        return conn.enqueue(self._frame(message))
+
+    async def wait_writable(self, connection_id: str) -> None:
+        """Backpressure for bulk sends (e.g. offline replay): wait for the socket's queue to drain."""
+        conn = self._by_id.get(connection_id)
+        if conn is not None:
+            await conn.wait_writable()
 
     async def send_to_user_in_conversation(
         self,
         conversation_id: UUID,
         user_id: UUID,
-        message: Dict[str, Any],
+        message: Outbound,
     ) -> bool:
-        key = self._conversation_key(conversation_id)
-        connections = self._connections.get(key, {})
-        uid_str = str(user_id)
-        for cid, ws in connections.items():
-            meta = self._connection_meta.get(cid)
-            if meta and meta.get("user_id") == uid_str:
-                try:
-                    await ws.send_text(json.dumps(message, default=str))
-                    return True
-                except Exception:
-                    pass
-        return False
+        frame = self._frame(message)
+        sent = False
+        for cid in self._by_user.get(user_id, ()):
+            conn = self._by_id[cid]
+            if conversation_id in conn.subscriptions and conn.enqueue(frame):
+                sent = True
+        return sent
 
 
 # Shared singleton — import this from any module that needs the manager
@@ -0,0 +1,169 @@
+import asyncio
+import json
+import logging
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+from uuid import UUID
+from app.core.config import settings
+from app.db.redis_client import get_redis
+from app.db.session import AsyncSessionLocal
+from app.repositories.conversation_repository import ConversationRepository
+from app.websocket.frame import Frame
+from app.websocket.redis_store import PRESENCE_CHANNEL
+
+logger = logging.getLogger(__name__)
+
+ONLINE = "online"
+OFFLINE = "offline"
+# Last status pushed per user, so a flap that ends where it started is not pushed at all
+LAST_PUSHED_MAX_USERS = 100000
+
+
+class PresenceNotifier:
+    """
+    Pushes presence transitions to local sockets of users sharing a conversation with the user.
+    Transitions come from RedisConnectionStore's presence channel (cluster-wide). Every
+    PRESENCE_PUSH_INTERVAL_MS the latest status per user is resolved with one membership query
+    for the users that changed and each socket gets at most one `presence` frame. Offline transitions wait
+    PRESENCE_OFFLINE_GRACE_SECONDS, so a reconnect within the grace window pushes nothing.
+    """
+
+    def __init__(self, interval_ms: Optional[int] = None, offline_grace: Optional[float] = None) -> None:
+        self.interval = (interval_ms if interval_ms is not None else settings.PRESENCE_PUSH_INTERVAL_MS) / 1000
+        self.offline_grace = (
+            offline_grace if offline_grace is not None else settings.PRESENCE_OFFLINE_GRACE_SECONDS
+        )
+        # user_id -> (status, unix time of the transition); latest wins
+        self._pending: Dict[UUID, Tuple[str, float]] = {}
+        self._last_pushed: Dict[UUID, str] = {}
+        self._pubsub = None
+        self._listener: Optional[asyncio.Task] = None
+        self._flusher: Optional[asyncio.Task] = None
+        self.frames_sent = 0
+
+    async def start(self) -> None:
+        if self._listener is not None:
+            return
+        redis = await get_redis()
+        self._pubsub = redis.pubsub(ignore_subscribe_messages=True)
+        await self._pubsub.subscribe(PRESENCE_CHANNEL)
+        self._listener = asyncio.create_task(self._listen())
+        self._flusher = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        for task in (self._listener, self._flusher):
+            if task is None:
+                continue
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._listener = self._flusher = None
+        if self._pubsub is not None:
+            await self._pubsub.aclose()
+            self._pubsub = None
+
+    def note(self, user_id: UUID, status: str, at: float) -> None:
+        current = self._pending.get(user_id)
+        if current is not None and current[1] > at:
+            return
+        self._pending[user_id] = (status, at)
+
+    async def _listen(self) -> None:
+        while True:
+            try:
+                raw = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Presence listener error")
+                await asyncio.sleep(1.0)
+                continue
+            if raw is None or raw.get("type") != "message":
+                continue
+            try:
+                event = json.loads(raw["data"])
+                self.note(UUID(event["user_id"]), event["status"], float(event["at"]))
+            except (KeyError, TypeError, ValueError):
+                continue
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self._flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Presence push failed")
+
+    def _take_due(self) -> Dict[UUID, Tuple[str, float]]:
+        now = time.time()
+        due = {}
+        for user_id, (status, at) in list(self._pending.items()):
+            if status == OFFLINE and now - at < self.offline_grace:
+                continue
+            del self._pending[user_id]
+            if self._last_pushed.get(user_id) == status:
+                continue
+            due[user_id] = (status, at)
+        return due
+
+    def _remember(self, due: Dict[UUID, Tuple[str, float]]) -> None:
+        for user_id, (status, _) in due.items():
+            self._last_pushed.pop(user_id, None)
+            self._last_pushed[user_id] = status
+        while len(self._last_pushed) > LAST_PUSHED_MAX_USERS:
+            self._last_pushed.pop(next(iter(self._last_pushed)))
+
+    async def _flush(self) -> None:
+        from app.websocket.manager import ws_manager
+
+        due = self._take_due()
+        if not due:
+            return
+        self._remember(due)
+        # Keyed by the few due users only; conversations without a local socket are skipped below,
+        # so the query never grows with the number of sockets on this node
+        async with AsyncSessionLocal() as db:
+            memberships = await ConversationRepository(db).get_memberships(due)
+
+        # connection id -> indexes of the updates it should see
+        per_connection: Dict[str, List[int]] = {}
+        updates = []
+        for user_id, conversation_ids in memberships.items():
+            status, at = due[user_id]
+            update = {"user_id": str(user_id), "status": status}
+            if status == OFFLINE:
+                update["last_seen"] = datetime.fromtimestamp(at, timezone.utc).isoformat()
+            index = len(updates)
+            updates.append(update)
+            for conversation_id in conversation_ids:
+                for connection_id in ws_manager.get_connection_ids_for_conversation(conversation_id):
+                    if ws_manager.get_connection_user(connection_id) == user_id:
+                        continue
+                    targets = per_connection.setdefault(connection_id, [])
+                    if not targets or targets[-1] != index:
+                        targets.append(index)
+
+        # Sockets that see the same set of updates share one encoded frame
+        frames: Dict[Tuple[int, ...], Frame] = {}
+        for connection_id, indexes in per_connection.items():
+            key = tuple(indexes)
+            frame = frames.get(key)
+            if frame is None:
+                frame = frames[key] = Frame({"type": "presence", "users": [updates[i] for i in key]})
+            if await ws_manager.send_to_connection(connection_id, frame):
+                self.frames_sent += 1
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "frames_sent": self.frames_sent,
+            "pending_users": len(self._pending),
+        }
+
+
+# Shared singleton — started from the app lifespan
+presence_notifier = PresenceNotifier()
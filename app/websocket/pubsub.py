@@ -0,0 +1,102 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Optional
+from uuid import UUID
+from app.db.redis_client import get_redis
+from app.websocket.frame import Frame
+
+logger = logging.getLogger(__name__)
+
+CONVERSATION_CHANNEL = "messaging:ws:conversation:{conversation_id}"
+NODE_CHANNEL = "messaging:ws:node:{node_id}"
+CONVERSATION_CHANNEL_PREFIX = "messaging:ws:conversation:"
+
+DeliverCallback = Callable[[UUID, Frame, Optional[str]], Awaitable[None]]
+
+
+def encode_envelope(node_id: str, frame: Frame, exclude_connection_id: Optional[str]) -> str:
+    # Header lines followed by the already-encoded frame, so relaying never re-serializes the payload
+    return f"{node_id}\n{exclude_connection_id or ''}\n{frame.type or ''}\n{frame.text}"
+
+
+def decode_envelope(data: str):
+    node_id, exclude, event_type, text = data.split("\n", 3)
+    return node_id, exclude or None, Frame.from_text(text, event_type or None)
+
+
+class ConversationPubSub:
+    """
+    Relays conversation broadcasts between nodes over Redis pub/sub.
+    Each node only subscribes to channels of conversations it holds local sockets for;
+    envelopes published by this node are ignored on receipt since they were delivered locally.
+    """
+
+    def __init__(self, node_id: str, deliver: DeliverCallback) -> None:
+        self.node_id = node_id
+        self._deliver = deliver
+        self._pubsub = None
+        self._listener: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        redis = await get_redis()
+        self._pubsub = redis.pubsub(ignore_subscribe_messages=True)
+        # Node channel keeps the pub/sub connection subscribed even with no local conversations
+        await self._pubsub.subscribe(NODE_CHANNEL.format(node_id=self.node_id))
+        self._listener = asyncio.create_task(self._listen())
+
+    async def stop(self) -> None:
+        if self._listener:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
+        if self._pubsub:
+            await self._pubsub.aclose()
+            self._pubsub = None
+
+    async def subscribe(self, conversation_id: UUID) -> None:
+        if self._pubsub:
+            await self._pubsub.subscribe(CONVERSATION_CHANNEL.format(conversation_id=str(conversation_id)))
+
+    async def unsubscribe(self, conversation_id: UUID) -> None:
+        if self._pubsub:
+            await self._pubsub.unsubscribe(CONVERSATION_CHANNEL.format(conversation_id=str(conversation_id)))
+
+    async def publish(
+        self,
+        conversation_id: UUID,
+        frame: Frame,
+        exclude_connection_id: Optional[str] = None,
+    ) -> None:
+        redis = await get_redis()
+        envelope = encode_envelope(self.node_id, frame, exclude_connection_id)
+        await redis.publish(CONVERSATION_CHANNEL.format(conversation_id=str(conversation_id)), envelope)
+
+    async def _listen(self) -> None:
+        while True:
+            try:
+                raw = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Pub/sub listener error")
+                await asyncio.sleep(1.0)
+                continue
+            if raw is None or raw.get("type") != "message":
+                continue
+            channel = raw.get("channel", "")
+            if not channel.startswith(CONVERSATION_CHANNEL_PREFIX):
+                continue
+            try:
+                node_id, exclude, frame = decode_envelope(raw["data"])
+                conversation_id = UUID(channel[len(CONVERSATION_CHANNEL_PREFIX):])
+            except (TypeError, ValueError):
+                continue
+            if node_id == self.node_id:
+                continue
+            try:
+                await self._deliver(conversation_id, frame, exclude)
+            except Exception:
+                logger.exception("Failed to deliver relayed broadcast")
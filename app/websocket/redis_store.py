@@ -1,47 +1,217 @@
-from typing import Set, Optional
+import time
+from typing import Dict, Iterable, List, Set, Optional, Tuple
 from uuid import UUID
 import json
 from app.db.redis_client import get_redis
 
 ONLINE_USERS_KEY = "messaging:online_users"
-USER_CONVERSATIONS_KEY = "messaging:user:{user_id}:conversations"
+# Refcounted: conversation id -> number of the user's connections subscribed to it
+USER_CONVERSATIONS_KEY = "messaging:user:{user_id}:conversation_refs"
 CONNECTION_KEY = "messaging:connection:{connection_id}"
+CONNECTION_CONVERSATIONS_KEY = "messaging:connection:{connection_id}:conversations"
+CONNECTION_TTL = 86400
 CONNECTION_ID_PREFIX = "conn"
 CONNECTION_IDS_KEY = "messaging:connection_ids"
+# The user's live connection ids; the user is online while this set is non-empty
+USER_CONNECTIONS_KEY = "messaging:presence:{user_id}:connections"
+LAST_SEEN_KEY = "messaging:presence:last_seen"
+# Receives {"user_id", "status": "online" | "offline", "at"} only when a user's connection count crosses zero
+PRESENCE_CHANNEL = "messaging:presence"
+# Node leases: node id -> unix time its lease runs out; renewed by every live node's heartbeat
+NODE_LEASES_KEY = "messaging:nodes"
+NODE_CONNECTIONS_KEY = "messaging:node:{node_id}:connections"
+# node id -> public WebSocket base URL, for conversation affinity routing
+NODE_URLS_KEY = "messaging:node_urls"
+
+# KEYS: user connections, online users, connection hash, node connections, connection conversations,
+#       user conversation refs
+# ARGV: user id, connection id, node id, ttl, now, channel, conversation ids...
+CONNECT_SCRIPT = """
+redis.call('SADD', KEYS[1], ARGV[2])
+redis.call('HSET', KEYS[3], 'user_id', ARGV[1], 'node_id', ARGV[3])
+if ARGV[7] then
+    redis.call('HSET', KEYS[3], 'conversation_id', ARGV[7])
+end
+redis.call('EXPIRE', KEYS[3], ARGV[4])
+redis.call('SADD', KEYS[4], ARGV[2])
+for i = 7, #ARGV do
+    if redis.call('SADD', KEYS[5], ARGV[i]) == 1 then
+        redis.call('HINCRBY', KEYS[6], ARGV[i], 1)
+    end
+end
+redis.call('EXPIRE', KEYS[5], ARGV[4])
+if redis.call('SCARD', KEYS[1]) == 1 then
+    redis.call('SADD', KEYS[2], ARGV[1])
+    redis.call('PUBLISH', ARGV[6], cjson.encode({user_id = ARGV[1], status = 'online', at = tonumber(ARGV[5])}))
+    return 1
+end
+return 0
+"""
+
+# KEYS: same as CONNECT_SCRIPT plus the last-seen hash
+# ARGV: user id, connection id, now, channel
+DISCONNECT_SCRIPT = """
+local removed = redis.call('SREM', KEYS[1], ARGV[2])
+for _, cid in ipairs(redis.call('SMEMBERS', KEYS[5])) do
+    if redis.call('HINCRBY', KEYS[6], cid, -1) <= 0 then
+        redis.call('HDEL', KEYS[6], cid)
+    end
+end
+redis.call('DEL', KEYS[3], KEYS[5])
+redis.call('SREM', KEYS[4], ARGV[2])
+if removed == 1 and redis.call('SCARD', KEYS[1]) == 0 then
+    redis.call('SREM', KEYS[2], ARGV[1])
+    redis.call('DEL', KEYS[6])
+    redis.call('HSET', KEYS[7], ARGV[1], ARGV[3])
+    redis.call('PUBLISH', ARGV[4], cjson.encode({user_id = ARGV[1], status = 'offline', at = tonumber(ARGV[3])}))
+    return 1
+end
+return 0
+"""
+
+# KEYS: connection conversations, user conversation refs; ARGV: delta (1 or -1), ttl, conversation ids...
+CONVERSATIONS_SCRIPT = """
+local command = ARGV[1] == '1' and 'SADD' or 'SREM'
+for i = 3, #ARGV do
+    if redis.call(command, KEYS[1], ARGV[i]) == 1 and redis.call('HINCRBY', KEYS[2], ARGV[i], ARGV[1]) <= 0 then
+        redis.call('HDEL', KEYS[2], ARGV[i])
+    end
+end
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 1
+"""
+
+
+def _presence_keys(user_id: str, connection_id: str, node_id: str) -> List[str]:
+    return [
+        USER_CONNECTIONS_KEY.format(user_id=user_id),
+        ONLINE_USERS_KEY,
+        CONNECTION_KEY.format(connection_id=connection_id),
+        NODE_CONNECTIONS_KEY.format(node_id=node_id),
+        CONNECTION_CONVERSATIONS_KEY.format(connection_id=connection_id),
+        USER_CONVERSATIONS_KEY.format(user_id=user_id),
+    ]
 
 
 class RedisConnectionStore:
-    """Stores active WebSocket connections and online user state in Redis."""
+    """
+    Stores active WebSocket connections and online user state in Redis.
+    Presence is reference-counted per user (set of live connection ids) and every transition is
+    one server-side script, so concurrent connects and disconnects on different nodes cannot
+    leave a connected user marked offline.
+    """
 
     @staticmethod
-    async def set_online(user_id: UUID, connection_id: str, conversation_id: UUID) -> None:
+    async def set_online(
+        user_id: UUID,
+        connection_id: str,
+        node_id: str,
+        conversation_id: Optional[UUID] = None,
+    ) -> bool:
+        """Register a connection. Returns True when this was the user's first connection (online transition)."""
         redis = await get_redis()
         uid = str(user_id)
-        cid = str(conversation_id)
-        pipe = redis.pipeline()
-        pipe.sadd(ONLINE_USERS_KEY, uid)
-        pipe.sadd(USER_CONVERSATIONS_KEY.format(user_id=uid), cid)
-        pipe.hset(CONNECTION_KEY.format(connection_id=connection_id), mapping={
-            "user_id": uid,
-            "conversation_id": cid,
-        })
-        pipe.expire(CONNECTION_KEY.format(connection_id=connection_id), 86400)
-        await pipe.execute()
+        args = [uid, connection_id, node_id, CONNECTION_TTL, time.time(), PRESENCE_CHANNEL]
+        if conversation_id is not None:
+            args.append(str(conversation_id))
+        script = redis.register_script(CONNECT_SCRIPT)
+        return bool(await script(keys=_presence_keys(uid, connection_id, node_id), args=args))
+
+    @staticmethod
+    async def add_conversations(user_id: UUID, connection_id: str, conversation_ids: Iterable[UUID]) -> None:
+        await RedisConnectionStore._update_conversations(user_id, connection_id, conversation_ids, 1)
+
+    @staticmethod
+    async def remove_conversations(user_id: UUID, connection_id: str, conversation_ids: Iterable[UUID]) -> None:
+        await RedisConnectionStore._update_conversations(user_id, connection_id, conversation_ids, -1)
+
+    @staticmethod
+    async def _update_conversations(
+        user_id: UUID, connection_id: str, conversation_ids: Iterable[UUID], delta: int
+    ) -> None:
+        cids = [str(c) for c in conversation_ids]
+        if not cids:
+            return
+        redis = await get_redis()
+        script = redis.register_script(CONVERSATIONS_SCRIPT)
+        keys = [
+            CONNECTION_CONVERSATIONS_KEY.format(connection_id=connection_id),
+            USER_CONVERSATIONS_KEY.format(user_id=str(user_id)),
+        ]
+        await script(keys=keys, args=[delta, CONNECTION_TTL, *cids])
 
     @staticmethod
-    async def set_offline(user_id: UUID, connection_id: str, conversation_id: UUID) -> None:
+    async def set_offline(user_id: UUID, connection_id: str, node_id: str) -> bool:
+        """Drop a connection. Returns True when it was the user's last one (offline transition)."""
         redis = await get_redis()
         uid = str(user_id)
-        cid = str(conversation_id)
+        script = redis.register_script(DISCONNECT_SCRIPT)
+        keys = _presence_keys(uid, connection_id, node_id) + [LAST_SEEN_KEY]
+        return bool(await script(keys=keys, args=[uid, connection_id, time.time(), PRESENCE_CHANNEL]))
+
+    @staticmethod
+    async def renew_node_lease(node_id: str, ttl: int, url: Optional[str] = None) -> List[str]:
+        """
+        Extend this node's lease and claim nodes whose lease ran out (crashed or partitioned).
+        Returns the claimed node ids; ZREM decides the claim, so each dead node is purged by one node only.
+        """
+        redis = await get_redis()
+        now = time.time()
+        pipe = redis.pipeline()
+        pipe.zadd(NODE_LEASES_KEY, {node_id: now + ttl})
+        pipe.zrangebyscore(NODE_LEASES_KEY, "-inf", now)
+        if url:
+            pipe.hset(NODE_URLS_KEY, node_id, url)
+        expired = (await pipe.execute())[1]
+        claimed = []
+        for dead_node in expired:
+            if dead_node != node_id and await redis.zrem(NODE_LEASES_KEY, dead_node):
+                claimed.append(dead_node)
+        if claimed:
+            await redis.hdel(NODE_URLS_KEY, *claimed)
+        return claimed
+
+    @staticmethod
+    async def release_node_lease(node_id: str) -> None:
+        redis = await get_redis()
         pipe = redis.pipeline()
-        pipe.srem(USER_CONVERSATIONS_KEY.format(user_id=uid), cid)
-        pipe.delete(CONNECTION_KEY.format(connection_id=connection_id))
+        pipe.zrem(NODE_LEASES_KEY, node_id)
+        pipe.hdel(NODE_URLS_KEY, node_id)
         await pipe.execute()
-        conversations = await redis.smembers(USER_CONVERSATIONS_KEY.format(user_id=uid))
-        if not conversations:
-            pipe2 = redis.pipeline()
-            pipe2.srem(ONLINE_USERS_KEY, uid)
-            await pipe2.execute()
+
+    @staticmethod
+    async def get_live_nodes() -> Dict[str, str]:
+        """node id -> URL of every node holding an unexpired lease and advertising a URL."""
+        redis = await get_redis()
+        pipe = redis.pipeline()
+        pipe.zrangebyscore(NODE_LEASES_KEY, time.time(), "+inf")
+        pipe.hgetall(NODE_URLS_KEY)
+        live, urls = await pipe.execute()
+        return {node_id: urls[node_id] for node_id in live if urls.get(node_id)}
+
+    @staticmethod
+    async def purge_node(node_id: str) -> int:
+        """Remove the presence of every connection a dead node left behind. Returns how many were purged."""
+        redis = await get_redis()
+        node_key = NODE_CONNECTIONS_KEY.format(node_id=node_id)
+        connection_ids = list(await redis.smembers(node_key))
+        if connection_ids:
+            pipe = redis.pipeline()
+            for connection_id in connection_ids:
+                pipe.hget(CONNECTION_KEY.format(connection_id=connection_id), "user_id")
+            user_ids = await pipe.execute()
+            script = redis.register_script(DISCONNECT_SCRIPT)
+            now = time.time()
+            pipe = redis.pipeline(transaction=False)
+            for connection_id, uid in zip(connection_ids, user_ids):
+                if uid:
+                    keys = _presence_keys(uid, connection_id, node_id) + [LAST_SEEN_KEY]
+                    await script(keys=keys, args=[uid, connection_id, now, PRESENCE_CHANNEL], client=pipe)
+            await pipe.execute()
+        await redis.delete(node_key)
+        return len(connection_ids)
 
     @staticmethod
     async def is_user_online(user_id: UUID) -> bool:
@@ -49,10 +219,21 @@ class RedisConnectionStore:
         return await redis.sismember(ONLINE_USERS_KEY, str(user_id))
 
     @staticmethod
-    async def get_online_user_ids() -> Set[str]:
+    async def get_online_among(user_ids: Iterable[UUID]) -> List[str]:
+        """The subset of `user_ids` that is online, in one SMISMEMBER."""
+        ids = [str(uid) for uid in dict.fromkeys(user_ids)]
+        if not ids:
+            return []
+        redis = await get_redis()
+        flags = await redis.smismember(ONLINE_USERS_KEY, ids)
+        return [uid for uid, online in zip(ids, flags) if online]
+
+    @staticmethod
+    async def scan_online_user_ids(cursor: int = 0, count: int = 500) -> Tuple[int, List[str]]:
+        """One SSCAN page of online users; a returned cursor of 0 means the scan is complete."""
         redis = await get_redis()
-        members = await redis.smembers(ONLINE_USERS_KEY)
-        return members or set()
+        next_cursor, members = await redis.sscan(ONLINE_USERS_KEY, cursor=cursor, count=count)
+        return next_cursor, list(members)
 
     @staticmethod
     async def get_connection_info(connection_id: str) -> Optional[dict]:
@@ -65,5 +246,5 @@ class RedisConnectionStore:
     @staticmethod
     async def get_user_conversations(user_id: UUID) -> Set[str]:
         redis = await get_redis()
-        members = await redis.smembers(USER_CONVERSATIONS_KEY.format(user_id=str(user_id)))
-        return members or set()
+        members = await redis.hkeys(USER_CONVERSATIONS_KEY.format(user_id=str(user_id)))
+        return set(members)
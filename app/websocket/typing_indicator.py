@@ -1,52 +1,178 @@
-from typing import Dict, Optional
+import asyncio
+import logging
+import time
+from typing import Dict, Optional, Tuple
 from uuid import UUID
 from datetime import datetime, timezone
+from app.core.config import settings
 from app.db.redis_client import get_redis
 import json
 
+logger = logging.getLogger(__name__)
+
 TYPING_KEY_PREFIX = "typing:conversation:"
 TYPING_TTL = 10
 
+# Applies a conversation's pending typing changes and returns the resulting hash in one round trip.
+# KEYS[1] = typing hash; ARGV[1] = ttl; then (user_id, data) pairs, empty data meaning "stopped".
+TYPING_UPDATE_SCRIPT = """
+local key = KEYS[1]
+for i = 2, #ARGV, 2 do
+    if ARGV[i + 1] == '' then
+        redis.call('HDEL', key, ARGV[i])
+    else
+        redis.call('HSET', key, ARGV[i], ARGV[i + 1])
+    end
+end
+if redis.call('HLEN', key) > 0 then
+    redis.call('EXPIRE', key, ARGV[1])
+end
+return redis.call('HGETALL', key)
+"""
+
+
+def _parse_typing_users(data: Dict[str, str]) -> Dict[str, dict]:
+    # Entries of users who vanished without a "stopped" update age out even while others keep typing
+    cutoff = datetime.now(timezone.utc).timestamp() - TYPING_TTL
+    result = {}
+    for user_id_str, value_str in data.items():
+        try:
+            value = json.loads(value_str)
+            if datetime.fromisoformat(value["timestamp"]).timestamp() < cutoff:
+                continue
+        except (json.JSONDecodeError, TypeError, KeyError, ValueError):
+            continue
+        result[user_id_str] = value
+    return result
+
+
+def _typing_data(user_id: UUID, username: str) -> str:
+    return json.dumps({
+        "user_id": str(user_id),
+        "username": username,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+    })
+
 
 class TypingIndicatorManager:
     @staticmethod
-    async def set_typing(
-        conversation_id: UUID,
-        user_id: UUID,
-        username: str,
-        is_typing: bool = True
-    ) -> None:
+    async def get_typing_users(conversation_id: UUID) -> Dict[str, dict]:
         redis = await get_redis()
         key = f"{TYPING_KEY_PREFIX}{conversation_id}"
-        
+        return _parse_typing_users(await redis.hgetall(key))
+
+
+class TypingEngine:
+    """
+    Node-local typing pipeline. Per user, only state changes and a periodic refresh while still
+    typing get through (TYPING_REFRESH_SECONDS); accepted updates are collected per conversation
+    and applied every TYPING_TICK_MS with one pipelined script call per conversation, followed by
+    one typing_indicator broadcast per changed conversation.
+    """
+
+    def __init__(self, tick_ms: Optional[int] = None, refresh_seconds: Optional[float] = None) -> None:
+        self.tick = (tick_ms if tick_ms is not None else settings.TYPING_TICK_MS) / 1000
+        self.refresh = refresh_seconds if refresh_seconds is not None else settings.TYPING_REFRESH_SECONDS
+        # (conversation, user) currently typing -> monotonic time "typing" was last forwarded
+        self._last: Dict[Tuple[UUID, UUID], float] = {}
+        # conversation -> user -> serialized entry ("" for stopped), latest wins within a tick
+        self._pending: Dict[UUID, Dict[str, str]] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.accepted = 0
+        self.throttled = 0
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        await self._flush()
+
+    async def note(self, conversation_id: UUID, user_id: UUID, username: str, is_typing: bool = True) -> bool:
+        """Record a typing update; returns False when it was throttled away."""
+        if self._task is None:
+            await self.start()
+        now = time.monotonic()
+        slot = (conversation_id, user_id)
+        typing_since = self._last.get(slot)
         if is_typing:
-            data = {
-                "user_id": str(user_id),
-                "username": username,
-                "timestamp": datetime.now(timezone.utc).isoformat()
-            }
-            await redis.hset(key, str(user_id), json.dumps(data))
-            await redis.expire(key, TYPING_TTL)
+            # Still typing: forward only once per refresh interval to keep the Redis entry alive
+            throttled = typing_since is not None and now - typing_since < self.refresh
         else:
-            await redis.hdel(key, str(user_id))
-            if await redis.hlen(key) == 0:
-                await redis.delete(key)
+            # Never reported as typing from this node: nothing to clear
+            throttled = typing_since is None
+        if throttled:
+            self.throttled += 1
+            return False
+        if is_typing:
+            self._last[slot] = now
+        else:
+            del self._last[slot]
+        self._pending.setdefault(conversation_id, {})[str(user_id)] = (
+            _typing_data(user_id, username) if is_typing else ""
+        )
+        self.accepted += 1
+        self._wakeup.set()
+        return True
 
-    @staticmethod
-    async def get_typing_users(conversation_id: UUID) -> Dict[str, dict]:
-        redis = await get_redis()
-        key = f"{TYPING_KEY_PREFIX}{conversation_id}"
-        data = await redis.hgetall(key)
-        
-        result = {}
-        for user_id_str, value_str in data.items():
+    async def clear(self, conversation_id: UUID, user_id: UUID) -> None:
+        await self.note(conversation_id, user_id, "", False)
+
+    async def _run(self) -> None:
+        while True:
+            await self._wakeup.wait()
+            await asyncio.sleep(self.tick)
+            self._wakeup.clear()
             try:
-                result[user_id_str] = json.loads(value_str)
-            except (json.JSONDecodeError, TypeError):
-                continue
-        
-        return result
+                await self._flush()
+            except Exception:
+                logger.exception("Typing flush failed")
+            self._expire_stale()
 
-    @staticmethod
-    async def clear_typing(conversation_id: UUID, user_id: UUID) -> None:
-        await TypingIndicatorManager.set_typing(conversation_id, user_id, "", False)
+    def _expire_stale(self) -> None:
+        # Users whose last "typing" is older than the Redis TTL are gone from the hash already
+        cutoff = time.monotonic() - TYPING_TTL
+        for slot in [s for s, at in self._last.items() if at < cutoff]:
+            del self._last[slot]
+
+    async def _flush(self) -> None:
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        from app.websocket.events import typing_event
+        from app.websocket.manager import ws_manager
+
+        redis = await get_redis()
+        script = redis.register_script(TYPING_UPDATE_SCRIPT)
+        pipe = redis.pipeline(transaction=False)
+        conversation_ids = list(pending)
+        for conversation_id in conversation_ids:
+            args = [TYPING_TTL]
+            for user_id, data in pending[conversation_id].items():
+                args.extend((user_id, data))
+            await script(keys=[f"{TYPING_KEY_PREFIX}{conversation_id}"], args=args, client=pipe)
+        results = await pipe.execute()
+        for conversation_id, flat in zip(conversation_ids, results):
+            typing_users = _parse_typing_users(dict(zip(flat[::2], flat[1::2])))
+            await ws_manager.broadcast_to_conversation(conversation_id, typing_event(conversation_id, typing_users))
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "accepted": self.accepted,
+            "throttled": self.throttled,
+            "tracked_users": len(self._last),
+            "pending_conversations": len(self._pending),
+        }
+
+
+# Shared singleton — started from the app lifespan
+typing_engine = TypingEngine()
@@ -0,0 +1,7 @@
+from app.api.v1.conversations import router
+from app.core.dependencies import get_admin_user_id
+
+
+def test_bulk_ingest_is_admin_only():
+    (route,) = [r for r in router.routes if r.path == "/messages/bulk"]
+    assert get_admin_user_id in [dependency.call for dependency in route.dependant.dependencies]
@@ -0,0 +1,97 @@
+import asyncio
+import json
+
+import pytest
+
+from app.websocket.connection import Connection
+from app.websocket.frame import Frame
+
+pytestmark = pytest.mark.anyio
+
+
+class FakeWebSocket:
+    def __init__(self, blocked=False):
+        self.sent = []
+        self.closed = None
+        self.cancelled = False
+        self.gate = asyncio.Event()
+        if not blocked:
+            self.gate.set()
+
+    async def send_text(self, data):
+        try:
+            await self.gate.wait()
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        self.sent.append(json.loads(data))
+
+    async def close(self, code=1000):
+        self.closed = code
+
+
+async def test_writer_exists_only_while_frames_are_in_flight():
+    websocket = FakeWebSocket(blocked=True)
+    conn = Connection("c", websocket, "u")
+    assert conn._writer is None and conn._queue is None
+
+    for i in range(3):
+        assert conn.enqueue(Frame({"i": i}))
+    assert conn._writer is not None
+
+    websocket.gate.set()
+    await conn.flush()
+    assert websocket.sent == [{"i": 0}, {"i": 1}, {"i": 2}]
+    assert conn._writer is None and conn._queue is None
+
+
+async def test_backpressure_releases_once_the_queue_drains():
+    websocket = FakeWebSocket(blocked=True)
+    conn = Connection("c", websocket, "u", max_queue=8, overflow_policy="coalesce")
+    for i in range(8):
+        assert conn.enqueue(Frame({"i": i}))
+    dropped = Connection.frames_dropped
+    assert conn.enqueue(Frame({"t": 1}), "k") is False
+    assert Connection.frames_dropped == dropped + 1
+    waiter = asyncio.create_task(conn.wait_writable())
+    await asyncio.sleep(0)
+    assert not waiter.done()
+
+    websocket.gate.set()
+    await conn.flush()
+    assert waiter.done() and len(websocket.sent) == 8
+
+
+async def test_slow_consumer_is_evicted():
+    websocket = FakeWebSocket(blocked=True)
+    conn = Connection("c", websocket, "u", max_queue=2, overflow_policy="disconnect")
+    for _ in range(2):
+        assert conn.enqueue(Frame({}))
+    assert conn.enqueue(Frame({})) is False
+    assert conn.enqueue(Frame({})) is False
+
+    websocket.gate.set()
+    await conn.flush()
+    assert websocket.closed == 1013 and conn._writer is None
+
+
+async def test_stop_cancels_a_blocked_send():
+    websocket = FakeWebSocket(blocked=True)
+    conn = Connection("c", websocket, "u")
+    conn.enqueue(Frame({}))
+    await asyncio.sleep(0)
+
+    await conn.stop()
+    assert websocket.cancelled and websocket.sent == []
+
+
+async def test_failed_send_closes_the_connection():
+    class Broken(FakeWebSocket):
+        async def send_text(self, data):
+            raise RuntimeError("socket is gone")
+
+    conn = Connection("c", Broken(), "u")
+    assert conn.enqueue(Frame({}))
+    await conn.flush()
+    assert conn.closed
+    assert conn.enqueue(Frame({})) is False
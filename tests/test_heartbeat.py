@@ -0,0 +1,49 @@
+import time
+from uuid import uuid4
+
+import pytest
+
+from app.core.config import settings
+from app.websocket.connection import Connection
+from app.websocket.manager import ConnectionManager
+
+pytestmark = pytest.mark.anyio
+
+
+class FakeWebSocket:
+    closed = None
+
+    async def send_text(self, data):
+        pass
+
+    async def close(self, code=1000):
+        self.closed = code
+
+
+def silent_connection(manager):
+    conn = Connection(uuid4().hex, FakeWebSocket(), uuid4())
+    # A client from before the app-level ping: it never answers, so it looks idle
+    conn.last_seen = time.monotonic() - 3600
+    manager._register(conn)
+    return conn
+
+
+async def test_silent_clients_are_kept_by_default(redis):
+    manager = ConnectionManager()
+    conn = silent_connection(manager)
+
+    await manager._reap_idle()
+    stats = manager.stats()
+    assert (stats["connections"], stats["reaped"]) == (1, 0)
+    assert conn.websocket.closed is None
+
+
+async def test_idle_reap_is_opt_in(redis, monkeypatch):
+    monkeypatch.setattr(settings, "WS_IDLE_TIMEOUT", 75)
+    manager = ConnectionManager()
+    conn = silent_connection(manager)
+
+    await manager._reap_idle()
+    stats = manager.stats()
+    assert (stats["connections"], stats["reaped"]) == (0, 1)
+    assert conn.websocket.closed == 1001
@@ -0,0 +1,72 @@
+import asyncio
+from uuid import uuid4
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+from app.db.session import on_commit
+from app.services.membership_cache import MembershipCacheService
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture(autouse=True)
+def clear_local():
+    MembershipCacheService._local.clear()
+    yield
+    MembershipCacheService._local.clear()
+
+
+async def test_fill_that_read_before_a_removal_is_not_cached(redis):
+    conversation_id, removed, kept = uuid4(), uuid4(), uuid4()
+
+    # A reader misses and loads the participants while the removal is still uncommitted
+    assert await MembershipCacheService.is_participant(conversation_id, removed) is None
+    generation = await MembershipCacheService.generation(conversation_id)
+    stale = [removed, kept]
+
+    # The remover invalidates before and after its commit
+    await MembershipCacheService.invalidate(conversation_id)
+    await MembershipCacheService.invalidate(conversation_id)
+
+    # The reader's late write-back is refused, so the next check goes to the database again
+    assert not await MembershipCacheService.store_participants(conversation_id, stale, generation)
+    assert await MembershipCacheService.is_participant(conversation_id, removed) is None
+
+
+async def test_fill_between_flush_and_commit_is_dropped_after_commit(redis):
+    conversation_id, removed, kept = uuid4(), uuid4(), uuid4()
+
+    # Invalidated at flush; a reader then loads the pre-commit rows and caches them
+    await MembershipCacheService.invalidate(conversation_id)
+    generation = await MembershipCacheService.generation(conversation_id)
+    assert await MembershipCacheService.store_participants(conversation_id, [removed, kept], generation)
+    assert await MembershipCacheService.is_participant(conversation_id, removed) is True
+
+    # The post-commit invalidation removes the stale set and the local entry
+    await MembershipCacheService.invalidate(conversation_id)
+    assert await MembershipCacheService.is_participant(conversation_id, removed) is None
+
+
+async def test_on_commit_runs_after_commit_only(redis):
+    engine = create_async_engine("sqlite+aiosqlite://")
+    calls = []
+
+    async def record():
+        calls.append("ran")
+
+    try:
+        async with AsyncSession(engine) as db:
+            await db.execute(text("SELECT 1"))
+            on_commit(db, record)
+            await db.rollback()
+            await db.execute(text("SELECT 1"))
+            on_commit(db, record)
+            assert calls == []
+            await db.commit()
+        for _ in range(3):
+            await asyncio.sleep(0)
+        assert calls == ["ran"]
+    finally:
+        await engine.dispose()
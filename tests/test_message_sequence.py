@@ -0,0 +1,70 @@
+from datetime import datetime, timezone
+from uuid import uuid4
+
+import pytest
+
+from app.services.message_sequence import SEQUENCE_KEY, MessageSequenceService
+
+pytestmark = pytest.mark.anyio
+
+
+class ClaimTable:
+    """message_seqs: (conversation_id, seq) -> message id, with the repository's claim semantics."""
+
+    def __init__(self):
+        self.claims = {}
+
+    async def get_max_seqs(self, conversation_ids):
+        seqs = {}
+        for conversation_id, seq in self.claims:
+            if conversation_id in conversation_ids:
+                seqs[conversation_id] = max(seq, seqs.get(conversation_id, 0))
+        return seqs
+
+    async def claim_seqs(self, rows):
+        taken = []
+        for row in rows:
+            key = (row["conversation_id"], row["seq"])
+            if key in self.claims:
+                taken.append(row["id"])
+            else:
+                self.claims[key] = row["id"]
+        return taken
+
+    async def release_seqs(self, message_ids):
+        self.claims = {key: i for key, i in self.claims.items() if i not in message_ids}
+
+
+def rows(conversation_id, n):
+    now = datetime.now(timezone.utc)
+    return [{"id": uuid4(), "conversation_id": conversation_id, "created_at": now} for _ in range(n)]
+
+
+async def test_counter_behind_the_database_is_repaired(redis):
+    table = ClaimTable()
+    conversation_id = uuid4()
+    await MessageSequenceService.claim(rows(conversation_id, 5), table)
+    # A failover lost the last increments: the counter exists but is behind the stored seqs
+    await redis.set(SEQUENCE_KEY.format(conversation_id=str(conversation_id)), 1)
+
+    batch = rows(conversation_id, 3)
+    await MessageSequenceService.claim(batch, table)
+
+    assert [row["seq"] for row in batch] == [6, 7, 8]
+    assert sorted(seq for _, seq in table.claims) == list(range(1, 9))
+    assert all(table.claims[(conversation_id, row["seq"])] == row["id"] for row in batch)
+    assert await redis.get(SEQUENCE_KEY.format(conversation_id=str(conversation_id))) == "8"
+
+
+async def test_only_colliding_conversations_are_reallocated(redis):
+    table = ClaimTable()
+    behind, healthy = uuid4(), uuid4()
+    await MessageSequenceService.claim(rows(behind, 2), table)
+    await redis.set(SEQUENCE_KEY.format(conversation_id=str(behind)), 0)
+
+    # `behind` is handed 1-3: 1 and 2 collide, so 3 is given back too and the batch moves past it
+    batch = rows(healthy, 2) + rows(behind, 3)
+    await MessageSequenceService.claim(batch, table)
+
+    assert [row["seq"] for row in batch] == [1, 2, 4, 5, 6]
+    assert len(table.claims) == 7
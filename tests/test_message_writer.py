@@ -0,0 +1,105 @@
+from types import SimpleNamespace
+from uuid import uuid4
+
+import pytest
+
+import app.services.message_writer as writer_module
+from app.db.models import MessageReadStatus
+from app.services.message_writer import CommittedWriteError, MessageWriter
+
+pytestmark = pytest.mark.anyio
+
+
+class Session:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def commit(self):
+        pass
+
+
+@pytest.fixture
+def store(monkeypatch, redis):
+    rows = {}
+    inserts = []
+    # client_message_ids already claimed by a message committed elsewhere
+    claimed = set()
+
+    class MessageRepository:
+        def __init__(self, db):
+            pass
+
+        async def get_max_seqs(self, conversation_ids):
+            return {}
+
+        async def get_by_ids(self, ids):
+            return [rows[i] for i in ids if i in rows]
+
+        async def claim_seqs(self, batch):
+            return []
+
+        async def insert_many(self, batch):
+            inserts.append(len(batch))
+            created = []
+            for row in batch:
+                if row["id"] in rows:
+                    raise RuntimeError("duplicate key value violates unique constraint")
+                if row["client_message_id"] in claimed:
+                    continue
+                message = SimpleNamespace(**row)
+                rows[message.id] = message
+                created.append(message)
+            return created
+
+        async def get_by_client_message_ids(self, keys):
+            return []
+
+    class FailingUserRepository:
+        def __init__(self, db):
+            pass
+
+        async def get_by_ids(self, ids):
+            raise ConnectionError("connection reset")
+
+    monkeypatch.setattr(writer_module, "AsyncSessionLocal", Session)
+    monkeypatch.setattr(writer_module, "MessageRepository", MessageRepository)
+    monkeypatch.setattr(writer_module, "UserRepository", FailingUserRepository)
+    return SimpleNamespace(rows=rows, inserts=inserts, claimed=claimed)
+
+
+async def test_failure_after_commit_delivers_inserted_rows_without_retrying(store, redis):
+    writer = MessageWriter(flush_interval_ms=0)
+    conversation_id, sender_id = uuid4(), uuid4()
+    futures = [writer.enqueue(sender_id, conversation_id, f"m{i}", f"c{i}") for i in range(3)]
+
+    # Senders could not be loaded, but the inserted rows are known and get acknowledged
+    results = [await future for future in futures]
+    await writer.stop()
+    assert [(msg.content, created, msg.sender) for msg, created in results] == [
+        ("m0", True, None), ("m1", True, None), ("m2", True, None)
+    ]
+
+    # One batch INSERT, no row-by-row replay of rows that are already stored
+    assert store.inserts == [3]
+    assert len(store.rows) == 3
+    assert all(m.read_status == MessageReadStatus.sent for m in store.rows.values())
+    assert await redis.llen(f"messages:conversation:{conversation_id}") == 3
+
+
+async def test_retry_whose_original_cannot_be_read_fails_alone(store):
+    store.claimed.add("dup")
+    writer = MessageWriter(flush_interval_ms=0)
+    conversation_id, sender_id = uuid4(), uuid4()
+    futures = [writer.enqueue(sender_id, conversation_id, f"m{i}", cid) for i, cid in enumerate(["c0", "dup", "c2"])]
+
+    first = await futures[0]
+    with pytest.raises(CommittedWriteError):
+        await futures[1]
+    last = await futures[2]
+    await writer.stop()
+
+    assert (first[0].content, last[0].content) == ("m0", "m2")
+    assert store.inserts == [3] and len(store.rows) == 2
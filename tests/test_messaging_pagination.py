@@ -0,0 +1,71 @@
+from datetime import datetime, timedelta, timezone
+from uuid import uuid4
+
+import pytest
+
+from app.db.models import MessageReadStatus
+from app.services.message_cache import CACHE_SIZE, MessageCacheService
+from app.services.messaging_service import MessagingService
+
+pytestmark = pytest.mark.anyio
+
+
+class NoDatabase:
+    """Repository stand-in that fails the test if the database is asked for a page."""
+
+    def __getattr__(self, name):
+        raise AssertionError(f"database hit: {name}")
+
+
+def service() -> MessagingService:
+    svc = MessagingService.__new__(MessagingService)
+    svc.msg_repo = NoDatabase()
+
+    async def allow(conversation_id, user_id):
+        return None
+
+    svc._require_participant = allow
+    return svc
+
+
+async def fill_cache(conversation_id, count):
+    start = datetime(2026, 1, 1, tzinfo=timezone.utc)
+    for i in range(count):
+        await MessageCacheService.cache_message(conversation_id, {
+            "id": str(uuid4()),
+            "sender_id": str(uuid4()),
+            "conversation_id": str(conversation_id),
+            "seq": i + 1,
+            "content": f"m{i}",
+            "created_at": (start + timedelta(seconds=i)).isoformat(),
+            "read_status": MessageReadStatus.sent.value,
+        })
+
+
+async def test_default_newest_page_is_served_from_cache(redis):
+    conversation_id = uuid4()
+    await fill_cache(conversation_id, CACHE_SIZE + 20)
+
+    page = await service().get_conversation_messages(conversation_id, uuid4())
+
+    assert [m.seq for m in page.messages] == list(range(CACHE_SIZE + 20 - 49, CACHE_SIZE + 21))
+    assert page.has_older and page.prev_cursor is not None
+    assert not page.has_newer
+
+
+async def test_largest_page_is_served_from_cache(redis):
+    conversation_id = uuid4()
+    await fill_cache(conversation_id, CACHE_SIZE)
+
+    page = await service().get_conversation_messages(conversation_id, uuid4(), limit=CACHE_SIZE - 1)
+
+    assert len(page.messages) == CACHE_SIZE - 1
+    assert page.has_older
+
+
+async def test_short_cache_falls_back_to_database(redis):
+    conversation_id = uuid4()
+    await fill_cache(conversation_id, 50)
+
+    with pytest.raises(AssertionError, match="database hit"):
+        await service().get_conversation_messages(conversation_id, uuid4(), limit=50)
@@ -0,0 +1,53 @@
+from datetime import date
+
+import pytest
+
+import app.db.partitions as partitions
+from app.db.partitions import MessagePartitionMaintainer, UnpartitionedMessagesTable, monthly_ranges
+
+pytestmark = pytest.mark.anyio
+
+
+def test_monthly_ranges_cover_last_month_to_months_ahead_across_a_year_end():
+    assert monthly_ranges(date(2026, 12, 17), 2) == [
+        ("messages_p2026_11", date(2026, 11, 1), date(2026, 12, 1)),
+        ("messages_p2026_12", date(2026, 12, 1), date(2027, 1, 1)),
+        ("messages_p2027_01", date(2027, 1, 1), date(2027, 2, 1)),
+        ("messages_p2027_02", date(2027, 2, 1), date(2027, 3, 1)),
+    ]
+
+
+class FakeEngine:
+    def __init__(self, relkind):
+        self.relkind = relkind
+
+    def connect(self):
+        engine = self
+
+        class Result:
+            def scalar_one_or_none(self):
+                return engine.relkind
+
+        class Connection:
+            async def __aenter__(self):
+                return self
+
+            async def __aexit__(self, *exc):
+                return False
+
+            async def execute(self, statement, params=None):
+                return Result()
+
+        return Connection()
+
+
+@pytest.mark.parametrize("relkind", [None, "p"])
+async def test_check_layout_accepts_missing_or_partitioned_table(monkeypatch, relkind):
+    monkeypatch.setattr(partitions, "engine", FakeEngine(relkind))
+    await MessagePartitionMaintainer(1).check_layout()
+
+
+async def test_check_layout_refuses_an_unpartitioned_table(monkeypatch):
+    monkeypatch.setattr(partitions, "engine", FakeEngine("r"))
+    with pytest.raises(UnpartitionedMessagesTable, match="not partitioned"):
+        await MessagePartitionMaintainer(1).check_layout()
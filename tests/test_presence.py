@@ -0,0 +1,60 @@
+import time
+from types import SimpleNamespace
+from uuid import uuid4
+
+import pytest
+
+import app.websocket.manager as manager_module
+import app.websocket.presence as presence_module
+from app.websocket.presence import ONLINE, PresenceNotifier
+
+pytestmark = pytest.mark.anyio
+
+
+class Session:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+async def test_flush_queries_only_the_due_users_on_a_node_with_many_conversations(monkeypatch):
+    alice, bob = uuid4(), uuid4()
+    shared = uuid4()
+    # A node with far more subscribed conversations than a query may bind
+    local = {uuid4(): {f"c{i}": bob} for i in range(40_000)}
+    local[shared] = {"bob-socket": bob}
+    queries = []
+    sent = []
+
+    class ConversationRepository:
+        def __init__(self, db):
+            pass
+
+        async def get_memberships(self, user_ids):
+            queries.append(list(user_ids))
+            # alice is also in a conversation nobody on this node has open
+            return {alice: {shared, uuid4()}}
+
+    async def send_to_connection(connection_id, frame):
+        sent.append((connection_id, frame.message))
+        return True
+
+    manager = SimpleNamespace(
+        get_local_conversation_ids=lambda: list(local),
+        get_connection_ids_for_conversation=lambda conversation_id: set(local.get(conversation_id, {})),
+        get_connection_user=lambda connection_id: bob,
+        send_to_connection=send_to_connection,
+    )
+    monkeypatch.setattr(manager_module, "ws_manager", manager)
+    monkeypatch.setattr(presence_module, "AsyncSessionLocal", Session)
+    monkeypatch.setattr(presence_module, "ConversationRepository", ConversationRepository)
+
+    notifier = PresenceNotifier(interval_ms=0, offline_grace=0)
+    notifier.note(alice, ONLINE, time.time())
+    await notifier._flush()
+
+    assert queries == [[alice]]
+    assert notifier.stats()["frames_sent"] == 1
+    assert sent == [("bob-socket", {"type": "presence", "users": [{"user_id": str(alice), "status": ONLINE}]})]
@@ -0,0 +1,27 @@
+import pytest
+
+from app.core.rate_limit import RateLimiter
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_partial_grant_only_counts_granted_units(redis):
+    assert await RateLimiter.acquire("k", 8, limit=10, window_seconds=3600) == (8, None)
+
+    granted, retry_after = await RateLimiter.acquire("k", 5, limit=10, window_seconds=3600)
+    assert granted == 2 and retry_after > 0
+
+    # Denied units were not charged: the window holds exactly the limit
+    (key,) = await redis.keys("rate_limit:k:*")
+    assert await redis.get(key) == "10"
+    assert 0 < await redis.ttl(key) <= 3610
+
+
+async def test_exhausted_window_grants_nothing_and_stays_at_the_limit(redis):
+    await RateLimiter.acquire("k", 10, limit=10, window_seconds=3600)
+    for _ in range(3):
+        granted, retry_after = await RateLimiter.acquire("k", 4, limit=10, window_seconds=3600)
+        assert granted == 0 and retry_after > 0
+
+    (key,) = await redis.keys("rate_limit:k:*")
+    assert await redis.get(key) == "10"
@@ -0,0 +1,45 @@
+from datetime import datetime, timezone
+from uuid import uuid4
+
+import pytest
+
+from app.core.pagination import encode_cursor
+from app.services.messaging_service import MessagingService
+
+pytestmark = pytest.mark.anyio
+
+
+class Repository:
+    def __init__(self):
+        self.chunks = []
+
+    async def get_by_id(self, message_id, options=None):
+        raise AssertionError("resume must not look the anchor up by id")
+
+    async def get_conversation_chunk(self, conversation_id, after, limit=100, inclusive=False):
+        self.chunks.append((conversation_id, after, limit))
+        return []
+
+
+def service():
+    svc = MessagingService.__new__(MessagingService)
+    svc.msg_repo = Repository()
+    return svc
+
+
+async def test_resume_reads_after_the_cursor_position_without_an_id_lookup():
+    svc = service()
+    conversation_id, message_id = uuid4(), uuid4()
+    created_at = datetime(2026, 3, 1, 12, 0, tzinfo=timezone.utc)
+
+    delta = await svc.get_resume_delta(conversation_id, encode_cursor(created_at, message_id), 10)
+
+    assert delta == []
+    assert svc.msg_repo.chunks == [(conversation_id, (created_at, message_id), 10)]
+
+
+@pytest.mark.parametrize("token", [str(uuid4()), "not-a-cursor", ""])
+async def test_invalid_resume_token_means_resync(token):
+    svc = service()
+    assert await svc.get_resume_delta(uuid4(), token, 10) is None
+    assert svc.msg_repo.chunks == []
@@ -0,0 +1,105 @@
+import asyncio
+from types import SimpleNamespace
+from uuid import uuid4
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+import app.services.messaging_service as messaging_module
+from app.db.models import MessageReadStatus
+from app.schemas.messaging import MessageCreate
+from app.services.message_cache import MESSAGE_CACHE_KEY
+from app.services.message_dedupe import PENDING, _key
+from app.services.messaging_service import MessagingService
+
+pytestmark = pytest.mark.anyio
+
+
+class Repository:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.rows = {}
+
+    async def get_max_seqs(self, conversation_ids):
+        return {}
+
+    async def claim_seqs(self, rows):
+        return []
+
+    async def insert_many(self, rows):
+        if self.fail:
+            raise ConnectionError("connection reset")
+        for row in rows:
+            self.rows[row["id"]] = SimpleNamespace(**row, sender=None)
+        return list(rows)
+
+    async def get_by_id(self, message_id, options=None):
+        return self.rows[message_id]
+
+
+@pytest.fixture
+async def db():
+    engine = create_async_engine("sqlite+aiosqlite://")
+    async with AsyncSession(engine) as session:
+        await session.execute(text("SELECT 1"))
+        yield session
+    await engine.dispose()
+
+
+def service(db, repo):
+    svc = MessagingService.__new__(MessagingService)
+    svc.db = db
+    svc.msg_repo = repo
+
+    async def allowed(conversation_id, user_id):
+        pass
+
+    svc._require_participant = allowed
+    return svc
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+async def send(svc):
+    conversation_id, sender_id = uuid4(), uuid4()
+    data = MessageCreate(conversation_id=conversation_id, content="hi", client_message_id="c1")
+    return (conversation_id, sender_id, "c1"), await svc.send_message(sender_id, data)
+
+
+async def test_failed_insert_releases_the_dedupe_claim(redis, db):
+    svc = service(db, Repository(fail=True))
+    conversation_id, sender_id = uuid4(), uuid4()
+    data = MessageCreate(conversation_id=conversation_id, content="hi", client_message_id="c1")
+
+    with pytest.raises(ConnectionError):
+        await svc.send_message(sender_id, data)
+    assert await redis.get(_key((conversation_id, sender_id, "c1"))) is None
+
+
+async def test_dedupe_record_and_cache_wait_for_the_commit(redis, db):
+    svc = service(db, Repository())
+    client_key, (msg, created) = await send(svc)
+    cache_key = MESSAGE_CACHE_KEY.format(conversation_id=str(client_key[0]))
+
+    assert created and msg.read_status == MessageReadStatus.sent
+    assert await redis.get(_key(client_key)) == PENDING
+    assert await redis.llen(cache_key) == 0
+
+    await db.commit()
+    await settle()
+    assert await redis.get(_key(client_key)) == str(msg.id)
+    assert await redis.llen(cache_key) == 1
+
+
+async def test_rollback_releases_the_claim_and_caches_nothing(redis, db):
+    svc = service(db, Repository())
+    client_key, _ = await send(svc)
+
+    await db.rollback()
+    await settle()
+    assert await redis.get(_key(client_key)) is None
+    assert await redis.llen(MESSAGE_CACHE_KEY.format(conversation_id=str(client_key[0]))) == 0
@@ -0,0 +1,17 @@
+from uuid import uuid4
+
+import pytest
+
+from app.api.v1.websocket import realtime_stats
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_stats_report_every_node_component():
+    stats = await realtime_stats(uuid4())
+
+    assert stats["writer"]["queue_depth"] == 0
+    assert "max_lag_ms" in stats["fanout"]
+    assert stats["admission"]["rejected"] == 0
+    assert stats["presence"] == {"frames_sent": 0, "pending_users": 0}
+    assert set(stats["typing"]) == {"accepted", "throttled", "tracked_users", "pending_conversations"}